@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+from lexer import lex_source
+from lowering import lower_program
+from parser import Program, parse_program_from_file
+from typechecker import typecheck_program
+
+# Benchmarks of the front end on generated programs, every size doubles the one before so
+# the ratio of the times shows how the cost grows, close to 1 per line is linear
+
+default_lines = 51200
+default_megabytes = 16
+default_ir_lines = 102400
+
+
+# Program of about the given number of lines, declarations, loops, branches and functions
+# nested the way real programs are
+def synthetic_program(lines: int) -> str:
+    chunks: List[str] = []
+
+    k = 0
+    while 10 * k < lines:
+        if k % 4 == 0:
+            chunks.append(f"f{k} := func (a:i64) -> (i64) {{\n"
+                          f"    b:i64 = a + {k}\n"
+                          f"    -> b * 2\n"
+                          f"}}\n")
+        else:
+            chunks.append(f"v{k}:i64 = {k}\n"
+                          f"while v{k} < {k} + 3 {{\n"
+                          f"    t{k}:i64 = v{k} * 2\n"
+                          f"    if t{k} > 4 {{\n"
+                          f"        print t{k}\n"
+                          f"    }}\n"
+                          f"    else {{\n"
+                          f"        print v{k}\n"
+                          f"    }}\n"
+                          f"    v{k} = v{k} + 1\n"
+                          f"}}\n")
+        k += 1
+
+    return "".join(chunks)
+
+
+def write_source(directory: str, source: str) -> str:
+    path = os.path.join(directory, "bench.hc")
+    with open(path, "w") as file:
+        file.write(source)
+
+    return path
+
+
+def time_parse(source: str) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_source(directory, source)
+
+        start = time.perf_counter()
+        parse_program_from_file(path)
+        return time.perf_counter() - start
+
+
+def parse_scaling(max_lines: int):
+    print(f"{'lines':>8} {'seconds':>9} {'us/line':>9} {'growth':>7}")
+
+    previous = None
+    lines = 800
+    while lines <= max_lines:
+        source = synthetic_program(lines)
+        count = source.count("\n")
+        seconds = time_parse(source)
+
+        # exponent of the cost in the number of lines, 1 is linear and 2 quadratic
+        growth = "" if previous is None else f"{math.log2(seconds / previous[1]) / math.log2(count / previous[0]):.2f}"
+        print(f"{count:>8} {seconds:>9.3f} {seconds / count * 1e6:>9.2f} {growth:>7}")
+
+        previous = (count, seconds)
+        lines *= 2
+
+
+# Lexing throughput, the tokens are only counted so the peak memory shows the source is
+# never held as a whole
+def lex_throughput(megabytes: int):
+    chunk = synthetic_program(default_lines)
+    source = chunk * max(1, megabytes * 2**20 // len(chunk))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_source(directory, source)
+        size = os.path.getsize(path) / 2**20
+
+        start = time.perf_counter()
+        count = sum([1 for _ in lex_source(path)])
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        for _ in lex_source(path):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print(f"{size:.1f} MB, {count} tokens in {seconds:.3f}s")
+    print(f"{size / seconds:.1f} MB/s, {count / seconds / 1e6:.2f} M tokens/s, peak memory {peak / 2**10:.0f} KB")
+
+
+def operation_count(program: Program) -> int:
+    return len(program.operations) + sum([len(func.operations) for func in program.funcs])
+
+
+def load_program(path: str) -> Program:
+    program = parse_program_from_file(path)
+    typecheck_program(program)
+    lower_program(program)
+
+    return program
+
+
+# Memory the ir of a generated program holds once it is typechecked and lowered, the way
+# the interpreter and the compilers get it
+def ir_memory(lines: int):
+    source = synthetic_program(lines)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_source(directory, source)
+
+        start = time.perf_counter()
+        load_program(path)
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        program = load_program(path)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    count = operation_count(program)
+    print(f"{source.count(chr(10))} lines, {count} operations, loaded in {seconds:.2f}s")
+    print(f"ir {size / 2**20:.1f} MB, {size / count:.0f} bytes per operation, peak {peak / 2**20:.1f} MB")
+
+
+def usage():
+    print("./benchmark.py [benchmark] [..options]")
+    print("   benchmarks:")
+    print("       - parse [MAX_LINES] : parse time of generated programs of doubling size (default 51200 lines)")
+    print("       - lex [MEGABYTES] : lexing throughput on a generated source (default 16 MB)")
+    print("       - ir [LINES] : memory of the typechecked and lowered ir of a generated program (default 102400 lines)")
+
+
+def main() -> int:
+    if len(sys.argv) < 2:
+        usage()
+        return 1
+
+    if sys.argv[1] == "parse":
+        parse_scaling(int(sys.argv[2]) if len(sys.argv) > 2 else default_lines)
+    elif sys.argv[1] == "lex":
+        lex_throughput(int(sys.argv[2]) if len(sys.argv) > 2 else default_megabytes)
+    elif sys.argv[1] == "ir":
+        ir_memory(int(sys.argv[2]) if len(sys.argv) > 2 else default_ir_lines)
+    else:
+        usage()
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,380 @@
+import struct
+import sys
+from typing import Callable, List
+
+from interpreter import AllocStats, Memory, apply_op_binary, convert_value, copy_memory, fill_memory, load_memory, \
+    make_memory, slot_format, store_memory
+from lowering import ExprOp, Instr
+from misc import not_implemented, report_error
+from parser import OpType, Operation, Program
+from static_types import FuncType, Primitives, TypedPtr, Types, size_of_primitive, type_str
+
+# Closure compiled engine, every operation is translated ahead of time into a python closure
+# with its expression, slots, types and jump targets already bound, the driver loop then only
+# has to call the closure at ip and use whatever it returns as the next ip
+
+float_types = [Primitives.F32, Primitives.F64]
+f32 = struct.Struct("f")
+
+
+def round_f32(value: float) -> float:
+    return f32.unpack(f32.pack(value))[0]
+
+
+def make_const(value: int | float) -> Callable:
+    return lambda: value
+
+
+def make_load(frame: List, slot: int) -> Callable:
+    return lambda: frame[slot]
+
+
+def make_not(a: Callable) -> Callable:
+    return lambda: 0 if a() else 1
+
+
+def make_deref(a: Callable, tp: Types, global_memory: Memory) -> Callable:
+    # bytes can never be unaligned so they index the view directly
+    if size_of_primitive(tp) == 1:
+        view = global_memory.views["B"]
+        return lambda: view[a()]
+
+    return lambda: load_memory(global_memory, a(), tp)
+
+
+def make_arithmetic(opcode: ExprOp, b: Callable, a: Callable) -> Callable:
+    if opcode == ExprOp.Add:
+        return lambda: b() + a()
+    elif opcode == ExprOp.Sub:
+        return lambda: b() - a()
+
+    return lambda: b() * a()
+
+
+def make_binary(opcode: ExprOp, b: Callable, b_tp: Types, a: Callable, a_tp: Types,
+                tp: Types, file: str, line: int) -> Callable:
+
+    if opcode in [ExprOp.Add, ExprOp.Sub, ExprOp.Mul]:
+        fn = make_arithmetic(opcode, b, a)
+
+        # python already keeps ints and floats apart, only mixed oprands need a conversion
+        is_float = tp in float_types
+        if is_float and not (a_tp in float_types and b_tp in float_types):
+            return lambda: float(fn())
+        elif not is_float and (a_tp in float_types or b_tp in float_types):
+            return lambda: int(fn())
+
+        return fn
+
+    elif opcode == ExprOp.Lt:
+        return lambda: 1 if b() < a() else 0
+    elif opcode == ExprOp.Gt:
+        return lambda: 1 if b() > a() else 0
+    elif opcode == ExprOp.Eq:
+        return lambda: 1 if b() == a() else 0
+    elif opcode == ExprOp.Ne:
+        return lambda: 1 if b() != a() else 0
+    elif opcode == ExprOp.And:
+        return lambda: 1 if (b() and a()) else 0
+    elif opcode == ExprOp.Or:
+        return lambda: 1 if (b() or a()) else 0
+
+    # division has to follow c semantics so it goes through the reference implementation
+    return lambda: apply_op_binary(opcode, b(), a(), tp, file, line)
+
+
+def compile_expression(code: List[Instr], frame: List, global_memory: Memory,
+                       file: str, line: int) -> Callable:
+    stack: List[tuple[Callable, Types]] = []
+
+    # left hand sides of && and || waiting for their right hand side
+    pending: List[tuple[Callable, Types, ExprOp]] = []
+
+    for instr in code:
+        opcode = instr.opcode
+
+        if opcode == ExprOp.Const:
+            stack.append((make_const(instr.arg), instr.type))
+
+        elif opcode == ExprOp.Load:
+            stack.append((make_load(frame, instr.arg), instr.type))
+
+        elif opcode == ExprOp.Not:
+            a, _ = stack.pop()
+            stack.append((make_not(a), instr.type))
+
+        elif opcode == ExprOp.Deref:
+            a, _ = stack.pop()
+            stack.append((make_deref(a, instr.type, global_memory), instr.type))
+
+        elif opcode == ExprOp.Call:
+            not_implemented("function calls in the interpreter")
+
+        elif opcode in [ExprOp.JumpIfFalse, ExprOp.JumpIfTrue]:
+            b, b_tp = stack.pop()
+            pending.append((b, b_tp, ExprOp.And if opcode == ExprOp.JumpIfFalse else ExprOp.Or))
+
+        elif opcode == ExprOp.ToBool:
+            a, a_tp = stack.pop()
+            b, b_tp, logic = pending.pop()
+            stack.append((make_binary(logic, b, b_tp, a, a_tp,
+                         instr.type, file, line), instr.type))
+
+        else:
+            a, a_tp = stack.pop()
+            b, b_tp = stack.pop()
+            stack.append((make_binary(opcode, b, b_tp, a, a_tp,
+                         instr.type, file, line), instr.type))
+
+    return stack.pop()[0]
+
+
+def make_begin_scope(op: Operation, frame: List, stats: AllocStats, nxt: int) -> Callable:
+    if len(op.slots) == 0:
+        return lambda: nxt
+
+    stats.scopes += 1
+
+    start = op.slots[0]
+    end = op.slots[-1] + 1
+    zeros = [0.0 if tp in float_types else 0 for tp in op.types[1:]]
+
+    def begin_scope():
+        frame[start:end] = zeros
+        return nxt
+
+    return begin_scope
+
+
+def make_mov(op: Operation, expr: Callable, expr_tp: Types, frame: List,
+             global_memory: Memory, memory_ptr: int, nxt: int) -> Callable:
+    deref = op.oprands[-2]
+    tp = op.types[-1]
+    slot = op.slots[-1]
+
+    if deref:
+        primitive = tp.primitive
+        size = size_of_primitive(primitive)
+
+        if size == 1:
+            view = global_memory.views["B"]
+            fmt = slot_format(primitive)
+
+            def mov_deref_byte():
+                address = frame[slot]
+                if address > memory_ptr - 1:
+                    report_error(
+                        f"trying to access unallocated memory", op.file, op.line)
+
+                view[address] = convert_value(fmt, expr())
+                return nxt
+
+            return mov_deref_byte
+
+        def mov_deref():
+            address = frame[slot]
+            if address + size - 1 > memory_ptr - 1:
+                report_error(
+                    f"trying to access unallocated memory", op.file, op.line)
+
+            store_memory(global_memory, address, primitive, expr())
+            return nxt
+
+        return mov_deref
+
+    elif tp == Primitives.F32:
+        def mov_f32():
+            frame[slot] = round_f32(expr())
+            return nxt
+
+        return mov_f32
+
+    elif tp == Primitives.F64 and expr_tp not in float_types:
+        def mov_float():
+            frame[slot] = float(expr())
+            return nxt
+
+        return mov_float
+
+    elif tp in [Primitives.I64, Primitives.I32, Primitives.Byte, Primitives.Bool] or type(tp) in [TypedPtr, FuncType]:
+        fmt = slot_format(tp)
+
+        # integers wrap on store like they do in the interpreter, floats are cut to integers
+        def mov_int():
+            frame[slot] = convert_value(fmt, expr())
+            return nxt
+
+        return mov_int
+
+    elif tp == Primitives.F64:
+        def mov():
+            frame[slot] = expr()
+            return nxt
+
+        return mov
+
+    report_error(
+        f"assignment for this type `{type_str(tp)}` not defined", op.file, op.line)
+
+
+def make_bulk(op: Operation, expr: Callable, frame: List, global_memory: Memory,
+              memory_ptr: int, nxt: int) -> Callable:
+    dst, count = op.slots
+    primitive = op.types[0].primitive
+
+    if op.type == OpType.OpFill:
+        def fill():
+            fill_memory(global_memory, frame[dst], frame[count], primitive,
+                        expr(), memory_ptr, op.file, op.line)
+            return nxt
+
+        return fill
+
+    def copy():
+        copy_memory(global_memory, frame[dst], expr(), frame[count], primitive,
+                    memory_ptr, op.file, op.line)
+        return nxt
+
+    return copy
+
+
+def make_print(op: Operation, expr: Callable, nxt: int) -> Callable:
+    tp = op.types[-1]
+    write = sys.stdout.write
+
+    if tp in [Primitives.I32, Primitives.I64, Primitives.F32, Primitives.F64]:
+        def print_value():
+            write(str(expr()))
+            return nxt
+
+    elif tp == Primitives.Byte:
+        def print_value():
+            write(chr(expr()))
+            return nxt
+
+    elif tp == Primitives.Bool:
+        def print_value():
+            write("true" if expr() == 1 else "false")
+            return nxt
+
+    elif type(tp) == TypedPtr:
+        name = type_str(tp.primitive)
+
+        def print_value():
+            write(f"^{name}({expr()})")
+            return nxt
+
+    else:
+        report_error(
+            f"undefined print for this type", op.file, op.line)
+
+    return print_value
+
+
+def compile_operations(program: Program, frame: List, global_memory: Memory,
+                       stats: AllocStats) -> List[Callable]:
+    ops = program.operations
+    steps: List[Callable] = [None] * len(ops)
+
+    # true when a branch of the current if chain was taken
+    chain = [False]
+
+    assert len(OpType) == 12, "Exhaustive handling of operations"
+
+    for ip, op in enumerate(ops):
+        nxt = ip + 1
+
+        if op.type == OpType.OpBeginScope:
+            steps[ip] = make_begin_scope(op, frame, stats, nxt)
+
+        elif op.type == OpType.OpEndScope:
+            target = op.oprands[-1] if len(op.oprands) > 0 else nxt
+            steps[ip] = make_const(target)
+
+        # pushes are fused with the operation consuming them
+        elif op.type == OpType.OpPush:
+            pass
+
+        elif op.type == OpType.OpElse:
+            end = ip + op.oprands[-1] + 1
+            steps[ip] = lambda end=end, nxt=nxt: end if chain[0] else nxt
+
+        else:
+            push = ops[ip - 1]
+            if push.type != OpType.OpPush:
+                report_error(
+                    f"expected expression before operation", op.file, op.line)
+
+            expr = compile_expression(
+                push.code, frame, global_memory, push.file, push.line)
+
+            if op.type == OpType.OpMov:
+                step = make_mov(op, expr, push.code[-1].type, frame,
+                                global_memory, program.memory_ptr, nxt)
+
+            elif op.type == OpType.OpIf:
+                end = ip + op.oprands[-1] + 1
+
+                def step(expr=expr, end=end, nxt=nxt):
+                    if expr():
+                        chain[0] = True
+                        return nxt
+
+                    chain[0] = False
+                    return end
+
+            elif op.type == OpType.OpElseIf:
+                end = ip + op.oprands[-1] + 1
+
+                def step(expr=expr, end=end, nxt=nxt):
+                    if chain[0]:
+                        return end
+
+                    if expr():
+                        chain[0] = True
+                        return nxt
+
+                    return end
+
+            elif op.type == OpType.OpWhile:
+                end = ip + op.oprands[-1] + 1
+
+                def step(expr=expr, end=end, nxt=nxt):
+                    return nxt if expr() else end
+
+            elif op.type == OpType.OpPrint:
+                step = make_print(op, expr, nxt)
+
+            elif op.type in [OpType.OpFill, OpType.OpCopy]:
+                step = make_bulk(op, expr, frame, global_memory,
+                                 program.memory_ptr, nxt)
+
+            else:
+                not_implemented(f"closure compilation of `{op.type}`")
+
+            steps[ip - 1] = step
+            steps[ip] = step
+
+    return steps
+
+
+def interpret_program(program: Program, stats: AllocStats | None = None):
+    if stats is None:
+        stats = AllocStats()
+
+    frame = [0] * program.frame_size
+    global_memory = make_memory(program.memory_capacity)
+    stats.frames += 1
+    stats.memory += 1
+
+    steps = compile_operations(program, frame, global_memory, stats)
+
+    ip = 0
+    end = len(steps)
+
+    stats.begin_run()
+
+    while ip < end:
+        ip = steps[ip]()
+
+    stats.end_run()
@@ -2,8 +2,11 @@ from calendar import c
 from pprint import pprint
 from typing import List, Tuple
 from misc import report_error
-from parser import Function, OpType, Program
-from static_types import FuncCall, FuncType, Primitives, TypedPtr, Types, type_str
+from ir import expression_tree, if_chain, is_const
+from lowering import ExprOp
+from parser import Function, OpType, Operation, Program
+from staticinit import StaticImage
+from static_types import FuncCall, FuncType, Primitives, TypedPtr, Types, size_of_primitive, type_str
 
 
 def husky_to_c_type(tp: Types) -> str:
@@ -49,7 +52,7 @@ def compile_expression(value_stack: List, type_stack: List[Types]) -> str:
         else:
             if type(tp) == TypedPtr:
                 if deref:
-                    c_code += f"*(({type_str(tp.primitive)}*)(global_memory + {val}))"
+                    c_code += f"*(({type_str(tp.primitive)}*)load_at({val},{size_of_primitive(tp.primitive)}))"
                     deref = False
                 else:
                     c_code += f"{val}"
@@ -63,27 +66,78 @@ def compile_expression(value_stack: List, type_stack: List[Types]) -> str:
                     oprands.append(compile_expression(opr, tp.types[i]))
                 c_code += ",".join(oprands)
                 c_code += f")"
+            elif type(val) in [int, float] and val < 0:
+                # keeps folded negative constants from merging with a `-` before them
+                c_code += f"({val})"
             else:
                 c_code += f"{val}"
 
     return c_code
 
 
+# Returns the variable and the constant each branch compares it against (None for an else)
+# when every condition of the if chain at ip is `variable == constant`
+def switch_cases(ops: List[Operation], ip: int) -> Tuple[str, List[Tuple[int, int | None]]] | None:
+    chain = if_chain(ops, ip)
+    if len([i for i in chain if ops[i].type != OpType.OpElse]) < 3:
+        return None
+
+    var = None
+    cases: List[Tuple[int, int | None]] = []
+
+    for i in chain:
+        if ops[i].type == OpType.OpElse:
+            cases.append((i, None))
+            continue
+
+        tree = expression_tree(ops[i - 1])
+        if tree.opcode != ExprOp.Eq:
+            return None
+
+        b, a = tree.children
+        if is_const(b):
+            b, a = a, b
+
+        if b.opcode != ExprOp.Load or not is_const(a) or type(a.value) != int \
+                or b.type not in [Primitives.I32, Primitives.I64, Primitives.Byte, Primitives.Bool]:
+            return None
+
+        if var is None:
+            var = b.value
+        if b.value != var or a.value in [case for _, case in cases]:
+            return None
+
+        cases.append((i, a.value))
+
+    return var, cases
+
+
 def compile_operations(program: Program | Function) -> str:
     c_code = ""
 
     type_stack: List[Types] = []
     value_stack: List[int | str] = []
 
-    assert len(OpType) == 10, "Exhaustive handling of operations"
+    # if chains compiled as a switch, end of each branch -> code following it and the
+    # else ifs and elses with their conditions that are left out
+    switch_labels: dict = {}
+    switch_skipped: set = set()
+
+    assert len(OpType) == 12, "Exhaustive handling of operations"
 
-    for op in program.operations:
+    ops = program.operations
+    for ip, op in enumerate(ops):
+
+        if ip in switch_skipped:
+            continue
 
         if op.type == OpType.OpBeginScope:
             c_code += "{\n"
 
+            # parameters are declared by the function's signature, they only ever come
+            # first in its outer scope
             is_func = type(program) == Function
-            n = len(program.signature.ins) if is_func else 0
+            n = len(program.signature.ins) if is_func and ip == 0 else 0
 
             while len(op.oprands[1+n:]) > 0:
                 var = op.oprands.pop()
@@ -99,6 +153,7 @@ def compile_operations(program: Program | Function) -> str:
 
         elif op.type == OpType.OpEndScope:
             c_code += "}\n"
+            c_code += switch_labels.pop(ip, "")
 
         elif op.type == OpType.OpPush:
             n = len(op.oprands)
@@ -116,7 +171,7 @@ def compile_operations(program: Program | Function) -> str:
 
             c_code += "{\n"
             if deref and type(tp) == TypedPtr:
-                c_code += f"{type_str(tp.primitive)} *tmp_cast=({type_str(tp.primitive)}*)(global_memory+{var});\n"
+                c_code += f"{type_str(tp.primitive)} *tmp_cast=({type_str(tp.primitive)}*)store_at({var},{size_of_primitive(tp.primitive)});\n"
                 c_code += f"*tmp_cast="
             else:
                 c_code += f"{var}="
@@ -126,9 +181,26 @@ def compile_operations(program: Program | Function) -> str:
             c_code += "}\n"
 
         elif op.type == OpType.OpIf:
-            c_code += "if("
-            c_code += compile_expression(value_stack, type_stack)
-            c_code += ")"
+            switch = switch_cases(ops, ip)
+
+            if switch is None:
+                c_code += "if("
+                c_code += compile_expression(value_stack, type_stack)
+                c_code += ")"
+            else:
+                var, cases = switch
+                compile_expression(value_stack, type_stack)
+
+                c_code += f"switch({var}){{\ncase {cases[0][1]}:"
+
+                for (i, _), (nxt, case) in zip(cases, cases[1:]):
+                    switch_labels[i + ops[i].oprands[-1]] = "break;\n" + \
+                        (f"case {case}:" if case is not None else "default:")
+
+                    switch_skipped.update([nxt - 1, nxt] if case is not None else [nxt])
+
+                last = cases[-1][0]
+                switch_labels[last + ops[last].oprands[-1]] = "break;\n}\n"
 
         elif op.type == OpType.OpElseIf:
             c_code += "else if("
@@ -168,6 +240,38 @@ def compile_operations(program: Program | Function) -> str:
             c_code += compile_expression(value_stack, type_stack)
             c_code += ");\n"
 
+        elif op.type == OpType.OpFill:
+            dst, count = op.oprands
+            primitive = type_str(op.types[0].primitive)
+
+            c_code += "{\n"
+            c_code += f"{primitive} bulk_value="
+            c_code += compile_expression(value_stack, type_stack)
+            c_code += ";\n"
+
+            if size_of_primitive(op.types[0].primitive) == 1:
+                c_code += f"if({count}>0) memset(global_memory+{dst},bulk_value,{count});\n"
+            else:
+                c_code += f"for(i64 bulk_i=0;bulk_i<{count};bulk_i++) (({primitive}*)(global_memory+{dst}))[bulk_i]=bulk_value;\n"
+            c_code += "}\n"
+
+        elif op.type == OpType.OpCopy:
+            dst, count = op.oprands
+            primitive = type_str(op.types[0].primitive)
+            length = f"{count}*{size_of_primitive(op.types[0].primitive)}"
+
+            c_code += "{\n"
+            c_code += "ptr bulk_source="
+            c_code += compile_expression(value_stack, type_stack)
+            c_code += ";\n"
+
+            # a destination starting inside the source has to see the elements it already stored
+            c_code += f"if({count}>0 && ({dst}<=bulk_source || {dst}>=bulk_source+{length})) "
+            c_code += f"memmove(global_memory+{dst},global_memory+bulk_source,{length});\n"
+            c_code += f"else for(i64 bulk_i=0;bulk_i<{count};bulk_i++) "
+            c_code += f"(({primitive}*)(global_memory+{dst}))[bulk_i]=(({primitive}*)(global_memory+bulk_source))[bulk_i];\n"
+            c_code += "}\n"
+
         elif op.type == OpType.OpReturn:
             c_code += "return "
             c_code += compile_expression(value_stack, type_stack)
@@ -177,10 +281,10 @@ def compile_operations(program: Program | Function) -> str:
     return c_code
 
 
-def compile_program(program: Program) -> str:
-
-    c_code = """
+c_types = """
 # include<stdio.h>
+# include<stdlib.h>
+# include<string.h>
 
 typedef int i32;
 typedef long long i64;
@@ -192,20 +296,67 @@ typedef unsigned char bool;
 typedef unsigned char byte;
 
 typedef i64 ptr;
+"""
+
+# every load and store through a pointer goes through these, code compiled for somewhere
+# else can check the addresses instead
+memory_access = """
+# define load_at(address, size) (global_memory + (address))
+# define store_at(address, size) (global_memory + (address))
+"""
+
 
-void print_i32(i32 a) {printf(\"%d\", a);}
-void print_i64(i64 a) {printf(\"%lld\", a);}
+def compile_memory_image(memory: bytes) -> str:
+    rows = [",".join([str(byte) for byte in memory[i:i + 32]])
+            for i in range(0, len(memory), 32)]
 
-void print_f32(f32 a) {printf(\"%f\", a);}
-void print_f64(f64 a) {printf(\"%lf\", a);}
+    return "{\n" + ",\n".join(rows) + "\n}"
 
-void print_bool(bool a) {printf(\"%s\", a?"true":"false");}
-void print_byte(byte a) {printf(\"%c\", a);}
 
-void print_ptr(const char * type, ptr a) {printf(\"^%s(%lld)\",type, a);}
+def compile_program(program: Program, output_buffer: int = 1 << 16, image: StaticImage | None = None) -> str:
 
+    # prints go through a static buffer that is written out with fwrite once full and at exit
+    c_code = f"""
+# define OUTPUT_BUFFER_SIZE {max(output_buffer, 1)}
 """
-    c_code += f"byte global_memory[{program.memory_capacity}];\n"
+    c_code += c_types
+    c_code += memory_access
+    c_code += """
+static char output_buffer[OUTPUT_BUFFER_SIZE];
+static size_t output_size = 0;
+
+void flush_output() {fwrite(output_buffer, 1, output_size, stdout); output_size = 0; fflush(stdout);}
+
+void write_output(const char * data, size_t size) {
+    if (output_size + size > OUTPUT_BUFFER_SIZE) flush_output();
+    if (size > OUTPUT_BUFFER_SIZE) {fwrite(data, 1, size, stdout); return;}
+    memcpy(output_buffer + output_size, data, size);
+    output_size += size;
+}
+
+char format_buffer[512];
+
+void print_i32(i32 a) {write_output(format_buffer, snprintf(format_buffer, sizeof(format_buffer), \"%d\", a));}
+void print_i64(i64 a) {write_output(format_buffer, snprintf(format_buffer, sizeof(format_buffer), \"%lld\", a));}
+
+void print_f32(f32 a) {write_output(format_buffer, snprintf(format_buffer, sizeof(format_buffer), \"%f\", a));}
+void print_f64(f64 a) {write_output(format_buffer, snprintf(format_buffer, sizeof(format_buffer), \"%lf\", a));}
+
+void print_bool(bool a) {if (a) write_output("true", 4); else write_output("false", 5);}
+void print_byte(byte a) {
+    if (output_size == OUTPUT_BUFFER_SIZE) flush_output();
+    output_buffer[output_size++] = a;
+}
+
+void print_ptr(const char * type, ptr a) {write_output(format_buffer, snprintf(format_buffer, sizeof(format_buffer), \"^%s(%lld)\", type, a));}
+
+"""
+    # whatever main did before image.resume has already been run while compiling
+    if image is not None and len(image.memory) > 0:
+        c_code += f"_Alignas(8) byte global_memory[{program.memory_capacity}]="
+        c_code += compile_memory_image(image.memory) + ";\n"
+    else:
+        c_code += f"_Alignas(8) byte global_memory[{program.memory_capacity}];\n"
 
     global_scope = program.operations[0]
     while len(global_scope.oprands[1:]) > 0:
@@ -214,11 +365,16 @@ void print_ptr(const char * type, ptr a) {printf(\"^%s(%lld)\",type, a);}
 
         c_type = husky_to_c_type(tp)
 
-        if c_type != "unkown":
-            c_code += f"{c_type} {var};\n"
-        else:
+        if c_type == "unkown":
             report_error(
                 f"type `{tp}` not defined for compilation", global_scope.file, global_scope.line)
+        elif image is not None and var in image.values:
+            value = image.values[var]
+            # c has no literal for the lowest i64, it has to be written as an expression
+            literal = f"({value + 1}-1)" if value == -2**63 else repr(value)
+            c_code += f"{c_type} {var}={literal};\n"
+        else:
+            c_code += f"{c_type} {var};\n"
 
     for i, func in enumerate(program.funcs):
         out, ins = compile_func_signature(func)
@@ -231,8 +387,9 @@ void print_ptr(const char * type, ptr a) {printf(\"^%s(%lld)\",type, a);}
 
     c_code += "int main()\n"
     c_code += "{\n"
+    c_code += "atexit(flush_output);\n"
     
-    program.operations = program.operations[1:-1]
+    program.operations = program.operations[1 if image is None else image.resume:-1]
     c_code += compile_operations(program)
     
     c_code += "return 0;\n"
@@ -0,0 +1,155 @@
+import math
+from typing import List
+
+from interpreter import apply_op_binary, convert_value, slot_format
+from ir import Variables, const_node, expression_tree, globals_written_by_functions, is_binary, \
+    is_const, node_size, resolve_variables, set_expression
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import FuncType, Primitives, TypedPtr, Types
+
+# Constant folding and propagation, literal subexpressions are evaluated at compile time the
+# same way the interpreter would and variables assigned a constant exactly once are replaced
+# by that constant wherever the assignment is known to have happened already
+
+integer_types = [Primitives.I32, Primitives.I64, Primitives.Byte, Primitives.Bool]
+
+i32_range = (-2**31, 2**31 - 1)
+i64_range = (-2**63, 2**63 - 1)
+
+
+def is_integral(tp: Types) -> bool:
+    return tp in integer_types or type(tp) == TypedPtr
+
+
+def is_foldable_type(tp: Types) -> bool:
+    # f32 values depend on where the c compiler rounds them, they are left alone
+    return is_integral(tp) or tp == Primitives.F64
+
+
+def fits_type(value: int | float, tp: Types) -> bool:
+    if type(value) == float:
+        return math.isfinite(value)
+
+    low, high = i32_range if tp == Primitives.I32 else i64_range
+
+    return low <= value <= high
+
+
+def fold_binary(node: Node, b: Node, a: Node) -> Node:
+    if not (is_foldable_type(a.type) and is_foldable_type(b.type) and is_foldable_type(node.type)):
+        return node
+
+    # int and float mixed together are converted differently by the backends
+    if is_integral(a.type) != is_integral(b.type):
+        return node
+
+    if node.opcode in [ExprOp.Div, ExprOp.Mod] and a.value == 0:
+        return node
+
+    value = apply_op_binary(node.opcode, b.value, a.value,
+                            node.type, "", 0)
+
+    if not fits_type(value, node.type):
+        return node
+
+    return const_node(value, node.type)
+
+
+# x+0, x-0, x*1 and x/1 for integers, only when x already has the type of the result
+def simplify_identity(node: Node, b: Node, a: Node) -> Node:
+    if not is_integral(node.type):
+        return node
+
+    if is_const(a) and b.type == node.type:
+        if node.opcode in [ExprOp.Add, ExprOp.Sub] and a.value == 0:
+            return b
+        if node.opcode in [ExprOp.Mul, ExprOp.Div] and a.value == 1:
+            return b
+
+    if is_const(b) and a.type == node.type:
+        if node.opcode == ExprOp.Add and b.value == 0:
+            return a
+        if node.opcode == ExprOp.Mul and b.value == 1:
+            return a
+
+    return node
+
+
+def fold_tree(node: Node) -> Node:
+    if len(node.children) == 0:
+        return node
+
+    node.children = [fold_tree(child) for child in node.children]
+
+    if is_binary(node):
+        b, a = node.children
+
+        if is_const(a) and is_const(b):
+            return fold_binary(node, b, a)
+
+        return simplify_identity(node, b, a)
+
+    a = node.children[0]
+    if node.opcode == ExprOp.Not and is_const(a) and is_foldable_type(a.type):
+        return const_node(0 if a.value else 1, node.type)
+
+    return node
+
+
+def can_propagate(tp: Types) -> bool:
+    return is_foldable_type(tp) and type(tp) != FuncType
+
+
+def substitute_constants(op: Operation, ip: int, variables: Variables, constants: dict) -> bool:
+    changed = False
+
+    for i, var in enumerate(variables.reads[ip]):
+        if var in constants:
+            op.oprands[i], op.types[i] = constants[var]
+            changed = True
+
+    return changed
+
+
+def fold_constants(program: Program, ops: List[Operation]) -> List[Operation]:
+    variables = resolve_variables(ops)
+
+    # main can call into functions that assign globals, those are never constant
+    unstable = globals_written_by_functions(program) if ops is program.operations else set()
+
+    constants: dict = {}
+
+    for ip, op in enumerate(ops):
+        if op.type == OpType.OpPush:
+            changed = substitute_constants(op, ip, variables, constants)
+
+            tree = expression_tree(op)
+            size = node_size(tree)
+            tree = fold_tree(tree)
+
+            # every fold removes nodes, untouched expressions keep their original form
+            if changed or node_size(tree) < size:
+                set_expression(op, tree)
+
+        elif op.type == OpType.OpMov and not op.oprands[-2]:
+            var = variables.targets[ip]
+            tp = variables.types.get(var, Primitives.Unknown)
+            push = ops[ip - 1]
+
+            if var[0] == -1 or var[1] in unstable or var in variables.nested_writes:
+                continue
+
+            if len(variables.writes[var]) != 1 or not can_propagate(tp):
+                continue
+
+            if push.type != OpType.OpPush or len(push.oprands) != 1 or type(push.oprands[0]) == str:
+                continue
+
+            value = push.oprands[0]
+            if not fits_type(value, tp):
+                continue
+
+            constants[var] = (convert_value(slot_format(tp), value), tp)
+
+    return ops
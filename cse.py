@@ -0,0 +1,225 @@
+import copy
+from dataclasses import dataclass, field
+from typing import List
+
+from ir import const_node, declare_temporary, declared_names, expression_tree, fresh_name, has_call, \
+    is_const, is_temporary_type, load_node, make_mov, make_push, same_tree, set_expression
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import Primitives, TypedPtr, type_str
+
+# Local common subexpression elimination, value numbering over the expressions of a basic
+# block. The first time a repeated subexpression is computed it is stored in a temporary
+# right before that expression and every later use reads the temporary instead.
+# Pointer arithmetic is reassociated first so `p+j+1+i*w` and `p+j+2+i*w` share `j+i*w`
+
+integer_types = [Primitives.I32, Primitives.I64]
+
+
+def tree_key(node: Node) -> tuple:
+    return (node.opcode, node.value, type_str(node.type), tuple([tree_key(child) for child in node.children]))
+
+
+def binary_node(opcode: ExprOp, b: Node, a: Node) -> Node:
+    return Node(opcode, "+" if opcode == ExprOp.Add else "-", b.type, [b, a])
+
+
+def split_integer(node: Node, sign: int, terms: List[tuple[int, Node]]):
+    if node.opcode in [ExprOp.Add, ExprOp.Sub] and node.type in integer_types \
+            and all([child.type in integer_types for child in node.children]):
+        b, a = node.children
+        split_integer(b, sign, terms)
+        split_integer(a, sign if node.opcode == ExprOp.Add else -sign, terms)
+    else:
+        terms.append((sign, node))
+
+
+# Returns the pointer the chain of additions starts from, the integers added to it go to terms
+def split_address(node: Node, terms: List[tuple[int, Node]]) -> Node:
+    if node.opcode in [ExprOp.Add, ExprOp.Sub] and type(node.type) == TypedPtr \
+            and type(node.children[0].type) == TypedPtr:
+        b, a = node.children
+        split_integer(a, 1 if node.opcode == ExprOp.Add else -1, terms)
+        return split_address(b, terms)
+
+    return node
+
+
+# Rewrites `ptr + terms` as `(ptr + (sorted terms)) + offset`, a constant pointer absorbs the
+# offset instead, the integer sum in the middle is what neighbouring addresses have in common
+def canonical_address(node: Node) -> Node:
+    node.children = [canonical_address(child) for child in node.children]
+
+    terms: List[tuple[int, Node]] = []
+    base = split_address(node, terms)
+    if len(terms) < 2:
+        return node
+
+    offset = sum([sign * term.value for sign, term in terms
+                  if is_const(term) and term.type in integer_types])
+    variables = sorted([(sign, term) for sign, term in terms
+                        if not (is_const(term) and term.type in integer_types)],
+                       key=lambda term: repr(tree_key(term[1])))
+
+    positive = [term for sign, term in variables if sign > 0]
+    negative = [term for sign, term in variables if sign < 0]
+    if len(positive) == 0:
+        return node
+
+    total = positive[0]
+    for term in positive[1:]:
+        total = binary_node(ExprOp.Add, total, term)
+    for term in negative:
+        total = binary_node(ExprOp.Sub, total, term)
+
+    if is_const(base):
+        return binary_node(ExprOp.Add, const_node(base.value + offset, base.type), total)
+
+    address = binary_node(ExprOp.Add, base, total)
+    if offset > 0:
+        address = binary_node(ExprOp.Add, address, const_node(offset, Primitives.I64))
+    elif offset < 0:
+        address = binary_node(ExprOp.Sub, address, const_node(-offset, Primitives.I64))
+
+    return address
+
+
+@dataclass
+class Value:
+    node: Node
+    ip: int
+    reads: set = field(default_factory=set)
+    loads: bool = False
+    temporary: str = ""
+
+
+def read_names(node: Node, names: set) -> bool:
+    loads = node.opcode == ExprOp.Deref
+    if node.opcode == ExprOp.Load:
+        names.add(node.value)
+
+    for child in node.children:
+        loads = read_names(child, names) or loads
+
+    return loads
+
+
+# Values are computed ahead of the expression using them first, anything that can fail has
+# to be evaluated unconditionally there so moving it doesn't change what happens
+def can_share(node: Node, conditional: bool) -> bool:
+    if node.opcode == ExprOp.Call:
+        return False
+    elif node.opcode == ExprOp.Deref and conditional:
+        return False
+    elif node.opcode in [ExprOp.Div, ExprOp.Mod] and conditional:
+        divisor = node.children[1]
+        if not (is_const(divisor) and divisor.value != 0):
+            return False
+
+    return all([can_share(child, conditional or (node.opcode in [ExprOp.And, ExprOp.Or] and i == 1))
+                for i, child in enumerate(node.children)])
+
+
+class ValueNumbering:
+    def __init__(self, program: Program, ops: List[Operation]):
+        self.ops = ops
+        self.names = declared_names(program)
+        self.values: dict = {}
+        self.insertions: dict = {}
+        self.changed: set = set()
+        self.scope = 0
+
+    def share(self, value: Value, node: Node, ip: int):
+        if value.temporary == "":
+            value.temporary = fresh_name(self.names, "_cse")
+            declare_temporary(self.ops[self.scope],
+                              value.temporary, value.node.type)
+
+            push = self.ops[value.ip]
+            self.insertions.setdefault(value.ip, []).extend([
+                make_push(copy.deepcopy(value.node), push.file, push.line),
+                make_mov(value.temporary, value.node.type, push.file, push.line),
+            ])
+
+            self.replace(value.node, value.temporary, value.ip)
+
+        self.replace(node, value.temporary, ip)
+
+    def replace(self, node: Node, name: str, ip: int):
+        node.opcode = ExprOp.Load
+        node.value = name
+        node.children = []
+        self.changed.add(ip)
+
+    def number(self, node: Node, ip: int, conditional: bool):
+        if len(node.children) == 0:
+            return
+
+        key = tree_key(node)
+        shareable = is_temporary_type(node.type) and can_share(node, conditional)
+
+        if shareable and key in self.values:
+            self.share(self.values[key], node, ip)
+            return
+
+        for i, child in enumerate(node.children):
+            self.number(child, ip, conditional or (
+                node.opcode in [ExprOp.And, ExprOp.Or] and i == 1))
+
+        if shareable:
+            value = Value(node, ip)
+            value.loads = read_names(node, value.reads)
+            self.values[key] = value
+
+    def kill(self, name: str | None):
+        self.values = {key: value for key, value in self.values.items()
+                       if not (value.loads if name is None else name in value.reads)}
+
+
+def eliminate_common_subexpressions(program: Program, ops: List[Operation]) -> List[Operation]:
+    numbering = ValueNumbering(program, ops)
+    trees: dict = {}
+    scopes: List[int] = []
+
+    for ip, op in enumerate(ops):
+        if op.type == OpType.OpBeginScope:
+            scopes.append(ip)
+            numbering.scope = ip
+            numbering.values = {}
+
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+            numbering.scope = scopes[-1] if len(scopes) > 0 else 0
+            numbering.values = {}
+
+        elif op.type == OpType.OpPush:
+            # a while condition is a loop head and nothing may go between an else if and
+            # the scope before it, neither has anywhere to put a temporary
+            if ops[ip + 1].type in [OpType.OpWhile, OpType.OpElseIf]:
+                numbering.values = {}
+                continue
+
+            tree = expression_tree(op)
+            canonical = canonical_address(expression_tree(op))
+            if not same_tree(tree, canonical):
+                numbering.changed.add(ip)
+
+            trees[ip] = canonical
+            numbering.number(canonical, ip, False)
+
+            if has_call(op):
+                numbering.values = {}
+
+        elif op.type == OpType.OpMov:
+            numbering.kill(None if op.oprands[-2] else op.oprands[-1])
+
+        elif op.type != OpType.OpPrint:
+            numbering.values = {}
+
+    for ip in numbering.changed:
+        set_expression(ops[ip], trees[ip])
+
+    for ip in sorted(numbering.insertions, reverse=True):
+        ops[ip:ip] = numbering.insertions[ip]
+
+    return ops
@@ -0,0 +1,191 @@
+from typing import List
+
+from ir import block_operations, bulk_operations, expression_tree, has_call, is_const, is_variable, relink_jumps, \
+    resolve_name
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import FuncCall
+
+# Dead store elimination, liveness is worked out backwards over the control flow of the
+# operations. An assignment to a variable nothing reads before it is assigned again or its
+# scope is entered again is removed together with the expression computing it, as long as
+# computing it can't fail or call anything. Variables nothing refers to anymore aren't
+# declared at all after that
+
+
+def call_reads(tp: FuncCall, scopes: List[dict], reads: set):
+    reads.add(resolve_name(scopes, tp.name))
+
+    for oprands, types in zip(tp.oprands, tp.types):
+        expression_reads(oprands, types, scopes, reads)
+
+
+def expression_reads(oprands: List, types: List, scopes: List[dict], reads: set):
+    for opr, tp in zip(oprands, types):
+        if type(tp) == FuncCall:
+            call_reads(tp, scopes, reads)
+        elif is_variable(opr, tp):
+            reads.add(resolve_name(scopes, opr))
+
+
+# Variables every operation reads and assigns, calls can read any global
+def uses_and_defs(ops: List[Operation], globals: set) -> tuple[List[set], List[set]]:
+    uses: List[set] = []
+    defs: List[set] = []
+    scopes: List[dict] = []
+
+    for ip, op in enumerate(ops):
+        reads = set()
+        writes = set()
+
+        if op.type == OpType.OpBeginScope:
+            scopes.append({name: (ip, name) for name in op.oprands[1:]})
+            # entering a scope zeroes its variables
+            writes.update(scopes[-1].values())
+
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+        elif op.type == OpType.OpPush:
+            expression_reads(op.oprands, op.types, scopes, reads)
+            if has_call(op):
+                reads.update(globals)
+
+        elif op.type == OpType.OpMov:
+            var = resolve_name(scopes, op.oprands[-1])
+            if op.oprands[-2]:
+                reads.add(var)
+            else:
+                writes.add(var)
+
+        elif op.type in bulk_operations:
+            reads.update([resolve_name(scopes, name) for name in op.oprands])
+
+        uses.append(reads)
+        defs.append(writes)
+
+    return uses, defs
+
+
+def successors(ops: List[Operation], ip: int) -> List[int]:
+    op = ops[ip]
+
+    # branches of a chain are reached either way, the jumps only ever skip forward
+    if op.type in block_operations:
+        return [ip + 1, ip + op.oprands[-1] + 1]
+    elif op.type == OpType.OpEndScope and len(op.oprands) > 0:
+        return [op.oprands[-1]]
+    elif op.type == OpType.OpReturn or ip + 1 >= len(ops):
+        return []
+
+    return [ip + 1]
+
+
+# Variables live right after every operation, exit is what is live once the body is done
+def live_out(ops: List[Operation], uses: List[set], defs: List[set], exit: set) -> List[set]:
+    live_in = [set() for _ in ops]
+    live = [set() for _ in ops]
+
+    changed = True
+    while changed:
+        changed = False
+
+        for ip in range(len(ops) - 1, -1, -1):
+            following = successors(ops, ip)
+            after = set(exit) if len(following) == 0 else set().union(*[live_in[s] for s in following])
+
+            before = uses[ip] | (after - defs[ip])
+            if before != live_in[ip] or after != live[ip]:
+                live_in[ip] = before
+                live[ip] = after
+                changed = True
+
+    return live
+
+
+def can_fail(node: Node) -> bool:
+    if node.opcode in [ExprOp.Div, ExprOp.Mod]:
+        divisor = node.children[1]
+        if not is_const(divisor) or divisor.value == 0:
+            return True
+
+    return any([can_fail(child) for child in node.children])
+
+
+def is_removable(push: Operation) -> bool:
+    return push.type == OpType.OpPush and not has_call(push) and not can_fail(expression_tree(push))
+
+
+def remove_dead_stores(ops: List[Operation], globals: set, exit: set) -> bool:
+    uses, defs = uses_and_defs(ops, globals)
+    live = live_out(ops, uses, defs, exit)
+
+    dead = []
+    for ip, op in enumerate(ops):
+        if op.type == OpType.OpMov and not op.oprands[-2] and \
+                not (defs[ip] & live[ip]) and is_removable(ops[ip - 1]):
+            dead.extend([ip - 1, ip])
+
+    for ip in dead[::-1]:
+        del ops[ip]
+
+    relink_jumps(ops)
+
+    return len(dead) > 0
+
+
+def remove_unused_declarations(ops: List[Operation], keep: set, params: int):
+    uses, defs = uses_and_defs(ops, set())
+    used = set()
+
+    for ip, op in enumerate(ops):
+        if op.type != OpType.OpBeginScope:
+            used |= uses[ip] | defs[ip]
+
+    for ip, op in enumerate(ops):
+        if op.type != OpType.OpBeginScope:
+            continue
+
+        # function parameters are filled in by the caller whether they are used or not
+        first = 1 + params if ip == 0 else 1
+        kept = [i for i in range(1, len(op.oprands))
+                if i < first or (ip, op.oprands[i]) in used or (ip, op.oprands[i]) in keep]
+
+        op.oprands = op.oprands[:1] + [op.oprands[i] for i in kept]
+        op.types = op.types[:1] + [op.types[i] for i in kept]
+
+
+# Names of globals the functions refer to
+def globals_used_by_functions(program: Program) -> set:
+    names = set()
+
+    for func in program.funcs:
+        uses, defs = uses_and_defs(func.operations, set())
+        for var in set().union(*uses, *defs):
+            if var[0] == -1:
+                names.add(var[1])
+
+    return names
+
+
+def eliminate_dead_code(program: Program, ops: List[Operation]) -> List[Operation]:
+    global_names = program.operations[0].oprands[1:]
+
+    if ops is program.operations:
+        globals = {(0, name) for name in global_names}
+        exit = set()
+        keep = {(0, name) for name in globals_used_by_functions(program)}
+        params = 0
+    else:
+        # main goes on with whatever a function leaves in the globals
+        globals = {(-1, name) for name in global_names}
+        exit = globals
+        keep = set()
+        params = len([func for func in program.funcs if func.operations is ops][0].signature.ins)
+
+    while remove_dead_stores(ops, globals, exit):
+        pass
+
+    remove_unused_declarations(ops, keep, params)
+
+    return ops
@@ -0,0 +1,141 @@
+import copy
+from typing import List
+
+from cse import tree_key
+from ir import const_node, declare_temporary, declared_names, enclosing_scope, expression_tree, fresh_name, \
+    if_chain, is_const, load_node, make_mov, make_push, relink_jumps, set_expression
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import Primitives
+
+# Decision tables, an if / else if chain whose conditions all compare the same few values
+# against constants works out once which constant each value matches and turns that into
+# an index into the table of branches, every condition then only checks the index and the
+# c backend emits the chain as a switch. The values are all read up front, even where
+# `&&` would have skipped reading some of them, so only variables are matched on, a
+# dereference can be out of bounds where the chain never read it
+
+min_branches = 3
+max_keys = 256
+
+scrutinee_types = [Primitives.Byte, Primitives.Bool, Primitives.I32, Primitives.I64]
+
+
+def conjunction(node: Node, terms: List[Node]):
+    if node.opcode == ExprOp.And:
+        for child in node.children:
+            conjunction(child, terms)
+    else:
+        terms.append(node)
+
+
+def is_scrutinee(node: Node) -> bool:
+    return node.type in scrutinee_types and node.opcode == ExprOp.Load
+
+
+# Returns scrutinee -> (scrutinee node, constant node) for `s == c && ..` or None
+def comparisons(node: Node) -> dict | None:
+    terms: List[Node] = []
+    conjunction(node, terms)
+
+    found = {}
+    for term in terms:
+        if term.opcode != ExprOp.Eq:
+            return None
+
+        b, a = term.children
+        if is_const(b):
+            b, a = a, b
+
+        if not (is_scrutinee(b) and is_const(a) and type(a.value) == int):
+            return None
+
+        key = tree_key(b)
+        if key in found:
+            return None
+
+        found[key] = (b, a)
+
+    return found
+
+
+def binary(opcode: ExprOp, token: str, tp, b: Node, a: Node) -> Node:
+    return Node(opcode, token, tp, [b, a])
+
+
+def lower_chain(ops: List[Operation], ip: int, names: set) -> bool:
+    branches = [i for i in if_chain(ops, ip) if ops[i].type != OpType.OpElse]
+    if len(branches) < min_branches:
+        return False
+
+    conditions = [comparisons(expression_tree(ops[i - 1])) for i in branches]
+    if any([condition is None for condition in conditions]):
+        return False
+
+    scrutinees = list(conditions[0].keys())
+    if any([set(condition.keys()) != set(scrutinees) for condition in conditions]):
+        return False
+
+    # scrutinee -> constants it is compared against, index + 1 is its digit in the key
+    constants: dict = {key: {} for key in scrutinees}
+    for condition in conditions:
+        for key, (_, constant) in condition.items():
+            constants[key].setdefault(constant.value, constant)
+
+    # only worth it when the chain compares the same values again and again
+    if sum([len(values) for values in constants.values()]) >= sum([len(c) for c in conditions]):
+        return False
+
+    strides = {}
+    size = 1
+    for key in scrutinees:
+        strides[key] = size
+        size *= len(constants[key]) + 1
+
+    if size > max_keys:
+        return False
+
+    index = None
+    for key in scrutinees:
+        scrutinee = conditions[0][key][0]
+
+        for digit, constant in enumerate(constants[key].values()):
+            match = binary(ExprOp.Eq, "==", Primitives.Bool,
+                           copy.deepcopy(scrutinee), copy.deepcopy(constant))
+            term = binary(ExprOp.Mul, "*", Primitives.I64,
+                          const_node((digit + 1) * strides[key], Primitives.I64), match)
+
+            index = term if index is None else binary(
+                ExprOp.Add, "+", Primitives.I64, index, term)
+
+    name = fresh_name(names, "_case")
+    declare_temporary(ops[enclosing_scope(ops, ip)], name, Primitives.I64)
+
+    for i, condition in zip(branches, conditions):
+        value = sum([(list(constants[key]).index(constant.value) + 1) * strides[key]
+                     for key, (_, constant) in condition.items()])
+
+        set_expression(ops[i - 1], binary(ExprOp.Eq, "==", Primitives.Bool,
+                                          load_node(name, Primitives.I64), const_node(value, Primitives.I64)))
+
+    push = ops[ip - 1]
+    ops[ip - 1:ip - 1] = [
+        make_push(index, push.file, push.line),
+        make_mov(name, Primitives.I64, push.file, push.line),
+    ]
+
+    return True
+
+
+def lower_decision_chains(program: Program, ops: List[Operation]) -> List[Operation]:
+    names = declared_names(program)
+
+    ip = 0
+    while ip < len(ops):
+        if ops[ip].type == OpType.OpIf and lower_chain(ops, ip, names):
+            relink_jumps(ops)
+            ip += 2
+
+        ip += 1
+
+    return ops
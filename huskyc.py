@@ -1,23 +1,154 @@
 #!/usr/bin/python3
 
 from pprint import pprint
+import re
 import subprocess
 import sys
+import tracemalloc
 
+import closures
 from compiler import compile_program
-# from interpreter import interpret_program
-
-from parser import parse_program_from_file
+import interpreter
+import jit
+import optimizer
+import profiler
+import pycompiler
+import staticinit
+import vectorize
+from inline import require_inlined
+from lowering import lower_program
+
+from parser import Program, parse_program_from_file
 from typechecker import typecheck_program
 
 
 def print_help():
     print("./huskycat [command] [..file]")
     print("   commands:")
-    # print("       - run : interprets the program")
+    print("       - run : interprets the program")
+    print("           --engine=interpreter|closure|python : execution engine to use (default interpreter, closure with --profile)")
+    print("           --no-cache : don't reuse or store compiled python code in __huskycache__")
+    print("           --alloc-stats : reports the storage the interpreter allocated up front and the peak of the run loop")
+    print("           --jit : compiles hot while loops of the interpreter to c when a c compiler is around")
+    print(f"           --jit-threshold=N : iterations before a loop counts as hot (default {jit.default_threshold})")
+    print("           --vectorize : runs element wise loops of the interpreter with numpy when it is installed")
+    print("           --profile : times every step of the closure engine, other engines are an error")
+    print("           --profile-top=N, --profile-json=PATH : rows to print (default 20), file to write the profile to")
     print("       - compile : compiles the given file to c code")
+    print("           --target=c|python : language to compile to (default c)")
+    print("           --output-buffer=N : size of the output buffer in the generated c code")
+    print(f"           --init-budget=N : steps of main to run while compiling to precompute globals, 0 disables (default {staticinit.default_budget})")
     print("       - dump : prints the intermeddiate representation")
+    print("           --dump-before=PASS,.. : prints the ir before the given passes (or all)")
+    print("           --dump-after=PASS,.. : prints the ir after the given passes (or all)")
+    print("           also lists the operations and variables the passes removed")
     print("       - help : prints this menu")
+    print("   optimization flags (run, compile, dump):")
+    print(f"       -O0|-O1|-O2 : optimization level (default -O{optimizer.default_level})")
+    print("       --no-PASS : skips the given pass, e.g. --no-inline")
+    print("       --pass-timings : reports the time spent in every pass")
+
+
+engines = {
+    "interpreter": interpreter.interpret_program,
+    "closure": closures.interpret_program,
+    "python": None,
+}
+
+
+def get_flag(name: str, default: str) -> str:
+    for arg in sys.argv[3:]:
+        if arg.startswith(f"--{name}="):
+            return arg[len(name)+3:]
+
+    return default
+
+
+def get_opt_level() -> int:
+    level = optimizer.default_level
+    for arg in sys.argv[3:]:
+        if re.fullmatch("-O[0-9]", arg):
+            level = int(arg[2:])
+
+    return min(level, optimizer.max_level)
+
+
+def get_list_flag(name: str) -> list:
+    return [item for item in get_flag(name, "").split(",") if item != ""]
+
+
+def disabled_passes() -> list:
+    return [p.name for p in optimizer.pipeline if f"--no-{p.name}" in sys.argv]
+
+
+def optimize(program: Program, report: bool = False) -> Program:
+    options = optimizer.PassOptions(get_opt_level(),
+                                    get_list_flag("dump-before"),
+                                    get_list_flag("dump-after"),
+                                    disabled_passes(),
+                                    report=report)
+    optimizer.optimize_program(program, options)
+
+    if report:
+        optimizer.print_removed(options)
+
+    if "--pass-timings" in sys.argv:
+        optimizer.print_timings(options)
+
+    return program
+
+
+def load_program(file_path: str) -> Program:
+    program = parse_program_from_file(file_path)
+    typecheck_program(program)
+    optimize(program)
+    require_inlined(program)
+    lower_program(program)
+
+    return program
+
+
+def run_program(engine: str):
+    if "--profile" in sys.argv:
+        program = load_program(sys.argv[2])
+        profile = profiler.profile_program(program)
+
+        profiler.print_profile(
+            program, profile, int(get_flag("profile-top", "20")))
+
+        json_path = get_flag("profile-json", "")
+        if json_path != "":
+            profiler.write_profile_json(program, profile, json_path)
+
+    elif engine == "python":
+        options = " ".join([f"-O{get_opt_level()}"] + disabled_passes())
+        code = pycompiler.compile_file(
+            sys.argv[2], load_program, options, "--no-cache" not in sys.argv)
+        pycompiler.run_code(code)
+    else:
+        stats = interpreter.AllocStats()
+        if "--alloc-stats" in sys.argv:
+            tracemalloc.start()
+
+        if engine == "interpreter" and ("--jit" in sys.argv or "--vectorize" in sys.argv):
+            hot_loops = None
+            if "--jit" in sys.argv:
+                hot_loops = jit.HotLoops(
+                    int(get_flag("jit-threshold", str(jit.default_threshold))))
+            if "--vectorize" in sys.argv:
+                if vectorize.np is None:
+                    print("warning: --vectorize needs numpy, loops run one element at a time", file=sys.stderr)
+                hot_loops = vectorize.VectorLoops(hot_loops)
+
+            interpreter.interpret_program(
+                load_program(sys.argv[2]), stats, hot_loops)
+        else:
+            engines[engine](load_program(sys.argv[2]), stats)
+
+        if "--alloc-stats" in sys.argv:
+            print(f"allocations: {stats.total()} (frames: {stats.frames}, memory: {stats.memory}, scopes: {stats.scopes})",
+                  file=sys.stderr)
+            print(f"run loop peak: {stats.run_peak} bytes", file=sys.stderr)
 
 
 def main() -> int:
@@ -29,15 +160,33 @@ def main() -> int:
     if sys.argv[1] == "help":
         print_help()
 
-    # elif sys.argv[1] == "run":
-    #     if len(sys.argv) < 3:
-    #         print_help()
-    #         print("Error: No file path was provided")
+    elif sys.argv[1] == "run":
+        if len(sys.argv) < 3:
+            print_help()
+            print("Error: No file path was provided")
+            return 1
+
+        # the profiler times the steps of the closure engine, so that is the default with it
+        engine = get_flag("engine", "closure" if "--profile" in sys.argv else "interpreter")
+        if engine not in engines:
+            print_help()
+            print(f"Error: unknown engine `{engine}`")
+            return 1
 
-    #     program = parse_program_from_file(sys.argv[2])
-    #     typecheck_program(program)
+        if "--profile" in sys.argv and engine != "closure":
+            print_help()
+            print(f"Error: --profile runs on the closure engine and can't be used with --engine={engine}")
+            return 1
 
-    #     interpret_program(program)
+        # the jit and the vectorizer hook into the loops of the interpreter engine
+        for flag in ["--jit", "--vectorize"]:
+            if flag in sys.argv and engine != "interpreter":
+                print_help()
+                print(f"Error: {flag} runs on the interpreter engine and can't be used with --engine={engine}")
+                return 1
+
+        with interpreter.buffered_output(int(get_flag("output-buffer", str(interpreter.default_output_buffer)))):
+            run_program(engine)
 
     elif sys.argv[1] == "dump":
         if len(sys.argv) < 3:
@@ -46,18 +195,41 @@ def main() -> int:
 
         program = parse_program_from_file(sys.argv[2])
         typecheck_program(program)
+        optimize(program, True)
 
-        pprint(program)
+        if len(get_list_flag("dump-before") + get_list_flag("dump-after")) == 0:
+            pprint(program)
 
     elif sys.argv[1] == "compile":
         if len(sys.argv) < 3:
             print_help()
             print("Error: No file path was provided")
 
+        target = get_flag("target", "c")
+
+        if target == "python":
+            output_file = f"{sys.argv[2]}.py"
+            with open(output_file, "w") as file:
+                file.write(pycompiler.compile_program(load_program(sys.argv[2])))
+
+            return 0
+
+        elif target != "c":
+            print_help()
+            print(f"Error: unknown target `{target}`")
+            return 1
+
         program = parse_program_from_file(sys.argv[2])
         typecheck_program(program)
+        optimize(program)
+
+        image = None
+        budget = int(get_flag("init-budget", str(staticinit.default_budget)))
+        if get_opt_level() > 0 and budget > 0:
+            image = staticinit.evaluate_prefix(program, budget)
 
-        c_code = compile_program(program)
+        c_code = compile_program(program, int(
+            get_flag("output-buffer", str(interpreter.default_output_buffer))), image)
 
         output_file = f"{sys.argv[2]}.c"
         with open(output_file, "w") as file:
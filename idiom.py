@@ -0,0 +1,150 @@
+import copy
+from typing import List
+
+from ir import const_node, declare_temporary, declared_names, expression_tree, fresh_name, has_call, load_node, \
+    make_mov, make_push, relink_jumps
+from licm import is_invariant
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import Primitives, size_of_primitive
+from strength import induction_step, linear_coefficient
+
+# Idiom recognition, a counted loop `while i < n` whose body only computes addresses from i
+# and stores a constant or copies an element through them with unit stride becomes one bulk
+# fill or copy. The bulk store covers every iteration but the last one, the loop is kept to
+# run that last iteration normally so all the variables it leaves behind end up as before
+
+bound_types = [Primitives.I32, Primitives.I64]
+
+
+def binary(opcode: ExprOp, b: Node, a: Node) -> Node:
+    return Node(opcode, "+" if opcode == ExprOp.Add else "-", Primitives.I64, [b, a])
+
+
+# Address tree of the pointer variable when it moves one element per iteration
+def unit_stride(addresses: dict, name: str, counter: str, variant: set) -> Node | None:
+    if name not in addresses:
+        return None
+
+    tree, tp = addresses[name]
+    if linear_coefficient(tree, counter, variant) != size_of_primitive(tp.primitive):
+        return None
+
+    return tree
+
+
+def bulk_loop(ops: List[Operation], ip: int, names: set) -> bool:
+    start = ip - 1
+    end = ip + ops[ip].oprands[-1]
+    body = ops[ip + 1]
+
+    cond = expression_tree(ops[start])
+    if cond.opcode != ExprOp.Lt or cond.children[0].opcode != ExprOp.Load:
+        return False
+
+    counter = cond.children[0].value
+    bound = cond.children[1]
+
+    # nothing but assignments in the body, the last one stepping the counter
+    pairs = ops[ip + 2:end]
+    if len(pairs) < 4 or len(pairs) % 2 != 0:
+        return False
+
+    for push, mov in zip(pairs[::2], pairs[1::2]):
+        if push.type != OpType.OpPush or mov.type != OpType.OpMov or has_call(push):
+            return False
+
+    targets = [mov.oprands[-1] for mov in pairs[1::2] if not mov.oprands[-2]]
+    if len(set(targets)) != len(targets) or counter in body.oprands[1:]:
+        return False
+
+    increment, step = pairs[-2:]
+    if step.oprands[-2] or step.oprands[-1] != counter or step.types[-1] != Primitives.I64:
+        return False
+    if induction_step(increment, counter) != 1:
+        return False
+
+    variant = set(targets) | set(body.oprands[1:])
+    if bound.type not in bound_types or not is_invariant(bound, variant, False):
+        return False
+
+    # pointer variables assigned so far -> (address tree, type)
+    addresses: dict = {}
+    store = None
+
+    for push, mov in zip(pairs[:-2:2], pairs[1:-2:2]):
+        tree = expression_tree(push)
+
+        if mov.oprands[-2]:
+            if store is not None:
+                return False
+
+            dst = unit_stride(addresses, mov.oprands[-1], counter, variant)
+            if dst is None:
+                return False
+
+            store = (mov, dst, tree)
+
+        # skipped iterations never assign these, so they must not be able to fail either
+        elif is_invariant(tree, variant - {counter}, False):
+            addresses[mov.oprands[-1]] = (tree, mov.types[-1])
+
+        else:
+            return False
+
+    if store is None:
+        return False
+
+    mov, dst, value = store
+    tp = mov.types[-1]
+
+    if value.opcode == ExprOp.Deref and value.children[0].opcode == ExprOp.Load:
+        source = value.children[0].value
+        src = unit_stride(addresses, source, counter, variant)
+
+        if src is None or addresses[source][1].primitive != tp.primitive:
+            return False
+
+        bulk_type, oprand = OpType.OpCopy, src
+
+    elif is_invariant(value, variant, False):
+        bulk_type, oprand = OpType.OpFill, value
+
+    else:
+        return False
+
+    count = fresh_name(names, "_bulk")
+    declare_temporary(body, count, Primitives.I64)
+    address = fresh_name(names, "_bulk")
+    declare_temporary(body, address, tp)
+
+    file, line = mov.file, mov.line
+    i = load_node(counter, Primitives.I64)
+    remaining = binary(ExprOp.Sub, binary(ExprOp.Sub, copy.deepcopy(bound), i),
+                       const_node(1, Primitives.I64))
+
+    ops[ip + 2:ip + 2] = [
+        make_push(remaining, file, line),
+        make_mov(count, Primitives.I64, file, line),
+        make_push(copy.deepcopy(dst), file, line),
+        make_mov(address, tp, file, line),
+        make_push(copy.deepcopy(oprand), file, line),
+        Operation(bulk_type, file, line, [address, count], [tp, Primitives.I64]),
+        make_push(binary(ExprOp.Add, i, load_node(count, Primitives.I64)), file, line),
+        make_mov(counter, Primitives.I64, file, line),
+    ]
+
+    return True
+
+
+def recognize_idioms(program: Program, ops: List[Operation]) -> List[Operation]:
+    names = declared_names(program)
+
+    ip = 0
+    while ip < len(ops):
+        if ops[ip].type == OpType.OpWhile and bulk_loop(ops, ip, names):
+            relink_jumps(ops)
+
+        ip += 1
+
+    return ops
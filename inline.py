@@ -0,0 +1,317 @@
+import copy
+from typing import List
+
+from ir import declare_temporary, declared_names, enclosing_scope, expression_tree, fresh_name, has_call, \
+    is_variable, load_node, make_mov, relink_jumps, resolve_variables, set_expression
+from lowering import ExprOp, Node
+from misc import report_error
+from parser import Function, OpType, Operation, Program
+from static_types import FuncCall, FuncType
+
+# Inlining, a call to a small function that can't end up calling itself is replaced by its
+# body. The arguments are assigned to copies of the parameters, the body runs in place of
+# the call and the value it returns is left in a variable the expression reads instead.
+# Only calls whose function is known are inlined, that is calls through a global main binds
+# to a function exactly once before it calls anything. Bodies with blocks of their own are
+# inlined whole, their ifs and whiles are relinked where they land.
+# The interpreters and the python backend can't call functions, a program they run has to
+# have every call of main inlined
+
+max_inline_size = 64  # operations in the body, blocks included, not counting its scope and return
+
+# consumers a call can be moved in front of, a condition of a while or an else if has to
+# be evaluated again every time
+inline_consumers = [OpType.OpMov, OpType.OpPrint, OpType.OpReturn, OpType.OpIf]
+
+
+def call_arguments(tp: FuncCall) -> List[tuple[List, List]]:
+    # the arguments keep their oprands in reverse
+    return [(oprands[::-1], types) for oprands, types in zip(tp.oprands, tp.types)]
+
+
+def expression_names(oprands: List, types: List, variables: set, calls: set):
+    for opr, tp in zip(oprands, types):
+        if type(tp) == FuncCall:
+            calls.add(tp.name)
+            for args, arg_types in call_arguments(tp):
+                expression_names(args, arg_types, variables, calls)
+        elif is_variable(opr, tp):
+            variables.add(opr)
+
+
+# Names of the variables every operation refers to and of the functions it calls
+def referenced_names(ops: List[Operation]) -> tuple[set, set]:
+    variables = set()
+    calls = set()
+
+    for op in ops:
+        if op.type == OpType.OpPush:
+            expression_names(op.oprands, op.types, variables, calls)
+        elif op.type == OpType.OpMov:
+            variables.add(op.oprands[-1])
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            variables.update(op.oprands)
+
+    return variables, calls
+
+
+# Globals of main bound to a function exactly once at its top level, before any call
+def function_bindings(program: Program) -> dict:
+    ops = program.operations
+    variables = resolve_variables(ops)
+
+    first_call = len(ops)
+    depths = []
+    depth = 0
+    for ip, op in enumerate(ops):
+        if has_call(op):
+            first_call = min(first_call, ip)
+
+        depth += op.type == OpType.OpBeginScope
+        depths.append(depth)
+        depth -= op.type == OpType.OpEndScope
+
+    assigned_by_functions = set()
+    for func in program.funcs:
+        for var, ips in resolve_variables(func.operations).writes.items():
+            if var[0] == -1 and len(ips) > 0:
+                assigned_by_functions.add(var[1])
+
+    values = {}
+    for (scope, name), ips in variables.writes.items():
+        if scope != 0 or type(variables.types[(scope, name)]) != FuncType or name in assigned_by_functions:
+            continue
+
+        if len(ips) != 1 or depths[ips[0]] != 1 or ips[0] > first_call:
+            continue
+
+        push = ops[ips[0] - 1]
+        if push.type == OpType.OpPush and len(push.oprands) == 1:
+            values[name] = push.oprands[0]
+
+    bindings = {}
+    for name in values:
+        value = values[name]
+        seen = {name}
+
+        while type(value) == str and value in values and value not in seen:
+            seen.add(value)
+            value = values[value]
+
+        if type(value) == int and 0 <= value < len(program.funcs):
+            bindings[name] = value
+
+    return bindings
+
+
+# Names declared anywhere in the operations
+def local_names(ops: List[Operation]) -> set:
+    names = set()
+    for op in ops:
+        if op.type == OpType.OpBeginScope:
+            names.update(op.oprands[1:])
+
+    return names
+
+
+# Functions that are small, return once at the end and never get back to themselves
+def inline_candidates(program: Program, bindings: dict) -> dict:
+    callees = {}
+    for i, func in enumerate(program.funcs):
+        names = referenced_names(func.operations)[1] - local_names(func.operations)
+        callees[i] = None if any([name not in bindings for name in names]) \
+            else set([bindings[name] for name in names])
+
+    def reachable(i: int) -> set | None:
+        found = set()
+        stack = [i]
+
+        while len(stack) > 0:
+            called = callees[stack.pop()]
+            if called is None:
+                return None
+
+            for j in called - found:
+                found.add(j)
+                stack.append(j)
+
+        return found
+
+    candidates = {}
+    for i, func in enumerate(program.funcs):
+        ops = func.operations
+        if len(ops) < 4 or ops[0].type != OpType.OpBeginScope or ops[-1].type != OpType.OpEndScope:
+            continue
+        if ops[-2].type != OpType.OpReturn or ops[-3].type != OpType.OpPush:
+            continue
+        if any([op.type == OpType.OpReturn for op in ops[:-2]]) or len(ops) - 3 > max_inline_size:
+            continue
+
+        called = reachable(i)
+        if called is not None and i not in called:
+            candidates[i] = func
+
+    return candidates
+
+
+def find_call(node: Node) -> Node | None:
+    if node.opcode == ExprOp.Call:
+        return node
+
+    # the right side of && and || doesn't always run
+    if node.opcode in [ExprOp.And, ExprOp.Or]:
+        return find_call(node.children[0])
+
+    for child in node.children:
+        found = find_call(child)
+        if found is not None:
+            return found
+
+    return None
+
+
+def replace_node(node: Node, old: Node, new: Node) -> Node:
+    if node is old:
+        return new
+
+    node.children = [replace_node(child, old, new) for child in node.children]
+    return node
+
+
+def rename_expression(oprands: List, types: List, scopes: List[dict]) -> List:
+    renamed = []
+    for opr, tp in zip(oprands, types):
+        if type(tp) == FuncCall:
+            tp.name = rename(scopes, tp.name)
+            tp.oprands = [rename_expression(args, arg_types, scopes)[::-1]
+                          for args, arg_types in call_arguments(tp)]
+            args = ",".join(["".join([str(a) for a in args]) for args, _ in call_arguments(tp)])
+            opr = f"{tp.name}[{args}]"
+        elif is_variable(opr, tp):
+            opr = rename(scopes, opr)
+
+        renamed.append(opr)
+
+    return renamed
+
+
+def rename(scopes: List[dict], name: str) -> str:
+    for scope in scopes[::-1]:
+        if name in scope:
+            return scope[name]
+
+    return name
+
+
+# Copy of the function's operations with every variable it declares renamed to a name
+# nothing else uses, along with the variables of its outer scope
+def renamed_body(func: Function, names: set) -> tuple[List[Operation], List[tuple[str, object]]]:
+    ops = copy.deepcopy(func.operations)
+    scopes: List[dict] = []
+
+    for op in ops:
+        if op.type == OpType.OpBeginScope:
+            scopes.append({name: fresh_name(names, f"_{name}") for name in op.oprands[1:]})
+            op.oprands = op.oprands[:1] + [scopes[-1][name] for name in op.oprands[1:]]
+
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+        elif op.type == OpType.OpPush:
+            op.oprands = rename_expression(op.oprands, op.types, scopes)
+
+        elif op.type == OpType.OpMov:
+            op.oprands[-1] = rename(scopes, op.oprands[-1])
+
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            op.oprands = [rename(scopes, name) for name in op.oprands]
+
+    return ops, list(zip(ops[0].oprands[1:], ops[0].types[1:]))
+
+
+# Names declared by the scopes around ip, leaving out the global scope of main
+def shadowing_names(ops: List[Operation], ip: int, is_main: bool) -> set:
+    scopes: List[int] = []
+    for i, op in enumerate(ops[:ip]):
+        if op.type == OpType.OpBeginScope:
+            scopes.append(i)
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+    return local_names([ops[i] for i in scopes[1 if is_main else 0:]])
+
+
+def inline_call(program: Program, ops: List[Operation], ip: int, candidates: dict, bindings: dict,
+                names: set) -> bool:
+    push = ops[ip]
+    if not has_call(push) or ip + 1 >= len(ops) or ops[ip + 1].type not in inline_consumers:
+        return False
+
+    tree = expression_tree(push)
+    call = find_call(tree)
+    if call is None or call.type.name not in bindings or bindings[call.type.name] not in candidates:
+        return False
+
+    func = candidates[bindings[call.type.name]]
+
+    # the globals the function refers to have to be the ones seen from the call
+    free = set().union(*referenced_names(func.operations)) - local_names(func.operations)
+    if (free | {call.type.name}) & shadowing_names(ops, ip, ops is program.operations):
+        return False
+
+    body, declared = renamed_body(func, names)
+    scope = ops[enclosing_scope(ops, ip)]
+    for name, tp in declared:
+        declare_temporary(scope, name, tp)
+
+    # parameters come first in the function's outer scope
+    inlined: List[Operation] = []
+    for (args, arg_types), (name, tp) in zip(call_arguments(call.type), declared):
+        inlined.append(Operation(OpType.OpPush, push.file,
+                       push.line, list(args), list(arg_types)))
+        inlined.append(make_mov(name, tp, push.file, push.line))
+
+    result = fresh_name(names, "_ret")
+    out = func.signature.outs[-1]
+    declare_temporary(scope, result, out)
+
+    inlined.extend(body[1:-2])
+    inlined.append(make_mov(result, out, push.file, push.line))
+
+    set_expression(push, replace_node(tree, call, load_node(result, out)))
+    ops[ip:ip] = inlined
+
+    # arrays of the function are part of global memory wherever it runs
+    program.memory_ptr = max(program.memory_ptr, func.memory_ptr)
+    program.memory_capacity = max(program.memory_capacity, func.memory_capacity)
+
+    return True
+
+
+def inline_functions(program: Program, ops: List[Operation]) -> List[Operation]:
+    bindings = function_bindings(program)
+    candidates = inline_candidates(program, bindings)
+    if len(candidates) == 0:
+        return ops
+
+    names = declared_names(program)
+
+    ip = 0
+    while ip < len(ops):
+        # the inlined body starts at ip, calls it makes itself get their turn next
+        if ops[ip].type == OpType.OpPush and inline_call(program, ops, ip, candidates, bindings, names):
+            relink_jumps(ops)
+            continue
+
+        ip += 1
+
+    return ops
+
+
+# Reports the first call of main left after inlining, for the engines that can't make calls
+def require_inlined(program: Program):
+    for op in program.operations:
+        calls = [tp.name for tp in op.types if type(tp) == FuncCall]
+        if len(calls) > 0:
+            report_error(f"only the c backend can call functions, `{calls[0]}` has to be inlined "
+                         f"(-O1 and up, not recursive, at most {max_inline_size} operations)", op.file, op.line)
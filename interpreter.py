@@ -1,294 +1,426 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
+import io
+import math
 import struct
-from typing import List
-from misc import operator_predence, operator_list, binary_operators, report_error, unary_operators
+import sys
+import tracemalloc
+from typing import Callable, Iterator, List, TextIO
+from lowering import ExprOp, Instr
+from misc import not_implemented, report_error
 from parser import OpType, Program
 from static_types import FuncType, Primitives, TypedPtr, Types, type_str, size_of_primitive
-from typechecker import apply_op_binary_on_types, apply_op_uinary_on_types
 
 
+# Every variable gets an 8 byte slot and its value sits at the start of it in native
+# byte order, the same layout a c local has, views are cast once per type
+slot_size = 8
+slot_scales = {"q": 1, "i": 2, "d": 1, "f": 2, "B": 8}
+
+
+@dataclass
+class Frame:
+    memory: bytearray
+    views: dict
+
+
+def make_frame(size: int) -> Frame:
+    memory = bytearray(size * slot_size)
+    view = memoryview(memory)
+
+    return Frame(memory, {fmt: view.cast(fmt) for fmt in slot_scales})
+
+
+# Storage allocated by a run, frames, memory and scope images are allocated up front. What
+# the run loop allocates on top of that, the values it computes and the stacks evaluating
+# them, is measured with tracemalloc when it is tracing
+@dataclass
+class AllocStats:
+    frames: int = 0
+    memory: int = 0
+    scopes: int = 0
+    run_base: int = 0  # bytes traced when the run loop started
+    run_peak: int = -1  # most bytes the run loop held at once, -1 when not traced
+
+    def total(self) -> int:
+        return self.frames + self.memory + self.scopes
+
+    def begin_run(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self.run_base = tracemalloc.get_traced_memory()[0]
+
+    def end_run(self):
+        if tracemalloc.is_tracing():
+            self.run_peak = max(0, tracemalloc.get_traced_memory()[1] - self.run_base)
+
+
+# Global memory uses the same native layout, typed views are cast once and used for every
+# aligned access, unaligned ones fall back to struct
 @dataclass
-class Var:
-    name: str
-    type: Types
-    size: int
-    value: bytes
+class Memory:
+    data: bytearray
+    views: dict
+
+
+def make_memory(capacity: int) -> Memory:
+    # padded so every typed view covers the whole memory
+    data = bytearray(capacity + -capacity % slot_size)
+    view = memoryview(data)
+
+    return Memory(data, {fmt: view.cast(fmt) for fmt in slot_scales})
+
+
+# Prints are collected in memory and handed to the real stream in large chunks,
+# while a run is buffered it stands in for sys.stdout so nothing gets reordered
+default_output_buffer = 1 << 16
+
+
+class OutputBuffer:
+    def __init__(self, size: int, stream: TextIO):
+        self.size = size
+        self.stream = stream
+        self.buffer = io.StringIO()
+
+    def write(self, text: str) -> int:
+        buffer = self.buffer
+        buffer.write(text)
+
+        if buffer.tell() >= self.size:
+            self.flush()
+
+        return len(text)
+
+    def flush(self):
+        self.stream.write(self.buffer.getvalue())
+        self.stream.flush()
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
 
+@contextmanager
+def buffered_output(size: int = default_output_buffer) -> Iterator[TextIO]:
+    stream = sys.stdout
+    if size <= 0:
+        yield stream
+        return
 
-def apply_op_binary(a: any, b: any, op: str, tps: List[Types], global_memory: bytearray, file: str, line: int) -> any:
+    output = OutputBuffer(size, stream)
+    sys.stdout = output
+
+    try:
+        yield output
+    finally:
+        # also runs when report_error exits in the middle of a run
+        output.flush()
+        sys.stdout = stream
+
+
+primitive_formats = {
+    Primitives.I64: "q",
+    Primitives.I32: "i",
+    Primitives.F64: "d",
+    Primitives.F32: "f",
+    Primitives.Byte: "B",
+    Primitives.Bool: "B",
+}
+
+
+def slot_format(tp: Types) -> str:
+    if type(tp) == Primitives:
+        return primitive_formats.get(tp, "")
+    elif type(tp) in [TypedPtr, FuncType]:
+        return "q"
+
+    return ""
+
+
+def c_int_div(b: int, a: int) -> int:
+    # c truncates towards zero while python floors
+    q = abs(b) // abs(a)
+    return q if (b < 0) == (a < 0) else -q
+
+
+def c_int_mod(b: int, a: int) -> int:
+    return b - a * c_int_div(b, a)
+
+
+def apply_op_binary(opcode: ExprOp, b: any, a: any, tp: Types, file: str, line: int) -> any:
     val = 0
-    if op == "+":
+    if opcode == ExprOp.Add:
         val = b + a
-    elif op == "-":
+    elif opcode == ExprOp.Sub:
         val = b - a
-    elif op == "/":
-        val = b / a
-    elif op == "*":
+    elif opcode == ExprOp.Mul:
         val = b * a
-    elif op == "%":
-        val = b % a
-    elif op == "||":
+    elif opcode in [ExprOp.Div, ExprOp.Mod]:
+        if a == 0:
+            report_error("division by zero", file, line)
+
+        if type(a) == int and type(b) == int:
+            val = c_int_div(b, a) if opcode == ExprOp.Div else c_int_mod(b, a)
+        elif opcode == ExprOp.Div:
+            val = b / a
+        else:
+            val = math.fmod(b, a)
+    elif opcode == ExprOp.Or:
         val = 1 if (b or a) else 0
-    elif op == "&&":
+    elif opcode == ExprOp.And:
         val = 1 if (b and a) else 0
-    elif op == "<":
+    elif opcode == ExprOp.Lt:
         val = 1 if (b < a) else 0
-    elif op == ">":
+    elif opcode == ExprOp.Gt:
         val = 1 if (b > a) else 0
-    elif op == "==":
+    elif opcode == ExprOp.Eq:
         val = 1 if (b == a) else 0
-    elif op == "==":
+    elif opcode == ExprOp.Ne:
         val = 1 if (b != a) else 0
 
-    if tps[1] in [Primitives.I64, Primitives.I64]:
-        val = int(val)
-    elif tps[1] in [Primitives.F32, Primitives.F64]:
-        val = float(val)
-    else:
-        val = int(val)
+    if tp in [Primitives.F32, Primitives.F64]:
+        return float(val)
 
-    return val
+    return int(val)
 
 
-def apply_op_uinary(a: int, op: str, tp: Types, global_memory: bytearray, file: str, line: int) -> int:
-    if op == "!":
+def apply_op_uinary(opcode: ExprOp, a: int, tp: Types, global_memory: Memory, file: str, line: int) -> int:
+    if opcode == ExprOp.Not:
         return 1 if (not a) else 0
-    elif op == "^":
-        if type(tp) != TypedPtr:
-            report_error(
-                f"cannot deref type `{type_str(a)}`", file, line)
-
-        return int.from_bytes(global_memory[a:a+size_of_primitive(tp.primitive)], "big")
+    elif opcode == ExprOp.Deref:
+        return load_memory(global_memory, a, tp)
     return 0
 
 
-def evaluate_operation(value_stack: List[int], ops_stack: List[str], tp_stack: List[Types], global_memory: bytearray, file: str, line: int):
-    op = ops_stack.pop()
+def convert_value(fmt: str, value: int | float) -> int | float:
+    # integers wrap around like the c types would
+    if fmt == "q":
+        return (int(value) + 0x8000000000000000) % 0x10000000000000000 - 0x8000000000000000
+    elif fmt == "i":
+        return (int(value) + 0x80000000) % 0x100000000 - 0x80000000
+    elif fmt == "B":
+        return int(value) & 0xFF
 
-    # Binary operators
-    if op in binary_operators:
-        a = value_stack.pop()
-        a_tp = tp_stack.pop()
+    return float(value)
 
-        b = value_stack.pop()
-        b_tp = tp_stack.pop()
 
-        value_stack.append(apply_op_binary(
-            a, b, op, [a_tp, b_tp], global_memory, file, line))
-        tp_stack.append(apply_op_binary_on_types(a_tp, b_tp, op, file, line))
+def load_memory(global_memory: Memory, address: int, tp: Types) -> int | float:
+    fmt = slot_format(tp)
+    size = size_of_primitive(tp)
 
-    # Uninary operators
-    elif op in unary_operators:
-        a = value_stack.pop()
-        a_tp = tp_stack.pop()
+    if address % size == 0:
+        return global_memory.views[fmt][address // size]
 
-        value_stack.append(apply_op_uinary(
-            a, op, a_tp, global_memory, file, line))
-        tp_stack.append(apply_op_uinary_on_types(a_tp, op, file, line))
+    return struct.unpack_from(fmt, global_memory.data, address)[0]
 
 
-def evaluate_stack(eval_stack: List[int | str], type_stack: List[Types],
-                   global_memory: bytearray, file: str, line: int) -> tuple[List[int], List[Types]]:
-    l = len(type_stack)
+def store_memory(global_memory: Memory, address: int, tp: Types, value: int | float):
+    fmt = slot_format(tp)
+    size = size_of_primitive(tp)
 
-    tp_stack = []
-    value_stack = []
-    ops_stack = []
+    if address % size == 0:
+        global_memory.views[fmt][address // size] = convert_value(fmt, value)
+    else:
+        struct.pack_into(fmt, global_memory.data, address,
+                         convert_value(fmt, value))
 
-    for i, token in enumerate(eval_stack[::-1]):
 
-        if str(token) == "(":
-            ops_stack.append(token)
+# Bulk stores of the optimizer, both leave memory exactly like storing one element at a
+# time from the front would
+def fill_memory(global_memory: Memory, address: int, count: int, tp: Types, value: int | float,
+                memory_ptr: int, file: str, line: int):
+    if count <= 0:
+        return
 
-        elif str(token) == ")":
-            while len(ops_stack) > 0 and ops_stack[-1] != "(":
-                evaluate_operation(value_stack, ops_stack, tp_stack,
-                                   global_memory, file, line)
+    fmt = slot_format(tp)
+    end = address + count * size_of_primitive(tp)
 
-            if len(ops_stack) > 0:
-                ops_stack.pop()
+    if end - 1 > memory_ptr - 1:
+        report_error(f"trying to access unallocated memory", file, line)
 
-        elif str(token) in operator_list:
-            while len(ops_stack) > 0 and operator_predence(ops_stack[-1]) >= operator_predence(token):
-                evaluate_operation(value_stack, ops_stack, tp_stack,
-                                   global_memory, file, line)
+    global_memory.data[address:end] = struct.pack(
+        fmt, convert_value(fmt, value)) * count
 
-            ops_stack.append(token)
 
-        elif type(token) == type(0) or type(token) == type(0.0):
-            value_stack.append(token)
-            tp_stack.append(type_stack[l - (i+1)])
+def copy_memory(global_memory: Memory, address: int, source: int, count: int, tp: Types,
+                memory_ptr: int, file: str, line: int):
+    if count <= 0:
+        return
 
-        else:
-            report_error(
-                f"unrecognised token `{token}` in eval stack", file, line)
+    size = size_of_primitive(tp)
+    length = count * size
+
+    if address + length - 1 > memory_ptr - 1 or source + length > len(global_memory.data):
+        report_error(f"trying to access unallocated memory", file, line)
+
+    # a destination starting inside the source reads back elements the copy already stored
+    if source < address < source + length:
+        for i in range(count):
+            store_memory(global_memory, address + i * size, tp,
+                         load_memory(global_memory, source + i * size, tp))
+    else:
+        global_memory.data[address:address + length] = global_memory.data[source:source + length]
 
-    while len(ops_stack) > 0:
-        evaluate_operation(value_stack, ops_stack, tp_stack,
-                           global_memory, file, line)
 
-    if len(value_stack) != 1 or len(tp_stack) != 1:
+def load_var(frame: Frame, slot: int, tp: Types, file: str, line: int) -> int | float:
+    fmt = slot_format(tp)
+    if fmt == "":
         report_error(
-            f"unable to evalution following stack {eval_stack}", file, line)
+            f"evaluation of type `{type_str(tp)}` not supported", file, line)
+
+    return frame.views[fmt][slot * slot_scales[fmt]]
+
+
+def store_var(frame: Frame, slot: int, tp: Types, value: int | float, file: str, line: int):
+    fmt = slot_format(tp)
+    if fmt == "":
+        report_error(
+            f"assignment for this type `{type_str(tp)}` not defined", file, line)
+
+    frame.views[fmt][slot * slot_scales[fmt]] = convert_value(fmt, value)
+
 
-    return value_stack, tp_stack
+def evaluate_postfix(code: List[Instr], frame: Frame,
+                     global_memory: Memory, file: str, line: int) -> int | float:
+    stack = []
+    pc = 0
+    end = len(code)
 
+    while pc < end:
+        instr = code[pc]
+        opcode = instr.opcode
+        pc += 1
 
-def find_var_scope(var: str, scopes: List[List[Var]]) -> tuple[int, int]:
-    for i, scope in enumerate(scopes[::-1]):
-        for j, v in enumerate(scope[::-1]):
-            if v.name == var:
-                return len(scopes) - (i + 1), len(scope) - (j+1)
+        if opcode == ExprOp.Const:
+            stack.append(instr.arg)
 
-    return -1, -1
+        elif opcode == ExprOp.Load:
+            stack.append(load_var(frame, instr.arg, instr.type, file, line))
 
+        elif opcode == ExprOp.Deref or opcode == ExprOp.Not:
+            stack.append(apply_op_uinary(
+                opcode, stack.pop(), instr.type, global_memory, file, line))
 
-def interpret_program(program: Program):
+        elif opcode == ExprOp.JumpIfFalse:
+            if stack[-1]:
+                stack.pop()
+            else:
+                stack[-1] = 0
+                pc = instr.arg
+
+        elif opcode == ExprOp.JumpIfTrue:
+            if stack[-1]:
+                stack[-1] = 1
+                pc = instr.arg
+            else:
+                stack.pop()
+
+        elif opcode == ExprOp.ToBool:
+            stack[-1] = 1 if stack[-1] else 0
+
+        elif opcode == ExprOp.Call:
+            not_implemented("function calls in the interpreter")
+
+        else:
+            a = stack.pop()
+            b = stack.pop()
+            stack.append(apply_op_binary(opcode, b, a, instr.type, file, line))
+
+    return stack.pop()
+
+
+# Every lexical scope gets a zeroed image of its part of the frame once, entering the
+# scope again just copies it over the frame in place
+def make_scope_images(program: Program, stats: AllocStats) -> List[bytes | None]:
+    images: List[bytes | None] = [None] * len(program.operations)
+
+    for ip, op in enumerate(program.operations):
+        if op.type != OpType.OpBeginScope:
+            continue
+
+        for tp in op.types[1:]:
+            if slot_format(tp) == "":
+                report_error(
+                    f"definition of type `{type_str(tp)}` not defined", op.file, op.line)
+
+        if len(op.slots) > 0:
+            images[ip] = bytes(len(op.slots) * slot_size)
+            stats.scopes += 1
 
-    type_stack: List[Types] = []
-    value_stack: List[int | str] = []
-    scopes: List[List[Var]] = []
+    return images
 
-    global_memory = bytearray(program.memory_capacity)
 
-    assert len(OpType) == 9, "Exhaustive handling of operations"
+# hot_loops gets every while loop iteration about to run, it returns true when it ran the
+# rest of the loop itself and otherwise the body runs as usual from whatever state it left,
+# see jit.HotLoops and vectorize.VectorLoops
+def interpret_program(program: Program, stats: AllocStats | None = None,
+                      hot_loops: Callable[[Program, int, Frame, Memory], bool] | None = None):
+    if stats is None:
+        stats = AllocStats()
 
+    value: int | float = 0
+    frame = make_frame(program.frame_size)
+    stats.frames += 1
+
+    global_memory = make_memory(program.memory_capacity)
+    stats.memory += 1
+
+    scope_images = make_scope_images(program, stats)
+
+    assert len(OpType) == 12, "Exhaustive handling of operations"
+
+    write = sys.stdout.write
     skip_elseif_else = False
     ip = 0
 
+    stats.begin_run()
+
     while ip < len(program.operations):
         op = program.operations[ip]
 
         if op.type == OpType.OpBeginScope:
+            image = scope_images[ip]
+
+            if image is not None:
+                start = op.slots[0] * slot_size
+                frame.memory[start:start + len(image)] = image
 
-            vars = []
-            for opi, opr in enumerate(op.oprands[1:][::-1]):
-                var = opr
-                tp = op.types[len(op.oprands) - (opi+1)]
-
-                if type(tp) == Primitives:
-                    vars.append(Var(var, tp, size_of_primitive(
-                        tp), bytearray(size_of_primitive(tp))))
-                elif type(tp) == TypedPtr:
-                    vars.append(Var(var, tp, size_of_primitive(Primitives.I64),
-                                    bytearray(size_of_primitive(Primitives.I64))))
-                
-                elif type(tp) == FuncType:
-                    vars.append(Var(var, tp, size_of_primitive(Primitives.I64),
-                                    bytearray(size_of_primitive(Primitives.I64))))
-                else:
-                    report_error(
-                        f"definition of type `{type_str(tp)}` not defined", op.file, op.line)
-
-            scopes.append(vars)
             ip += 1
 
         elif op.type == OpType.OpEndScope:
-            scopes.pop()
-
             if len(op.oprands) > 0:
                 ip = op.oprands[-1]
             else:
                 ip += 1
 
         elif op.type == OpType.OpPush:
-            value_stack = []
-            type_stack = []
-
-            for opi, opr in enumerate(op.oprands[::-1]):
-                i, j = find_var_scope(opr, scopes)
-                tp = op.types[len(op.oprands) - (opi+1)]
-
-                if i != -1:
-                    val = 0
-
-                    if tp in [Primitives.I32,
-                              Primitives.I64,
-                              Primitives.Byte,
-                              Primitives.Bool]:
-                        val = int.from_bytes(
-                            scopes[i][j].value, "big")
-
-                    elif tp == Primitives.F32:
-                        val = struct.unpack("f", bytes(scopes[i][j].value))
-
-                    elif tp == Primitives.F64:
-                        val = struct.unpack("d", bytes(scopes[i][j].value))[0]
-
-                    elif type(tp) == TypedPtr:
-                        val = int.from_bytes(
-                            scopes[i][j].value, "big")
-                    else:
-                        report_error(
-                            f"evaluation of type `{tp} not supported", op.file, op.line)
-
-                    value_stack.append(val)
-                else:
-                    value_stack.append(opr)
-
-                type_stack.append(tp)
+            value = evaluate_postfix(
+                op.code, frame, global_memory, op.file, op.line)
 
             ip += 1
 
         elif op.type == OpType.OpMov:
-            var = op.oprands[-1]
             deref = op.oprands[-2]
             tp = op.types[-1]
-
-            value_stack, type_stack = evaluate_stack(
-                value_stack, type_stack, global_memory, op.file, op.line)
-            i, j = find_var_scope(var, scopes)
-
-            type_stack.pop()
+            slot = op.slots[-1]
 
             if deref:
-                deref_index = int.from_bytes(
-                    scopes[i][j].value, "big")
+                deref_index = load_var(frame, slot, tp, op.file, op.line)
 
                 if deref_index + size_of_primitive(tp.primitive)-1 > program.memory_ptr - 1:
                         report_error(
                             f"trying to access unallocated memory", op.file, op.line)
 
-                bts = int(value_stack.pop()).to_bytes(
-                        size_of_primitive(tp.primitive), "big")
-                
-                for i, bt in enumerate(bts):
-                        global_memory[deref_index + i] = bt
-
-            elif tp in [Primitives.I32, Primitives.I64, Primitives.Byte, Primitives.Bool]:
-                scopes[i][j].value = int(value_stack.pop()).to_bytes(
-                    size_of_primitive(tp), "big")
-
-            elif tp == Primitives.F32:
-                scopes[i][j].value = bytearray(
-                    struct.pack("f", value_stack.pop()))
+                store_memory(global_memory, deref_index, tp.primitive, value)
 
-            elif tp == Primitives.F64:
-                scopes[i][j].value = bytearray(
-                    struct.pack("d", value_stack.pop()))
-
-            elif type(tp) == TypedPtr:
-                scopes[i][j].value = int(value_stack.pop()).to_bytes(
-                    size_of_primitive(Primitives.I64), "big")
-
-            elif type(tp) == FuncType:
-                scopes[i][j].value = int(value_stack.pop()).to_bytes(
-                    size_of_primitive(Primitives.I64), "big")
             else:
-                report_error(
-                    f"assignment for this type `{type_str(tp)}` not defined", op.file, op.line)
+                store_var(frame, slot, tp, value, op.file, op.line)
 
             ip += 1
 
         elif op.type == OpType.OpIf:
             tj = op.oprands[-1]
 
-            value_stack, type_stack = evaluate_stack(
-                value_stack, type_stack, global_memory, op.file, op.line)
-
-            type_stack.pop()
-
-            if value_stack.pop() < 1:
+            if value < 1:
                 skip_elseif_else = False
                 ip += tj + 1
             else:
@@ -303,12 +435,7 @@ def interpret_program(program: Program):
 
             tj = op.oprands[-1]
 
-            value_stack, type_stack = evaluate_stack(
-                value_stack, type_stack, global_memory, op.file, op.line)
-
-            type_stack.pop()
-
-            if value_stack.pop() < 1:
+            if value < 1:
                 skip_elseif_else = False
                 ip += tj + 1
             else:
@@ -326,34 +453,41 @@ def interpret_program(program: Program):
         elif op.type == OpType.OpWhile:
             tj = op.oprands[-1]
 
-            value_stack, type_stack = evaluate_stack(
-                value_stack, type_stack, global_memory, op.file, op.line)
-
-            type_stack.pop()
-
-            if value_stack.pop() < 1:
+            if value < 1:
+                ip += tj + 1
+            elif hot_loops is not None and hot_loops(program, ip, frame, global_memory):
                 ip += tj + 1
             else:
                 ip += 1
 
-        elif op.type == OpType.OpPrint:
-            tp = op.types[-1]
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            address = load_var(frame, op.slots[0], op.types[0], op.file, op.line)
+            count = load_var(frame, op.slots[1], op.types[1], op.file, op.line)
 
-            value_stack, type_stack = evaluate_stack(
-                value_stack, type_stack, global_memory, op.file, op.line)
+            if op.type == OpType.OpFill:
+                fill_memory(global_memory, address, count, op.types[0].primitive,
+                            value, program.memory_ptr, op.file, op.line)
+            else:
+                copy_memory(global_memory, address, value, count, op.types[0].primitive,
+                            program.memory_ptr, op.file, op.line)
+
+            ip += 1
 
-            type_stack.pop()
+        elif op.type == OpType.OpPrint:
+            tp = op.types[-1]
 
             if tp in [Primitives.I32, Primitives.I64, Primitives.F32, Primitives.F64]:
-                print(value_stack.pop(), end="")
+                write(str(value))
             elif tp == Primitives.Byte:
-                print(chr(value_stack.pop()), end="")
+                write(chr(value))
             elif tp == Primitives.Bool:
-                print("true" if value_stack.pop() == 1 else "false", end="")
+                write("true" if value == 1 else "false")
             elif type(tp) == TypedPtr:
-                print(f"^{type_str(tp.primitive)}({value_stack.pop()})", end="")
+                write(f"^{type_str(tp.primitive)}({value})")
             else:
                 report_error(
                     f"undefined print for this type", op.file, op.line)
 
             ip += 1
+
+    stats.end_run()
@@ -0,0 +1,320 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from lowering import ExprOp, Node, binary_opcodes, build_expression_tree, unary_opcodes
+from misc import report_error
+from parser import OpType, Operation, Program
+from static_types import FuncCall, Primitives, TypedPtr, Types, type_str
+
+# Helpers shared by the optimization passes, passes are free to insert and remove
+# operations, the pass manager relinks every jump afterwards
+
+
+block_operations = [OpType.OpIf, OpType.OpElseIf, OpType.OpElse, OpType.OpWhile]
+bulk_operations = [OpType.OpFill, OpType.OpCopy]
+
+
+def oprand_str(opr: int | str, tp: Types) -> str:
+    if type(tp) == FuncCall:
+        return str(opr)
+    elif tp == Primitives.Byte and type(opr) == int:
+        return repr(chr(opr))
+    elif type(tp) == TypedPtr and type(opr) == int:
+        return f"{type_str(tp)}({opr})"
+
+    return str(opr)
+
+
+def format_operation(ip: int, op: Operation) -> str:
+    text = f"{ip:>5}  {op.type.name:<13}"
+
+    if op.type == OpType.OpBeginScope:
+        names = [f"{name}:{type_str(tp)}" for name,
+                 tp in zip(op.oprands[1:], op.types[1:])]
+        text += f"mem={op.oprands[0]} " + " ".join(names)
+
+    elif op.type == OpType.OpPush:
+        text += " ".join([oprand_str(opr, tp)
+                         for opr, tp in zip(op.oprands, op.types)])
+
+    elif op.type == OpType.OpMov:
+        text += ("^" if op.oprands[-2] else "") + \
+            f"{op.oprands[-1]}:{type_str(op.types[-1])}"
+
+    elif op.type in block_operations:
+        text += f"+{op.oprands[-1]}"
+
+    elif op.type == OpType.OpEndScope and len(op.oprands) > 0:
+        text += f"-> {op.oprands[-1]}"
+
+    elif op.type == OpType.OpPrint:
+        text += type_str(op.types[-1])
+
+    elif op.type in bulk_operations:
+        text += f"^{op.oprands[0]}:{type_str(op.types[0])} x {op.oprands[1]}"
+
+    return text + f"  ; {op.file}:{op.line}"
+
+
+def format_operations(ops: List[Operation]) -> str:
+    return "\n".join([format_operation(ip, op) for ip, op in enumerate(ops)])
+
+
+# Recomputes every jump from the scope structure, each if, else if, else and while is
+# followed by the scope making up its body and jumps to that scope's end, the end of a
+# while body jumps back to the push evaluating the condition
+def relink_jumps(ops: List[Operation]):
+    scopes: List[int] = []
+
+    for ip, op in enumerate(ops):
+        if op.type == OpType.OpBeginScope:
+            scopes.append(ip)
+
+        elif op.type == OpType.OpEndScope:
+            if len(scopes) == 0:
+                report_error("unbalanced scope", op.file, op.line)
+
+            begin = scopes.pop()
+            owner = ops[begin - 1] if begin > 0 else None
+
+            op.oprands = []
+            if owner is not None and owner.type in block_operations:
+                owner.oprands = [ip - (begin - 1)]
+
+                if owner.type == OpType.OpWhile:
+                    op.oprands = [begin - 2]
+
+    if len(scopes) > 0:
+        op = ops[scopes[-1]]
+        report_error("unbalanced scope", op.file, op.line)
+
+
+# Indices of the if, else ifs and else making up the chain that starts with the if at ip
+def if_chain(ops: List[Operation], ip: int) -> List[int]:
+    chain = [ip]
+
+    while ops[chain[-1]].type != OpType.OpElse:
+        nxt = chain[-1] + ops[chain[-1]].oprands[-1] + 1
+
+        if nxt < len(ops) and ops[nxt].type == OpType.OpElse:
+            chain.append(nxt)
+        elif nxt + 1 < len(ops) and ops[nxt].type == OpType.OpPush and ops[nxt + 1].type == OpType.OpElseIf:
+            chain.append(nxt + 1)
+        else:
+            break
+
+    return chain
+
+
+# Expressions are rewritten as trees and turned back into infix oprands afterwards,
+# binary children are always parenthesized so the c backend reads them the same way
+operator_tokens = {opcode: token for token, opcode in (binary_opcodes | unary_opcodes).items()}
+
+
+def expression_tree(op: Operation) -> Node:
+    return build_expression_tree(op.oprands, op.types, op.file, op.line)
+
+
+def is_binary(node: Node) -> bool:
+    return len(node.children) == 2
+
+
+def is_const(node: Node) -> bool:
+    return node.opcode == ExprOp.Const
+
+
+def const_node(value: int | float, tp: Types) -> Node:
+    return Node(ExprOp.Const, value, tp, [])
+
+
+def tree_oprands(node: Node, oprands: List[int | str], types: List[Types]):
+    def child_oprands(child: Node):
+        if is_binary(child):
+            oprands.append("(")
+            types.append(Primitives.Operator)
+
+        tree_oprands(child, oprands, types)
+
+        if is_binary(child):
+            oprands.append(")")
+            types.append(Primitives.Operator)
+
+    if is_binary(node):
+        child_oprands(node.children[0])
+        oprands.append(operator_tokens[node.opcode])
+        types.append(Primitives.Operator)
+        child_oprands(node.children[1])
+
+    elif len(node.children) == 1:
+        oprands.append(operator_tokens[node.opcode])
+        types.append(Primitives.Operator)
+        child_oprands(node.children[0])
+
+    else:
+        oprands.append(node.value)
+        types.append(node.type)
+
+
+def set_expression(op: Operation, node: Node):
+    op.oprands = []
+    op.types = []
+    tree_oprands(node, op.oprands, op.types)
+
+
+def make_push(node: Node, file: str, line: int) -> Operation:
+    op = Operation(OpType.OpPush, file, line, [], [])
+    set_expression(op, node)
+
+    return op
+
+
+def make_mov(name: str, tp: Types, file: str, line: int) -> Operation:
+    return Operation(OpType.OpMov, file, line, [False, name], [tp])
+
+
+def load_node(name: str, tp: Types) -> Node:
+    return Node(ExprOp.Load, name, tp, [])
+
+
+def node_size(node: Node) -> int:
+    return 1 + sum([node_size(child) for child in node.children])
+
+
+def same_tree(a: Node, b: Node) -> bool:
+    if a.opcode != b.opcode or a.value != b.value or a.type != b.type:
+        return False
+
+    if len(a.children) != len(b.children):
+        return False
+
+    return all([same_tree(x, y) for x, y in zip(a.children, b.children)])
+
+
+def is_store(op: Operation) -> bool:
+    return (op.type == OpType.OpMov and op.oprands[-2]) or op.type in bulk_operations
+
+
+def has_call(op: Operation) -> bool:
+    return any([type(tp) == FuncCall for tp in op.types])
+
+
+def is_variable(opr: int | str, tp: Types) -> bool:
+    return type(opr) == str and tp != Primitives.Operator and type(tp) != FuncCall
+
+
+# Compiler generated temporaries are declared in an existing scope under a name no
+# scope of the program uses yet
+def declared_names(program: Program) -> set:
+    names = set()
+    for ops in [program.operations] + [func.operations for func in program.funcs]:
+        for op in ops:
+            if op.type == OpType.OpBeginScope:
+                names.update(op.oprands[1:])
+
+    return names
+
+
+def fresh_name(names: set, prefix: str) -> str:
+    n = 0
+    while f"{prefix}{n}" in names:
+        n += 1
+
+    names.add(f"{prefix}{n}")
+    return f"{prefix}{n}"
+
+
+def enclosing_scope(ops: List[Operation], ip: int) -> int:
+    scopes: List[int] = []
+    for i, op in enumerate(ops[:ip]):
+        if op.type == OpType.OpBeginScope:
+            scopes.append(i)
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+    return scopes[-1]
+
+
+# the interpreters keep intermediate values unbounded and unrounded, temporaries of these
+# types would round or wrap them early
+def is_temporary_type(tp: Types) -> bool:
+    return tp in [Primitives.I64, Primitives.F64, Primitives.Bool] or type(tp) == TypedPtr
+
+
+def declare_temporary(scope: Operation, name: str, tp: Types):
+    scope.oprands.append(name)
+    scope.types.append(tp)
+
+
+# Variables are identified by the scope declaring them and their name, names a function
+# body doesn't declare itself belong to the global scope and use -1 as their scope
+VarId = tuple[int, str]
+
+
+@dataclass
+class Variables:
+    # OpPush index -> variable read by every oprand (None for non variables)
+    reads: dict = field(default_factory=dict)
+    # variable -> indices of the OpMov assigning it
+    writes: dict = field(default_factory=dict)
+    # OpMov index -> variable it assigns or stores through
+    targets: dict = field(default_factory=dict)
+    # variables assigned outside of the top level of their own scope
+    nested_writes: set = field(default_factory=set)
+    # variable -> declared type
+    types: dict = field(default_factory=dict)
+
+
+def resolve_name(scopes: List[dict], name: str) -> VarId:
+    for scope in scopes[::-1]:
+        if name in scope:
+            return scope[name]
+
+    return (-1, name)
+
+
+def resolve_variables(ops: List[Operation]) -> Variables:
+    variables = Variables()
+    scopes: List[dict] = []
+
+    for ip, op in enumerate(ops):
+        if op.type == OpType.OpBeginScope:
+            scope = {}
+            for name, tp in zip(op.oprands[1:], op.types[1:]):
+                scope[name] = (ip, name)
+                variables.types[(ip, name)] = tp
+                variables.writes[(ip, name)] = []
+
+            scopes.append(scope)
+
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+        elif op.type == OpType.OpPush:
+            variables.reads[ip] = [resolve_name(scopes, opr) if is_variable(opr, tp) else None
+                                   for opr, tp in zip(op.oprands, op.types)]
+
+        elif op.type == OpType.OpMov:
+            var = resolve_name(scopes, op.oprands[-1])
+            variables.targets[ip] = var
+
+            if not op.oprands[-2]:
+                variables.writes.setdefault(var, []).append(ip)
+
+                if len(scopes) == 0 or var not in scopes[-1].values():
+                    variables.nested_writes.add(var)
+
+    return variables
+
+
+# Names of globals some function assigns, main can't assume anything about them once a
+# function has been called
+def globals_written_by_functions(program: Program) -> set:
+    names = set()
+
+    for func in program.funcs:
+        variables = resolve_variables(func.operations)
+        for var, ips in variables.writes.items():
+            if var[0] == -1 and len(ips) > 0:
+                names.add(var[1])
+
+    return names
@@ -0,0 +1,176 @@
+import copy
+import ctypes
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import Callable, List
+
+from compiler import c_types, compile_operations, husky_to_c_type
+from deadcode import can_fail
+from inline import referenced_names
+from interpreter import Frame, Memory, slot_size
+from ir import expression_tree, has_call, relink_jumps
+from lowering import visible_variables
+from misc import report_error
+from parser import OpType, Operation, Program
+
+# Tiered interpretation, the interpreter counts the iterations of every while loop and once
+# a loop gets hot it is compiled to c with the c backend and loaded as a shared library.
+# The native loop works on the interpreter's own frame and global memory, variables from
+# outside the loop are read and written in their frame slots, so the interpreter picks up
+# right after the loop. Loops that print, call, bulk store or divide by a variable stay
+# interpreted, and so does everything when there is no c compiler.
+# Native loops compute like the compiled c program does, which can differ from the
+# interpreter where a value overflows its type in the middle of an expression
+
+default_threshold = 1000
+
+# names the generated code uses itself
+reserved_names = ["frame", "global_memory", "fault", "husky_loop", "tmp_cast"]
+
+# the checks the interpreter does on stores and gets for free on loads, a native loop
+# stops at the first address out of range and the interpreter reports it
+checked_access = """
+# include<setjmp.h>
+
+static jmp_buf fault;
+
+# define checked(address, size, limit) \\
+    ((unsigned long long)(address) > (unsigned long long)(limit) - (size) ? (longjmp(fault, 1), (i64)0) : (address))
+# define load_at(address, size) (global_memory + checked(address, size, MEMORY_SIZE))
+# define store_at(address, size) (global_memory + checked(address, size, MEMORY_PTR))
+"""
+
+NativeLoop = Callable[[ctypes.Array, ctypes.Array], int]
+
+
+def is_native(op: Operation) -> bool:
+    if op.type in [OpType.OpPrint, OpType.OpReturn, OpType.OpFill, OpType.OpCopy] or has_call(op):
+        return False
+
+    return op.type != OpType.OpPush or not can_fail(expression_tree(op))
+
+
+# C source of the while loop at ip or None when it has to stay interpreted
+def loop_source(program: Program, ip: int, memory_size: int) -> str | None:
+    start = ip - 1
+    end = ip + program.operations[ip].oprands[-1]
+
+    ops = copy.deepcopy(program.operations[start:end + 1])
+    if not all([is_native(op) for op in ops]):
+        return None
+
+    outer = visible_variables(program.operations, start)
+    inner = set()
+    for op in ops:
+        if op.type == OpType.OpBeginScope:
+            inner.update(op.oprands[1:])
+
+    used = set().union(*referenced_names(ops))
+    if (used | inner) & set(reserved_names) or inner & set(outer):
+        return None
+
+    source = c_types + checked_access
+    source += f"# define MEMORY_PTR {program.memory_ptr}\n"
+    source += f"# define MEMORY_SIZE {memory_size}\n"
+
+    for name in sorted(used - inner):
+        if name not in outer:
+            return None
+
+        slot, tp = outer[name]
+        source += f"# define {name} (*({husky_to_c_type(tp)}*)(frame + {slot * slot_size}))\n"
+
+    relink_jumps(ops)
+    body = Program(program.memory_ptr, program.memory_capacity, [], ops)
+
+    source += "int husky_loop(byte *global_memory, byte *frame)\n{\n"
+    source += "if (setjmp(fault)) return 1;\n"
+    source += compile_operations(body)
+    source += "return 0;\n}\n"
+
+    return source
+
+
+def cache_directory(program: Program) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(program.operations[0].file)), "__huskycache__")
+
+
+# Builds the source into a shared library named after its hash, unless an earlier run
+# already did
+def build_loop(source: str, directory: str) -> NativeLoop | None:
+    path = os.path.join(directory, f"loop-{hashlib.sha256(source.encode()).hexdigest()[:24]}.so")
+
+    if not os.path.exists(path):
+        cc = shutil.which("cc")
+        if cc is None:
+            return None
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            with tempfile.TemporaryDirectory() as build:
+                c_file = os.path.join(build, "loop.c")
+                with open(c_file, "w") as file:
+                    file.write(source)
+
+                library = os.path.join(build, "loop.so")
+                result = subprocess.run([cc, "-O2", "-shared", "-fPIC", "-o", library, c_file],
+                                        capture_output=True)
+                if result.returncode != 0:
+                    return None
+
+                os.replace(library, path)
+
+        except OSError:
+            return None
+
+    try:
+        function = ctypes.CDLL(path).husky_loop
+    except (OSError, AttributeError):
+        return None
+
+    function.restype = ctypes.c_int
+    return function
+
+
+class HotLoops:
+    def __init__(self, threshold: int = default_threshold):
+        self.threshold = threshold
+        self.iterations: dict = {}
+        self.loops: dict = {}  # while index -> native loop or None once it can't be
+        self.buffers: dict = {}
+
+    def buffer(self, data: bytearray) -> ctypes.Array:
+        if id(data) not in self.buffers:
+            self.buffers[id(data)] = (ctypes.c_char * len(data)).from_buffer(data)
+
+        return self.buffers[id(data)]
+
+    # Called on every iteration of a while loop with the condition holding, returns true
+    # when the rest of the loop has run natively
+    def __call__(self, program: Program, ip: int, frame: Frame, global_memory: Memory) -> bool:
+        loop = self.loops.get(ip, False)
+
+        if loop is False:
+            count = self.iterations.get(ip, 0) + 1
+            self.iterations[ip] = count
+
+            if count < self.threshold:
+                return False
+
+            source = loop_source(program, ip, len(global_memory.data))
+            loop = None if source is None else build_loop(source, cache_directory(program))
+            self.loops[ip] = loop
+
+        if loop is None:
+            return False
+
+        # the native loop starts over with the condition, evaluating it again changes nothing
+        if loop(self.buffer(global_memory.data), self.buffer(frame.memory)) != 0:
+            op = program.operations[ip]
+            report_error("trying to access unallocated memory", op.file, op.line)
+
+        return True
@@ -1,127 +1,122 @@
-
 from dataclasses import dataclass
-from pprint import pprint
 import re
-from typing import List, Tuple
+from typing import Iterator
 
 from misc import report_error
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     word: str
     file: str
     line: int
 
 
-def lex_source(file_path) -> List[Token]:
-    tokens: List[Token] = []
-
+# Every statement is one line, a single alternation tells which kind of statement a line
+# is and picks its parts out in the same match. Keywords come first so a condition
+# comparing with `==` isn't taken for an assignment
+line_pattern = re.compile("|".join([
+    r"(?P<if>if (?P<if_cond>.*){)",
+    r"(?P<elseif>else\s*if (?P<elseif_cond>.*){)",
+    r"(?P<else>else\s*{)",
+    r"(?P<while>while (?P<while_cond>.*){)",
+    r"(?P<end>})",
+    r"(?P<ret>->(?P<ret_value>.*))",
+    r"(?P<print>print (?P<print_value>.+))",
+    r"(?P<decl>(?P<decl_name>[a-zA-Z0-9_]+)\s*:(?P<decl_type>\^?[a-zA-Z0-9]+))",
+    r"(?P<func>(?P<func_name>\^?[a-zA-Z0-9_]+)\s*(?P<func_colon>:(?P<func_type>\^?[a-zA-Z0-9]+)?)?\s*="
+    r"\s*func\s*\((?P<func_ins>[a-zA-Z0-9,:\s]*)\)\s*(?:->)?\s*\(?(?P<func_outs>[a-zA-Z0-9,\s]*)\)?\s*{)",
+    r"(?P<assign>(?P<assign_name>\^?[a-zA-Z0-9_]+)\s*(?P<assign_colon>:(?P<assign_type>\^?[a-zA-Z0-9]+)?)?\s*="
+    r"(?P<assign_value>.*))",
+]))
+
+# an `=` that isn't part of `==` or `!=`
+lone_equals = re.compile(r"(?<![=!])=(?!=)")
+
+
+def lex_line(line: str, file_path: str, line_num: int) -> Iterator[Token]:
+    match = line_pattern.fullmatch(line)
+    kind = None if match is None else match.lastgroup
+
+    if kind == "if" or kind == "while":
+        yield Token(kind, file_path, line_num)
+        yield Token(match.group(kind + "_cond").strip(), file_path, line_num)
+        yield Token("{", file_path, line_num)
+
+    elif kind == "elseif":
+        yield Token("else", file_path, line_num)
+        yield Token("if", file_path, line_num)
+        yield Token(match.group("elseif_cond").strip(), file_path, line_num)
+        yield Token("{", file_path, line_num)
+
+    elif kind == "else":
+        yield Token("else", file_path, line_num)
+        yield Token("{", file_path, line_num)
+
+    elif kind == "end":
+        yield Token("}", file_path, line_num)
+
+    elif kind == "ret" or kind == "print":
+        yield Token("->" if kind == "ret" else "print", file_path, line_num)
+        yield Token(match.group(kind + "_value").strip(), file_path, line_num)
+
+    elif kind == "decl":
+        yield Token(match.group("decl_name"), file_path, line_num)
+        yield Token(":", file_path, line_num)
+        yield Token(match.group("decl_type"), file_path, line_num)
+
+    elif kind == "func" or kind == "assign":
+        if kind == "assign" and lone_equals.search(match.group("assign_value")):
+            report_error(
+                f"asssignment must be of form var=expression", file_path, line_num)
+
+        yield Token(match.group(kind + "_name"), file_path, line_num)
+
+        if match.group(kind + "_colon") is not None:
+            yield Token(":", file_path, line_num)
+            if match.group(kind + "_type") is not None:
+                yield Token(match.group(kind + "_type"), file_path, line_num)
+
+        yield Token("=", file_path, line_num)
+
+        if kind == "func":
+            yield Token("func", file_path, line_num)
+            yield Token(match.group("func_ins").strip(), file_path, line_num)
+            yield Token(match.group("func_outs").strip(), file_path, line_num)
+            yield Token("{", file_path, line_num)
+        else:
+            yield Token(match.group("assign_value").strip(), file_path, line_num)
+
+    else:
+        report_error(f"unexpected token `{line}`", file_path, line_num)
+
+
+# Tokens of the source as the lines are read, the file is never held in memory as a whole
+def lex_source(file_path) -> Iterator[Token]:
     with open(file_path) as file:
-        lines = re.split("[\n]", file.read())
+        for line_num, line in enumerate(file, 1):
+            comment = line.find("//")
+            line = (line if comment < 0 else line[:comment]).strip()
 
-        for line_num, line in enumerate(lines):
+            # Skip empty lines
+            if line != "":
+                yield from lex_line(line, file_path, line_num)
 
-            line = line.split("//")[0].strip()
-            line_num = line_num + 1
 
-            # Skip empty lines
-            if line == "":
-                continue
-
-            #  Matching Declaration
-            elif re.fullmatch("[a-zA-Z0-9_]+\s*:\^?[a-zA-Z0-9]+", line):
-                lside_tks = re.split(":", line)
-                tokens.append(Token(lside_tks[0].strip(), file_path, line_num))
-
-                if len(lside_tks) == 2:
-                    tokens.append(
-                        Token(":", file_path, line_num))
-                    tokens.append(
-                        Token(lside_tks[1].strip(), file_path, line_num))
-
-            #  Matching Assignments
-            elif re.fullmatch("\^?[a-zA-Z0-9_]+\s*:?(\^?[a-zA-Z0-9]+)?\s*=.*", line):
-                tks = re.split("=", line)
-
-                if len(tks) != 2:
-                    report_error(
-                        f"asssignment must be of form var=expression", file_path, line_num)
-
-                lside = tks[0].strip()
-                rside = tks[1].strip()
-
-                lside_tks = re.split(":", lside)
-                tokens.append(Token(lside_tks[0].strip(), file_path, line_num))
-
-                if len(lside_tks) == 2:
-                    tokens.append(
-                        Token(":", file_path, line_num))
-                    if lside_tks[1].strip() != "":
-                        tokens.append(
-                            Token(lside_tks[1].strip(), file_path, line_num))
-
-                tokens.append(Token("=", file_path, line_num))
-
-                # Matching functions
-                if re.fullmatch("func\s*\(([a-zA-Z0-9,:\s]*)\)\s*(?:->)?\s*\(?([a-zA-Z0-9,\s]*)\)?\s*{", rside):
-                    tks = re.findall("func\s*\(([a-zA-Z0-9,:\s]*)\)\s*(?:->)?\s*\(?([a-zA-Z0-9,\s]*)\)?\s*{", line).pop()
-
-                    tokens.append(Token("func", file_path, line_num))
-                    tokens += [Token(tk.strip(), file_path, line_num) for tk in tks]
-                    tokens.append(Token("{", file_path, line_num))
-                else:
-                    tokens.append(Token(rside, file_path, line_num))
-
-            # Matching if keyword
-            elif re.fullmatch("if .*{", line):
-                tks = re.findall("if (.*){", line)
-                tokens.append(Token("if", file_path, line_num))
-                tokens.append(Token(tks.pop().strip(), file_path, line_num))
-                tokens.append(Token("{", file_path, line_num))
-
-            # Matching elif keyword
-            elif re.fullmatch("else\s*if .*{", line):
-                tks = re.findall("else[ ]*if (.*){", line)
-                tokens.append(Token("else", file_path, line_num))
-                tokens.append(Token("if", file_path, line_num))
-                tokens.append(Token(tks.pop().strip(), file_path, line_num))
-                tokens.append(Token("{", file_path, line_num))
-
-            # Matching else keyword
-            elif re.fullmatch("else\s*{", line):
-                tokens.append(Token("else", file_path, line_num))
-                tokens.append(Token("{", file_path, line_num))
-
-            # Matching while keyword
-            elif re.fullmatch("while .*{", line):
-                tks = re.findall("while (.*){", line)
-                tokens.append(Token("while", file_path, line_num))
-                tokens.append(Token(tks.pop().strip(), file_path, line_num))
-                tokens.append(Token("{", file_path, line_num))
-
-            # Matching end of blocks
-            elif re.fullmatch("}", line):
-                tokens.append(Token("}", file_path, line_num))
-
-            # elif re.fullmatch("[a-zA-Z][a-zA-Z0-9_]*[ ]*::")
-
-            # Match return statement
-            elif re.fullmatch("->.*", line):
-                tks = re.findall("->(.*)", line)
-
-                tokens.append(Token("->", file_path, line_num))
-                tokens.append(Token(tks.pop().strip(), file_path, line_num))
-
-            # Matching print intrinsic
-            elif re.fullmatch("print .+", line):
-                tks = re.findall("print (.+)", line)
-                tokens.append(Token("print", file_path, line_num))
-                tokens.append(Token(tks.pop().strip(), file_path, line_num))
-
-            # Other
-            else:
-                report_error(f"unexpected token `{line}`", file_path, line_num)
-
-    # pprint([token.word for token in tokens])
-    return tokens
+class TokenStream:
+    # the parser looks one token ahead
+    def __init__(self, tokens: Iterator[Token]):
+        self.tokens = tokens
+        self.next: Token | None = next(tokens, None)
+        self.line = 1  # line of the last token taken
+
+    def peek(self) -> Token | None:
+        return self.next
+
+    def consume(self) -> Token | None:
+        token = self.next
+        if token is not None:
+            self.line = token.line
+            self.next = next(self.tokens, None)
+
+        return token
@@ -0,0 +1,138 @@
+from typing import List
+
+from ir import declare_temporary, declared_names, enclosing_scope, expression_tree, fresh_name, has_call, \
+    is_const, is_store, is_temporary_type, load_node, make_push, make_mov, node_size, relink_jumps, same_tree, set_expression
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+
+# Loop invariant code motion, subexpressions of a while loop that only read variables the
+# loop never assigns are computed once into a temporary declared next to the loop.
+# Hoisted code runs even when the loop body wouldn't, so only operations that can't fail
+# are moved and loads through `^` only leave loops that never store through a pointer
+
+pure_opcodes = [ExprOp.Add, ExprOp.Sub, ExprOp.Mul, ExprOp.Lt, ExprOp.Gt,
+                ExprOp.Eq, ExprOp.Ne, ExprOp.And, ExprOp.Or, ExprOp.Not]
+
+
+def is_invariant(node: Node, variant: set, allow_loads: bool) -> bool:
+    if node.opcode == ExprOp.Const:
+        return True
+    elif node.opcode == ExprOp.Load:
+        return node.value not in variant
+    elif node.opcode == ExprOp.Deref:
+        return allow_loads and is_invariant(node.children[0], variant, allow_loads)
+    elif node.opcode in [ExprOp.Div, ExprOp.Mod]:
+        divisor = node.children[1]
+        if not (is_const(divisor) and divisor.value != 0):
+            return False
+    elif node.opcode not in pure_opcodes:
+        return False
+
+    return all([is_invariant(child, variant, allow_loads and conditional_loads(node, i))
+                for i, child in enumerate(node.children)])
+
+
+# the right hand side of && and || doesn't always run, loads can't be moved out of it
+def conditional_loads(node: Node, child: int) -> bool:
+    return child == 0 or node.opcode not in [ExprOp.And, ExprOp.Or]
+
+
+def find_invariants(node: Node, variant: set, allow_loads: bool, found: List[Node]):
+    if len(node.children) == 0:
+        return
+
+    if is_temporary_type(node.type) and is_invariant(node, variant, allow_loads):
+        if not any([same_tree(node, other) for other in found]):
+            found.append(node)
+        return
+
+    for i, child in enumerate(node.children):
+        find_invariants(child, variant, allow_loads and conditional_loads(node, i), found)
+
+
+def replace_subtrees(node: Node, replacements: List[tuple[Node, Node]]) -> Node:
+    for tree, replacement in replacements:
+        if same_tree(node, tree):
+            return replacement
+
+    node.children = [replace_subtrees(child, replacements)
+                     for child in node.children]
+    return node
+
+
+# Returns the number of operations inserted in front of the loop
+def hoist_loop(ops: List[Operation], ip: int, names: set) -> int:
+    start = ip - 1
+    end = ip + ops[ip].oprands[-1]
+
+    variant = set()
+    stores = False
+
+    for op in ops[start:end + 1]:
+        if has_call(op):
+            return 0
+
+        if op.type == OpType.OpBeginScope:
+            variant.update(op.oprands[1:])
+        elif is_store(op):
+            stores = True
+        elif op.type == OpType.OpMov:
+            variant.add(op.oprands[-1])
+
+    # the condition always runs at least once, so loading there ahead of the loop is fine
+    found: List[Node] = []
+    find_invariants(expression_tree(ops[start]), variant, not stores, found)
+
+    for op in ops[ip:end]:
+        if op.type == OpType.OpPush:
+            find_invariants(expression_tree(op), variant, False, found)
+
+    if len(found) == 0:
+        return 0
+
+    scope = ops[enclosing_scope(ops, start)]
+    hoisted: List[Operation] = []
+    replacements: List[tuple[Node, Node]] = []
+
+    for tree in found:
+        name = fresh_name(names, "_licm")
+        declare_temporary(scope, name, tree.type)
+
+        hoisted.append(make_push(tree, ops[start].file, ops[start].line))
+        hoisted.append(make_mov(name, tree.type, ops[start].file, ops[start].line))
+
+        replacements.append((tree, load_node(name, tree.type)))
+
+    for op in ops[start:end]:
+        if op.type == OpType.OpPush:
+            tree = expression_tree(op)
+            size = node_size(tree)
+            tree = replace_subtrees(tree, replacements)
+
+            if node_size(tree) < size:
+                set_expression(op, tree)
+
+    ops[start:start] = hoisted
+    return len(hoisted)
+
+
+def hoist_invariants(program: Program, ops: List[Operation]) -> List[Operation]:
+    names = declared_names(program)
+    done = set()
+
+    # outer loops come first so invariants of several nested loops move all the way out
+    ip = 0
+    while ip < len(ops):
+        op = ops[ip]
+
+        if op.type == OpType.OpWhile and id(op) not in done:
+            done.add(id(op))
+
+            inserted = hoist_loop(ops, ip, names)
+            if inserted > 0:
+                relink_jumps(ops)
+                ip += inserted
+
+        ip += 1
+
+    return ops
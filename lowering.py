@@ -0,0 +1,239 @@
+from dataclasses import dataclass
+from enum import IntEnum, auto
+from typing import List
+
+from misc import operator_predence, report_error, unary_operators
+from parser import OpType, Operation, Program
+from static_types import FuncCall, Primitives, Types
+from typechecker import apply_op_binary_on_types, apply_op_uinary_on_types
+
+
+class ExprOp(IntEnum):
+
+    # Pushes a literal value
+    Const = auto()
+
+    # Pushes the value of a variable
+    Load = auto()
+
+    # Calls a function, only supported by the c backend atm
+    Call = auto()
+
+    # Uninary operators
+    Not = auto()
+    Deref = auto()
+
+    # Binary operators
+    Add = auto()
+    Sub = auto()
+    Mul = auto()
+    Div = auto()
+    Mod = auto()
+    Lt = auto()
+    Gt = auto()
+    Eq = auto()
+    Ne = auto()
+    And = auto()
+    Or = auto()
+
+    # Short circuiting, && and || are emitted as
+    #   left JumpIfFalse/JumpIfTrue(end) right ToBool end:
+    # the jump leaves left normalised to 0/1 on the stack when it decides the result
+    JumpIfFalse = auto()
+    JumpIfTrue = auto()
+    ToBool = auto()
+
+
+binary_opcodes = {
+    "+": ExprOp.Add,
+    "-": ExprOp.Sub,
+    "*": ExprOp.Mul,
+    "/": ExprOp.Div,
+    "%": ExprOp.Mod,
+    "<": ExprOp.Lt,
+    ">": ExprOp.Gt,
+    "==": ExprOp.Eq,
+    "!=": ExprOp.Ne,
+    "&&": ExprOp.And,
+    "||": ExprOp.Or,
+}
+
+unary_opcodes = {
+    "!": ExprOp.Not,
+    "^": ExprOp.Deref,
+}
+
+
+# Single instruction of a postfix program, type is the type of the value it leaves on the stack
+@dataclass(slots=True)
+class Instr:
+    opcode: ExprOp
+    arg: int | float | str
+    type: Types
+
+
+@dataclass(slots=True)
+class Node:
+    opcode: ExprOp
+    value: int | float | str
+    type: Types
+    children: List["Node"]
+
+
+def reduce_operator(nodes: List[Node], ops_stack: List[str], file: str, line: int):
+    op = ops_stack.pop()
+
+    if op in unary_operators:
+        if len(nodes) < 1:
+            report_error(f"missing oprand for `{op}`", file, line)
+
+        a = nodes.pop()
+        nodes.append(Node(unary_opcodes[op], op,
+                          apply_op_uinary_on_types(a.type, op, file, line), [a]))
+    else:
+        if len(nodes) < 2:
+            report_error(f"missing oprand for `{op}`", file, line)
+
+        a = nodes.pop()
+        b = nodes.pop()
+        nodes.append(Node(binary_opcodes[op], op,
+                          apply_op_binary_on_types(a.type, b.type, op, file, line), [b, a]))
+
+
+# Runs shunting-yard over the infix oprands of an OpPush and returns the expression tree
+def build_expression_tree(oprands: List[int | str], types: List[Types], file: str, line: int) -> Node:
+    nodes: List[Node] = []
+    ops_stack: List[str] = []
+
+    for opr, tp in zip(oprands, types):
+        if tp == Primitives.Operator:
+            if opr == "(":
+                ops_stack.append(opr)
+
+            elif opr == ")":
+                while len(ops_stack) > 0 and ops_stack[-1] != "(":
+                    reduce_operator(nodes, ops_stack, file, line)
+
+                if len(ops_stack) > 0:
+                    ops_stack.pop()
+
+            # uninary operators are prefix so they only get reduced by what follows them
+            elif opr in unary_operators:
+                ops_stack.append(opr)
+
+            else:
+                while len(ops_stack) > 0 and operator_predence(ops_stack[-1]) >= operator_predence(opr):
+                    reduce_operator(nodes, ops_stack, file, line)
+
+                ops_stack.append(opr)
+
+        elif type(tp) == FuncCall:
+            nodes.append(Node(ExprOp.Call, opr, tp, []))
+
+        elif type(opr) == str:
+            nodes.append(Node(ExprOp.Load, opr, tp, []))
+
+        else:
+            nodes.append(Node(ExprOp.Const, opr, tp, []))
+
+    while len(ops_stack) > 0:
+        reduce_operator(nodes, ops_stack, file, line)
+
+    if len(nodes) != 1:
+        report_error(
+            f"unable to lower following expression {oprands}", file, line)
+
+    return nodes.pop()
+
+
+def emit_postfix(node: Node, code: List[Instr]):
+    if node.opcode in [ExprOp.And, ExprOp.Or]:
+        emit_postfix(node.children[0], code)
+
+        jump = Instr(ExprOp.JumpIfFalse if node.opcode == ExprOp.And else ExprOp.JumpIfTrue,
+                     0, node.type)
+        code.append(jump)
+
+        emit_postfix(node.children[1], code)
+        code.append(Instr(ExprOp.ToBool, 0, node.type))
+
+        jump.arg = len(code)
+        return
+
+    for child in node.children:
+        emit_postfix(child, code)
+
+    code.append(Instr(node.opcode, node.value, node.type))
+
+
+def lower_expression(op: Operation) -> List[Instr]:
+    code: List[Instr] = []
+    emit_postfix(build_expression_tree(
+        op.oprands, op.types, op.file, op.line), code)
+
+    return code
+
+
+def find_slot(symbol: str, scopes: List[dict], file: str, line: int) -> int:
+    for scope in scopes[::-1]:
+        if symbol in scope:
+            return scope[symbol]
+
+    report_error(f"unknown variable `{symbol}`", file, line)
+
+
+# Variables visible right before ip -> (frame slot, type), once the program is lowered
+def visible_variables(ops: List[Operation], ip: int) -> dict:
+    scopes: List[dict] = []
+    for op in ops[:ip]:
+        if op.type == OpType.OpBeginScope:
+            scopes.append({name: (slot, tp) for name, tp, slot in zip(
+                op.oprands[1:], op.types[1:], op.slots)})
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+
+    variables = {}
+    for scope in scopes:
+        variables.update(scope)
+
+    return variables
+
+
+# Turns every OpPush into a postfix program once so the interpreter never has to deal with infix.
+# Every variable also gets a fixed slot in a flat frame, scopes are laid out like a stack
+# so sibling scopes share slots and the frame never grows past the deepest nesting
+def lower_program(program: Program):
+    scopes: List[dict] = []
+    bases: List[int] = []
+    top = 0
+
+    program.frame_size = 0
+
+    for op in program.operations:
+        if op.type == OpType.OpBeginScope:
+            names = op.oprands[1:]
+            op.slots = list(range(top, top + len(names)))
+
+            scopes.append(dict(zip(names, op.slots)))
+            bases.append(top)
+
+            top += len(names)
+            program.frame_size = max(program.frame_size, top)
+
+        elif op.type == OpType.OpEndScope:
+            scopes.pop()
+            top = bases.pop()
+
+        elif op.type == OpType.OpPush:
+            op.code = lower_expression(op)
+
+            for instr in op.code:
+                if instr.opcode == ExprOp.Load:
+                    instr.arg = find_slot(instr.arg, scopes, op.file, op.line)
+
+        elif op.type == OpType.OpMov:
+            op.slots = [find_slot(op.oprands[-1], scopes, op.file, op.line)]
+
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            op.slots = [find_slot(name, scopes, op.file, op.line)
+                        for name in op.oprands]
@@ -0,0 +1,140 @@
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, TextIO
+
+from constfold import fold_constants
+from cse import eliminate_common_subexpressions
+from deadcode import eliminate_dead_code
+from decision import lower_decision_chains
+from idiom import recognize_idioms
+from inline import inline_functions
+from ir import format_operation, format_operations, relink_jumps
+from licm import hoist_invariants
+from strength import reduce_strength
+from parser import OpType, Operation, Program
+
+# Pass manager, runs an ordered list of ir to ir passes over the program and every function
+# after typechecking, both the interpreters and the c backend consume its output.
+# A pass gets the whole program for context plus the operations it should rewrite and
+# returns the new operations, the manager takes care of relinking jumps.
+# When asked to it also keeps track of the operations and declarations passes removed
+
+
+@dataclass
+class Pass:
+    name: str
+    level: int  # lowest -O level the pass runs at
+    run: Callable[[Program, List[Operation]], List[Operation]]
+
+
+default_level = 1
+max_level = 2
+
+# Passes in the order they run
+pipeline: List[Pass] = [
+    Pass("inline", 1, inline_functions),
+    Pass("constfold", 1, fold_constants),
+    Pass("idiom", 1, recognize_idioms),
+    Pass("strength", 2, reduce_strength),
+    Pass("licm", 1, hoist_invariants),
+    Pass("decision", 2, lower_decision_chains),
+    Pass("cse", 2, eliminate_common_subexpressions),
+    Pass("deadcode", 1, eliminate_dead_code),
+]
+
+
+@dataclass
+class PassOptions:
+    level: int = default_level
+    dump_before: List[str] = field(default_factory=list)
+    dump_after: List[str] = field(default_factory=list)
+    disabled: List[str] = field(default_factory=list)  # passes skipped at any level
+    timings: dict = field(default_factory=dict)
+    report: bool = False
+    removed: List[str] = field(default_factory=list)
+    out: TextIO = sys.stderr
+
+
+def selected_passes(level: int, disabled: List[str] | None = None) -> List[Pass]:
+    if disabled is None:
+        disabled = []
+
+    return [p for p in pipeline if p.level <= level and p.name not in disabled]
+
+
+def wants_dump(names: List[str], p: Pass) -> bool:
+    return "all" in names or p.name in names
+
+
+def dump_operations(title: str, ops: List[Operation], out: TextIO):
+    print(f"--- {title} ---", file=out)
+    print(format_operations(ops), file=out)
+
+
+def declarations(ops: List[Operation]) -> dict:
+    return {id(op): (op, list(op.oprands[1:])) for op in ops if op.type == OpType.OpBeginScope}
+
+
+# Operations and declared variables that were there before and are gone after
+def report_removed(title: str, before: List[Operation], scopes: dict, after: List[Operation], out: List[str]):
+    kept = set([id(op) for op in after])
+    for ip, op in enumerate(before):
+        if id(op) not in kept:
+            out.append(f"{title}: {format_operation(ip, op).strip()}")
+
+    remaining = declarations(after)
+    for key, (op, names) in scopes.items():
+        if key in remaining:
+            for name in names:
+                if name not in remaining[key][1]:
+                    out.append(f"{title}: variable {name}  ; {op.file}:{op.line}")
+
+
+def optimize_program(program: Program, options: PassOptions | None = None) -> Program:
+    if options is None:
+        options = PassOptions()
+
+    for p in selected_passes(options.level, options.disabled):
+        bodies = [("main", program)] + \
+            [(f"func_{i}", func) for i, func in enumerate(program.funcs)]
+
+        for name, body in bodies:
+            if wants_dump(options.dump_before, p):
+                dump_operations(f"before {p.name} ({name})",
+                                body.operations, options.out)
+
+            before = list(body.operations)
+            scopes = declarations(before)
+
+            start = time.perf_counter()
+
+            body.operations = p.run(program, body.operations)
+            relink_jumps(body.operations)
+
+            options.timings[p.name] = options.timings.get(p.name, 0.0) + \
+                time.perf_counter() - start
+
+            if options.report:
+                report_removed(f"{p.name} ({name})", before,
+                               scopes, body.operations, options.removed)
+
+            if wants_dump(options.dump_after, p):
+                dump_operations(f"after {p.name} ({name})",
+                                body.operations, options.out)
+
+    return program
+
+
+def print_removed(options: PassOptions):
+    print(f"--- removed ({len(options.removed)}) ---", file=options.out)
+    for line in options.removed:
+        print(line, file=options.out)
+
+
+def print_timings(options: PassOptions):
+    total = sum(options.timings.values())
+
+    print(f"passes at -O{options.level}: {total:.4f}s", file=options.out)
+    for name, elapsed in options.timings.items():
+        print(f"{elapsed:>10.4f}s  {name}", file=options.out)
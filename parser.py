@@ -1,15 +1,16 @@
-from dataclasses import dataclass
-from enum import Enum, auto
+from dataclasses import dataclass, field
+from enum import IntEnum, auto
 from pprint import pprint
 import re
+import sys
 from typing import List, Tuple
-from lexer import Token, lex_source
+from lexer import Token, TokenStream, lex_source
 
 from misc import not_implemented, operator_list, report_error
-from static_types import FuncCall, FuncType, Primitives, TypedPtr, Types, size_of_primitive
+from static_types import FuncCall, FuncType, Primitives, Types, size_of_primitive, typed_ptr
 
 
-class OpType(Enum):
+class OpType(IntEnum):
 
     # Declare local varibales
     OpBeginScope = auto()
@@ -39,17 +40,25 @@ class OpType(Enum):
 
     OpReturn = auto()
 
+    # Bulk stores generated by the optimizer for fill and copy loops, the destination pointer and
+    # the element count are variables, the stack holds the value to fill with or the source address
+    OpFill = auto()
+    OpCopy = auto()
 
-@dataclass
+
+@dataclass(slots=True)
 class Operation:
     type: OpType
     file: str
     line: int
     oprands: List[int | str]  # they can be both integers and string atm
     types: List[Types]
+    # filled by lowering, until then every operation shares the same empty tuple
+    code: List | tuple = ()  # postfix program
+    slots: List[int] | tuple = ()  # frame slots
 
 
-@dataclass
+@dataclass(slots=True)
 class Function:
     memory_ptr: int
     memory_capacity: int
@@ -57,67 +66,93 @@ class Function:
     operations: List[Operation]
 
 
-@dataclass
+@dataclass(slots=True)
 class Program:
     memory_ptr: int
     memory_capacity: int
     funcs: List[Function]
     operations: List[Operation]
+    frame_size: int = 0  # number of variable slots, filled by lowering
 
 
-def find_scope_with_symbol(symbol: str, program: Program, func_index: int) -> tuple[Operation|None, int]:
-    # Local Scope
-    ops = program.operations[::-1] if func_index == - \
-        1 else program.funcs[func_index].operations[::-1]
+@dataclass
+class Scope:
+    op: Operation  # begin scope declaring the symbols
+    symbols: dict = field(default_factory=dict)  # name -> index in its oprands
+
+
+@dataclass
+class Body:
+    func_index: int  # -1 for main
+    operations: List[Operation]
+    scopes: List[Scope]  # scopes open in the body, innermost last
+    blocks: List[int] = field(default_factory=list)  # if, else if, else and while waiting for their `}`
 
-    skip = False
-    for op in ops:
-        if op.type == OpType.OpBeginScope:
-            if not skip and symbol in op.oprands:
-                return op, op.oprands.index(symbol)
-            skip = False
-        elif op.type == OpType.OpEndScope:
-            skip = True
 
-    # Global Scope 
-    global_scope = program.operations[0]
-    if symbol in global_scope.oprands:
-        return global_scope, global_scope.oprands.index(symbol)
+# The parser keeps the open scopes and blocks on stacks instead of searching the operations
+# for them, so every statement takes the same time however long the program gets
+@dataclass
+class ParseState:
+    program: Program
+    bodies: List[Body]  # main and the functions being defined, innermost last
+    closed: Operation | None = None  # block the last `}` ended, an else has to follow an if
+
+
+def find_scope_with_symbol(symbol: str, state: ParseState) -> tuple[Operation | None, int]:
+    # Local Scope
+    for scope in state.bodies[-1].scopes[::-1]:
+        if symbol in scope.symbols:
+            return scope.op, scope.symbols[symbol]
+
+    # Global Scope
+    global_scope = state.bodies[0].scopes[0]
+    if symbol in global_scope.symbols:
+        return global_scope.op, global_scope.symbols[symbol]
 
     return None, -1
 
 
-def find_local_scope(program: Program, func_index: int) -> int:
-    ops = program.operations[::-1] if func_index == - \
-        1 else program.funcs[func_index].operations[::-1]
+def open_scope(op: Operation) -> Scope:
+    scope = Scope(op)
+    for i, symbol in enumerate(op.oprands[1:]):
+        scope.symbols.setdefault(symbol, i + 1)
 
-    l = len(ops)
+    return scope
 
-    skip = False
-    for i, op in enumerate(ops):
-        if op.type == OpType.OpBeginScope:
-            if not skip:
-                return l-(i+1)
-            skip = False
-        elif op.type == OpType.OpEndScope:
-            skip = True
 
-    return -1
+def declare_symbol(symbol: str, tp: Types, state: ParseState):
+    symbol = sys.intern(symbol)
+    scope = state.bodies[-1].scopes[-1]
+    scope.symbols[symbol] = len(scope.op.oprands)
+    scope.op.oprands.append(symbol)
+    scope.op.types.append(tp)
 
 
-def alloc_mem(size: int, program: Program, func_index: int) -> int:
-    loc = program.memory_ptr
-    program.memory_ptr += size
+def emit(state: ParseState, op: Operation):
+    state.bodies[-1].operations.append(op)
 
-    i = find_local_scope(program, func_index)
 
-    if func_index == -1:
-        program.operations[i].oprands[0] += size
-    else:
-        program.funcs[func_index].operations[i].oprands[0] += size
+def alloc_mem(size: int, align: int, state: ParseState) -> int:
+    program = state.program
+    body = state.bodies[-1]
+
+    # keeping allocations aligned to their element lets loads and stores use typed views
+    padding = -program.memory_ptr % align
+    loc = program.memory_ptr + padding
+    program.memory_ptr += padding + size
+
+    body.scopes[-1].op.oprands[0] += padding + size
+
+    if body.func_index != -1:
+        func = program.funcs[body.func_index]
+
+        # arrays of a function live in global memory as well, it keeps track of how far
+        # they reach so its body can run anywhere
+        func.memory_ptr = max(func.memory_ptr, program.memory_ptr)
+        func.memory_capacity = max(func.memory_capacity, program.memory_ptr)
 
     if program.memory_ptr > program.memory_capacity:
-        program.memory_capacity += size
+        program.memory_capacity = program.memory_ptr
 
     return loc
 
@@ -177,7 +212,7 @@ def parse_bool_literal(symbol: str) -> tuple[int, bool]:
     return 0, False
 
 
-def parse_word(word: str, program: Program, func_index: int, file: str, line: int) -> tuple[int | str, Types]:
+def parse_word(word: str, state: ParseState, file: str, line: int) -> tuple[int | str, Types]:
     word = word.strip()
 
     int_lit, is_int = parse_int_literal(word)
@@ -212,7 +247,7 @@ def parse_word(word: str, program: Program, func_index: int, file: str, line: in
             report_error(
                 f"unknown type `{tp[0]}`", file, line)
 
-        return alloc_mem(size_of_primitive(primitive), program, func_index), TypedPtr(primitive)
+        return alloc_mem(size_of_primitive(primitive), size_of_primitive(primitive), state), typed_ptr(primitive)
 
     # Match arrays
     elif re.fullmatch("\[[0-9]+\].*", word):
@@ -230,7 +265,7 @@ def parse_word(word: str, program: Program, func_index: int, file: str, line: in
             report_error(
                 f"unknown type `{tp[0]}`", file, line)
 
-        return alloc_mem(size_of_primitive(primitive) * size, program, func_index), TypedPtr(primitive)
+        return alloc_mem(size_of_primitive(primitive) * size, size_of_primitive(primitive), state), typed_ptr(primitive)
 
     # Match characters
     elif re.fullmatch("'\\\?.'", word):
@@ -256,8 +291,7 @@ def parse_word(word: str, program: Program, func_index: int, file: str, line: in
     elif re.fullmatch("[a-zA-Z0-9_]+\[.*\]", word):
         tokens = re.findall("([a-zA-Z0-9_]+)\[(.*)\]", word).pop()
 
-        foundop, p_index = find_scope_with_symbol(
-            tokens[0], program, func_index)
+        foundop, p_index = find_scope_with_symbol(tokens[0], state)
 
         if foundop != None:
             intokens = re.findall(
@@ -266,31 +300,26 @@ def parse_word(word: str, program: Program, func_index: int, file: str, line: in
             types = []
 
             for i in intokens:
-                eval_stack, tps = parse_expression(
-                    i, program, func_index, file, line)
+                eval_stack, tps = parse_expression(i, state, file, line)
                 oprands.append(eval_stack[::-1])
                 types.append(tps)
 
-            return word, FuncCall(name=tokens[0], signature=FuncType(ins=[], outs=[]), oprands=oprands, types=types)
+            return word, FuncCall(name=sys.intern(tokens[0]), signature=FuncType(ins=[], outs=[]), oprands=oprands, types=types)
         else:
             report_error(f"unrecognised function call `{word}`", file, line)\
 
     # Match variables
     else:
         # Match variables
-        foundop, p_index = find_scope_with_symbol(word, program, func_index)
+        foundop, p_index = find_scope_with_symbol(word, state)
         if foundop != None:
-            tp = Primitives.Unknown
-            if func_index == -1:
-                tp = foundop.types[p_index]
-            else:
-                tp = foundop.types[p_index]
-            return word, tp
+            # every use of a name is the same string
+            return sys.intern(word), foundop.types[p_index]
 
     report_error(f"unrecognised word in expression `{word}`", file, line)
 
 
-def parse_expression(exp: str, program: Program, func_index: int, file: str, line: int) -> tuple[List[int | str], List[Types]]:
+def parse_expression(exp: str, state: ParseState, file: str, line: int) -> tuple[List[int | str], List[Types]]:
     eval_stack: List[int | str] = []
     type_stack: List[Primitives] = []
 
@@ -311,7 +340,7 @@ def parse_expression(exp: str, program: Program, func_index: int, file: str, lin
 
         elif not skip and ch in "=+-/*%()!&^|<>":
             if word != "":
-                eval, type = parse_word(word, program, func_index, file, line)
+                eval, type = parse_word(word, state, file, line)
 
                 eval_stack.append(eval)
                 type_stack.append(type)
@@ -333,7 +362,7 @@ def parse_expression(exp: str, program: Program, func_index: int, file: str, lin
 
         if i == len(exp) - 1:
             if word != "":
-                eval, type = parse_word(word, program, func_index, file, line)
+                eval, type = parse_word(word, state, file, line)
 
                 eval_stack.append(eval)
                 type_stack.append(type)
@@ -341,27 +370,20 @@ def parse_expression(exp: str, program: Program, func_index: int, file: str, lin
     return eval_stack, type_stack
 
 
-def consume_token(tokens: List[Token], i: List[int]) -> Token | None:
-    if i[0] >= len(tokens):
-        return None
-    token = tokens[i[0]]
-    i[0] = i[0] + 1
-    return token
+def consume_token(tokens: TokenStream) -> Token | None:
+    return tokens.consume()
 
 
-def peek_token(tokens: List[Token], i: List[int]) -> Token | None:
-    if i[0] >= len(tokens):
-        return None
-    token = tokens[i[0]]
-    return token
+def peek_token(tokens: TokenStream) -> Token | None:
+    return tokens.peek()
 
 
-def parse_functype(tokens: List[Token], state: List[int], file: str, line: int) -> Tuple[List[str], FuncType]:
+def parse_functype(tokens: TokenStream, file: str, line: int) -> Tuple[List[str], FuncType]:
     ins: Types = []
     outs: Types = []
     vars: List[str] = []
 
-    token = consume_token(tokens, state)
+    token = consume_token(tokens)
     intokens = re.findall("([a-z][a-zA-Z0-9:]*)\s*(?:,|$)", token.word)
 
     for i in intokens:
@@ -370,19 +392,19 @@ def parse_functype(tokens: List[Token], state: List[int], file: str, line: int)
         if len(var_info) != 2:
             report_error("unexpected function declaration", file, line)
 
-        vars.append(var_info[0])
+        vars.append(sys.intern(var_info[0]))
         if var_info[1][0] == "^":
-            ins.append(TypedPtr(parse_primitives(var_info[1][1:])))
+            ins.append(typed_ptr(parse_primitives(var_info[1][1:])))
         else:
             ins.append(parse_primitives(var_info[1]))
 
-    token = consume_token(tokens, state)
+    token = consume_token(tokens)
     outtokens = re.findall(
         "([a-z][a-zA-Z0-9]*)\s*(?:,|$)", token.word)
 
     for i in outtokens:
         if i[0] == "^":
-            outs.append(TypedPtr(parse_primitives(i[1:])))
+            outs.append(typed_ptr(parse_primitives(i[1:])))
         else:
             outs.append(parse_primitives(i))
 
@@ -391,9 +413,12 @@ def parse_functype(tokens: List[Token], state: List[int], file: str, line: int)
 
 keywords = ["if", "while", "else", "print", "{", "}", "->"]
 
+# operations a `{` opens the body of
+block_types = [OpType.OpIf, OpType.OpElseIf, OpType.OpElse, OpType.OpWhile]
+
 
 def parse_program_from_file(file_path: str) -> Program:
-    tokens = lex_source(file_path)
+    tokens = TokenStream(lex_source(file_path))
 
     program = Program(memory_ptr=1,
                       memory_capacity=1,
@@ -403,210 +428,145 @@ def parse_program_from_file(file_path: str) -> Program:
     program.operations.append(
         Operation(OpType.OpBeginScope, file_path, 1, [0], [Primitives.Untyped]))
 
-    state = [0]
-    func_index = -1
-    skip_scope = False
+    state = ParseState(program, [Body(-1, program.operations, [open_scope(program.operations[0])])])
 
-    while state[0] < len(tokens):
-        token = consume_token(tokens, state)
+    while peek_token(tokens) is not None:
+        token = consume_token(tokens)
+        body = state.bodies[-1]
 
         if token.word in keywords:
             if token.word == "if":
-                token = consume_token(tokens, state)
+                token = consume_token(tokens)
 
                 eval_stack, types = parse_expression(
-                    token.word, program, func_index, token.file, token.line)
+                    token.word, state, token.file, token.line)
 
-                if func_index == -1:
-                    program.operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                    program.operations.append(
-                        Operation(OpType.OpIf, token.file, token.line, [], []))
-                else:
-                    program.funcs[i].operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                    program.funcs[i].operations.append(
-                        Operation(OpType.OpIf, token.file, token.line, [], []))
+                emit(state, Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                emit(state, Operation(OpType.OpIf, token.file, token.line, [], []))
 
             elif token.word == "else":
-                top_op = program.operations[-1]
+                top_op = body.operations[-1]
 
                 if top_op.type != OpType.OpEndScope:
                     report_error("unexpected expression else",
                                  token.file, token.line)
 
-                skip = False
-                if_found = False
-                for op in program.operations[::-1]:
-                    if op.type == OpType.OpElse:
-                        skip = True
-                    elif op.type == OpType.OpIf:
-                        if not skip:
-                            if_found = True
-                            break
-
-                        skip = False
-
-                if not if_found:
+                if state.closed is None or state.closed.type not in [OpType.OpIf, OpType.OpElseIf]:
                     report_error("unexpected else without if",
                                  token.file, token.line)
 
-                next_token = peek_token(tokens, state)
+                next_token = peek_token(tokens)
 
                 if next_token.word == "if":  # elseif
-                    consume_token(tokens, state)
-                    token = consume_token(tokens, state)
+                    consume_token(tokens)
+                    token = consume_token(tokens)
 
                     eval_stack, types = parse_expression(
-                        token.word, program, func_index, token.file, token.line)
+                        token.word, state, token.file, token.line)
 
-                    if func_index == -1:
-                        program.operations.append(
-                            Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                        program.operations.append(
-                            Operation(OpType.OpElseIf, token.file, token.line, [], []))
-                    else:
-                        program.funcs[func_index].operations.append(
-                            Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                        program.funcs[func_index].operations.append(
-                            Operation(OpType.OpElseIf, token.file, token.line, [], []))
+                    emit(state, Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                    emit(state, Operation(OpType.OpElseIf, token.file, token.line, [], []))
                 else:
-                    program.operations.append(
-                        Operation(OpType.OpElse, token.file, token.line, [], []))
+                    emit(state, Operation(OpType.OpElse, token.file, token.line, [], []))
 
             elif token.word == "while":
-                token = consume_token(tokens, state)
+                token = consume_token(tokens)
 
                 eval_stack, types = parse_expression(
-                    token.word, program, func_index, token.file, token.line)
-
-                if func_index == -1:
-                    program.operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                    program.operations.append(
-                        Operation(OpType.OpWhile, token.file, token.line, [], []))
-                else:
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                    token.word, state, token.file, token.line)
 
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpWhile, token.file, token.line, [], []))
+                emit(state, Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                emit(state, Operation(OpType.OpWhile, token.file, token.line, [], []))
 
             elif token.word == "{":
-                if func_index == -1:
-                    program.operations.append(
-                        Operation(OpType.OpBeginScope, token.file, token.line, [0], [Primitives.Untyped]))
-                else:
-                    skip_scope = True
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpBeginScope, token.file, token.line, [0], [Primitives.Untyped]))
+                ip = len(body.operations) - 1
+                if ip < 0 or body.operations[ip].type not in block_types or len(body.operations[ip].oprands) > 0:
+                    report_error("unexpected `{` without a block", token.file, token.line)
 
-            elif token.word == "}":
-                i = 0
-                j = 0
-                op_type = OpType.OpIf
+                op = Operation(OpType.OpBeginScope, token.file, token.line, [0], [Primitives.Untyped])
+                emit(state, op)
 
-                for ip, op in enumerate(program.operations[::-1]):
-                    if op.type in [OpType.OpIf, OpType.OpWhile, OpType.OpElseIf, OpType.OpElse] and len(op.oprands) == 0:
-                        op.oprands.append(i+1)
-                        op_type = op.type
-                        j = len(program.operations) - (ip + 1)
-                        break
+                body.blocks.append(ip)
+                body.scopes.append(open_scope(op))
 
-                    i = i+1
-                stack = []
+            elif token.word == "}":
+                if len(body.blocks) == 0 and len(state.bodies) == 1:
+                    report_error("unexpected `}` without a block", token.file, token.line)
 
-                if op_type == OpType.OpWhile:
-                    stack = [j - 1]
+                if len(body.blocks) > 0:
+                    # memory of a block in main is free again once it ends, a function keeps
+                    # all of its arrays since it can be called at any time
+                    scope = body.scopes.pop()
+                    if body.func_index == -1:
+                        program.memory_ptr -= scope.op.oprands[0]
 
-                elif op_type == OpType.OpIf:
-                    stack = []
+                    j = body.blocks.pop()
+                    op = body.operations[j]
+                    op.oprands.append(len(body.operations) - j)
 
-                i = find_local_scope(program, func_index)
-                program.memory_ptr -= program.operations[i].oprands[0]
+                    stack = [j - 1] if op.type == OpType.OpWhile else []
+                    emit(state, Operation(OpType.OpEndScope, token.file, token.line, stack, []))
+                    state.closed = op
 
-                if func_index == -1:
-                    program.operations.append(
-                        Operation(OpType.OpEndScope, token.file, token.line, stack, []))
                 else:
-                    if skip_scope:
-                        skip_scope = False
-                    else:
-                        func_index = -1
-
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpEndScope, token.file, token.line, stack, []))
+                    # the arrays of a function stay allocated, it can be called at any time
+                    emit(state, Operation(OpType.OpEndScope, token.file, token.line, [], []))
+                    state.bodies.pop()
+                    state.closed = None
 
             elif token.word == "print":
-                token = consume_token(tokens, state)
+                token = consume_token(tokens)
 
                 eval_stack, types = parse_expression(
-                    token.word, program, func_index, token.file, token.line)
-
-                if func_index == -1:
-                    program.operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                    token.word, state, token.file, token.line)
 
-                    program.operations.append(
-                        Operation(OpType.OpPrint, token.file, token.line, [], []))
-                else:
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
-
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpPrint, token.file, token.line, [], []))
+                emit(state, Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                emit(state, Operation(OpType.OpPrint, token.file, token.line, [], []))
 
             elif token.word == "->":
-                token = consume_token(tokens, state)
+                token = consume_token(tokens)
 
                 eval_stack, types = parse_expression(
-                    token.word, program, func_index, token.file, token.line)
+                    token.word, state, token.file, token.line)
 
-                if func_index == -1:
+                if body.func_index == -1:
                     report_error(
                         "return cannot be called outside a function call", token.file, token.line)
-                else:
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
 
-                    program.funcs[func_index].operations.append(
-                        Operation(OpType.OpReturn, token.file, token.line, [func_index], [Primitives.Untyped]))
+                emit(state, Operation(OpType.OpPush, token.file, token.line, eval_stack, types))
+                emit(state, Operation(OpType.OpReturn, token.file, token.line,
+                                      [body.func_index], [Primitives.Untyped]))
 
             else:
                 not_implemented(f"parsing of `{token.word}` keyword")
         else:
-            next_token = peek_token(tokens, state)
+            next_token = peek_token(tokens)
             if next_token is not None:
                 tp = Primitives.Unknown
                 deref = False
 
                 word = token.word
-                file = token.file
-                line = token.line
 
                 if word[0] == "^":
                     word = word[1:]
                     deref = True
 
-                foundop, opi = find_scope_with_symbol(word, program, func_index)
+                word = sys.intern(word)
+
+                foundop, opi = find_scope_with_symbol(word, state)
 
                 if foundop == None:
                     if next_token.word != ":":
                         report_error(f"Symbol `{word}` used before declaration",
                                      token.file, token.line)
 
-                    consume_token(tokens, state)
-                    next_token = peek_token(tokens, state)
+                    consume_token(tokens)
+                    next_token = peek_token(tokens)
 
                     if next_token.word != "=":
-                        token = consume_token(tokens, state)
+                        token = consume_token(tokens)
                         if token.word[0] == "^":
-                            tp = TypedPtr(parse_primitives(
+                            tp = typed_ptr(parse_primitives(
                                 token.word[1:]))
                         else:
                             tp = parse_primitives(next_token.word)
@@ -618,58 +578,60 @@ def parse_program_from_file(file_path: str) -> Program:
                             f"unkown type `{token.word}`",
                             token.file, token.line)
 
-                    ip = find_local_scope(program, func_index)
-
-                    program.operations[ip].oprands.append(word)
-                    program.operations[ip].types.append(tp)
+                    declare_symbol(word, tp, state)
                 else:
-                    tp = program.operations[ip].types[opi]
+                    tp = foundop.types[opi]
 
-                next_token = peek_token(tokens, state)
+                next_token = peek_token(tokens)
                 if next_token.word == ":":
-                     report_error(f"cannot redefine symbol `{word}`",
+                    report_error(f"cannot redefine symbol `{word}`",
                                  token.file, token.line)
 
-                consume_token(tokens, state)
-                token = consume_token(tokens, state)
+                consume_token(tokens)
+                token = consume_token(tokens)
 
                 if token.word == "":
                     report_error("expected expression after `=`",
                                  token.file, token.line)
                 elif token.word == "func":
                     vars, exp_type = parse_functype(
-                        tokens, state, token.file, token.line)
+                        tokens, token.file, token.line)
 
                     func_index = len(program.funcs)
-                    skip_scope = False
-                    program.funcs.append(
-                        Function(memory_capacity=1, memory_ptr=1, signature=exp_type, operations=[]))
+                    func = Function(memory_capacity=1, memory_ptr=1, signature=exp_type, operations=[])
+                    program.funcs.append(func)
 
-                    program.operations.append(
-                        Operation(OpType.OpPush, token.file,
-                                  token.line, [func_index], [exp_type]))
+                    emit(state, Operation(OpType.OpPush, token.file,
+                                          token.line, [func_index], [exp_type]))
+                    emit(state, Operation(OpType.OpMov, token.file,
+                                          token.line, [deref, word], [tp]))
 
-                    program.funcs[func_index].operations.append(
+                    func.operations.append(
                         Operation(OpType.OpBeginScope, token.file, token.line, [0] + vars, [Primitives.Untyped] + exp_type.ins))
+                    state.bodies.append(Body(func_index, func.operations, [open_scope(func.operations[0])]))
 
-                    consume_token(tokens, state)
+                    consume_token(tokens)
+                    continue
                 else:
                     eval_stack, types = parse_expression(
-                        token.word, program, func_index, token.file, token.line)
+                        token.word, state, token.file, token.line)
 
-                    program.operations.append(
-                        Operation(OpType.OpPush, token.file,
-                                  token.line, eval_stack, types))
+                    emit(state, Operation(OpType.OpPush, token.file,
+                                          token.line, eval_stack, types))
 
-                program.operations.append(
-                    Operation(OpType.OpMov, token.file,
-                              token.line, [deref, word], [tp]))
+                emit(state, Operation(OpType.OpMov, token.file,
+                                      token.line, [deref, word], [tp]))
 
             else:
                 report_error(f"Expected token after `{token.word}`",
-                             file, line)
+                             token.file, token.line)
+
+    for body in state.bodies:
+        if len(body.blocks) > 0 or body.func_index != -1:
+            op = body.operations[body.blocks[-1]] if len(body.blocks) > 0 else body.operations[0]
+            report_error("block is missing its `}`", op.file, op.line)
 
     program.operations.append(
-        Operation(OpType.OpEndScope, file_path, tokens[-1].line, [], []))
+        Operation(OpType.OpEndScope, file_path, tokens.line, [], []))
 
     return program
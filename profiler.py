@@ -0,0 +1,137 @@
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, List, TextIO
+
+from closures import compile_operations
+from interpreter import AllocStats, make_memory
+from parser import OpType, Program
+
+# Execution profiler, runs the program on the closure engine with every step wrapped in a
+# counter and a timer. Pushes are fused with the operation consuming them so their cost
+# is booked on that operation, the steps never nest so every time is exclusive
+
+
+@dataclass
+class Profile:
+    counts: List[int] = field(default_factory=list)
+    times: List[float] = field(default_factory=list)
+
+
+@dataclass
+class HotSpot:
+    location: str
+    operation: str
+    count: int
+    time: float
+
+
+def make_timed_step(step: Callable, ip: int, profile: Profile) -> Callable:
+    counts = profile.counts
+    times = profile.times
+    clock = time.perf_counter
+
+    def timed_step():
+        start = clock()
+        nxt = step()
+        times[ip] += clock() - start
+        counts[ip] += 1
+        return nxt
+
+    return timed_step
+
+
+def profile_program(program: Program, stats: AllocStats | None = None) -> Profile:
+    if stats is None:
+        stats = AllocStats()
+
+    ops = program.operations
+    profile = Profile([0] * len(ops), [0.0] * len(ops))
+
+    frame = [0] * program.frame_size
+    global_memory = make_memory(program.memory_capacity)
+    stats.frames += 1
+    stats.memory += 1
+
+    steps = compile_operations(program, frame, global_memory, stats)
+
+    for ip, step in enumerate(steps):
+        owner = ip + 1 if ops[ip].type == OpType.OpPush else ip
+        steps[ip] = make_timed_step(step, owner, profile)
+
+    ip = 0
+    end = len(steps)
+    while ip < end:
+        ip = steps[ip]()
+
+    sys.stdout.flush()
+    return profile
+
+
+def hot_operations(program: Program, profile: Profile) -> List[HotSpot]:
+    spots: List[HotSpot] = []
+
+    for ip, op in enumerate(program.operations):
+        if profile.counts[ip] == 0:
+            continue
+
+        spots.append(HotSpot(f"{op.file}:{op.line}", f"{ip}: {op.type.name}",
+                             profile.counts[ip], profile.times[ip]))
+
+    return sorted(spots, key=lambda spot: spot.time, reverse=True)
+
+
+def hot_lines(program: Program, profile: Profile) -> List[HotSpot]:
+    lines: dict = {}
+
+    for ip, op in enumerate(program.operations):
+        if profile.counts[ip] == 0:
+            continue
+
+        location = f"{op.file}:{op.line}"
+        if location not in lines:
+            lines[location] = HotSpot(location, "", 0, 0.0)
+
+        spot = lines[location]
+        spot.operation = op.type.name if spot.operation == "" else f"{spot.operation},{op.type.name}"
+        spot.count += profile.counts[ip]
+        spot.time += profile.times[ip]
+
+    return sorted(lines.values(), key=lambda spot: spot.time, reverse=True)
+
+
+def print_hot_spots(title: str, spots: List[HotSpot], total: float, limit: int, out: TextIO):
+    print(title, file=out)
+    print(f"{'count':>12} {'time(s)':>10} {'time%':>6}  {'location':<24} operation", file=out)
+
+    for spot in spots[:limit]:
+        share = 100 * spot.time / total if total > 0 else 0
+        print(f"{spot.count:>12} {spot.time:>10.4f} {share:>5.1f}%  {spot.location:<24} {spot.operation}",
+              file=out)
+
+
+def print_profile(program: Program, profile: Profile, limit: int = 20, out: TextIO = sys.stderr):
+    total = sum(profile.times)
+
+    print(f"profile: {sum(profile.counts)} steps in {total:.4f}s", file=out)
+    print_hot_spots("\nhot lines", hot_lines(
+        program, profile), total, limit, out)
+    print_hot_spots("\nhot operations", hot_operations(
+        program, profile), total, limit, out)
+
+
+def write_profile_json(program: Program, profile: Profile, file_path: str):
+    def as_dicts(spots: List[HotSpot]) -> List[dict]:
+        return [{"location": spot.location, "operation": spot.operation,
+                 "count": spot.count, "time": spot.time} for spot in spots]
+
+    report = {
+        "steps": sum(profile.counts),
+        "time": sum(profile.times),
+        "lines": as_dicts(hot_lines(program, profile)),
+        "operations": as_dicts(hot_operations(program, profile)),
+    }
+
+    with open(file_path, "w") as file:
+        json.dump(report, file, indent=2)
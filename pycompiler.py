@@ -0,0 +1,366 @@
+import glob
+import hashlib
+import marshal
+import os
+import sys
+from types import CodeType
+from typing import Callable, List
+
+from lowering import ExprOp, Instr
+from misc import not_implemented, report_error
+from parser import OpType, Operation, Program
+from static_types import FuncType, Primitives, TypedPtr, Types, size_of_primitive, type_str
+
+# Python backend, emits an equivalent python module with real while/if statements and
+# locals so cpython can run husky programs without going through an interpreter loop
+
+float_types = [Primitives.F32, Primitives.F64]
+
+arithmetic_operators = {
+    ExprOp.Add: "+",
+    ExprOp.Sub: "-",
+    ExprOp.Mul: "*",
+}
+
+compare_operators = {
+    ExprOp.Lt: "<",
+    ExprOp.Gt: ">",
+    ExprOp.Eq: "==",
+    ExprOp.Ne: "!=",
+}
+
+preamble = """import math
+import sys
+from closures import round_f32
+from interpreter import c_int_div, c_int_mod, copy_memory, fill_memory, load_memory, make_memory, store_memory
+from misc import report_error
+from static_types import Primitives
+
+"""
+
+
+# Expressions are returned as (code, is_bool), comparisons stay python bools so conditions
+# don't pay for turning them back into 1 and 0
+def as_value(code: str, is_bool: bool) -> str:
+    return f"(1 if {code} else 0)" if is_bool else code
+
+
+def compile_expression(code: List[Instr], names: dict) -> tuple[str, bool]:
+    stack: List[tuple[str, Types, bool]] = []
+
+    # left hand sides of && and || waiting for their right hand side
+    pending: List[tuple[str, ExprOp]] = []
+
+    for instr in code:
+        opcode = instr.opcode
+        tp = instr.type
+
+        if opcode == ExprOp.Const:
+            stack.append((repr(instr.arg), tp, False))
+
+        elif opcode == ExprOp.Load:
+            stack.append((names[instr.arg], tp, False))
+
+        elif opcode == ExprOp.Not:
+            a, _, a_bool = stack.pop()
+            stack.append((f"(not {a})", tp, True))
+
+        elif opcode == ExprOp.Deref:
+            a, _, a_bool = stack.pop()
+
+            # bytes can never be unaligned so they index the view directly
+            if size_of_primitive(tp) == 1:
+                stack.append((f"memory_bytes[{as_value(a, a_bool)}]", tp, False))
+            else:
+                stack.append(
+                    (f"load_memory(global_memory, {as_value(a, a_bool)}, Primitives.{tp.name})", tp, False))
+
+        elif opcode == ExprOp.Call:
+            not_implemented("function calls in the python backend")
+
+        elif opcode in [ExprOp.JumpIfFalse, ExprOp.JumpIfTrue]:
+            b, _, _ = stack.pop()
+            pending.append((b, "and" if opcode == ExprOp.JumpIfFalse else "or"))
+
+        elif opcode == ExprOp.ToBool:
+            a, _, _ = stack.pop()
+            b, logic = pending.pop()
+            stack.append((f"({b} {logic} {a})", tp, True))
+
+        else:
+            a, a_tp, a_bool = stack.pop()
+            b, b_tp, b_bool = stack.pop()
+
+            if opcode in compare_operators:
+                stack.append(
+                    (f"({as_value(b, b_bool)} {compare_operators[opcode]} {as_value(a, a_bool)})", tp, True))
+
+            else:
+                a = as_value(a, a_bool)
+                b = as_value(b, b_bool)
+                mixed = (a_tp in float_types) != (b_tp in float_types)
+
+                if opcode in arithmetic_operators:
+                    val = f"({b} {arithmetic_operators[opcode]} {a})"
+                elif a_tp not in float_types and b_tp not in float_types:
+                    val = f"c_int_div({b}, {a})" if opcode == ExprOp.Div else f"c_int_mod({b}, {a})"
+                    mixed = tp in float_types
+                elif opcode == ExprOp.Div:
+                    val = f"({b} / {a})"
+                    mixed = tp not in float_types
+                else:
+                    val = f"math.fmod({b}, {a})"
+                    mixed = tp not in float_types
+
+                if mixed:
+                    val = f"float({val})" if tp in float_types else f"int({val})"
+
+                stack.append((val, tp, False))
+
+    val, _, is_bool = stack.pop()
+    return val, is_bool
+
+
+def compile_store(name: str, deref: bool, tp: Types, expr: str, expr_tp: Types,
+                  memory_ptr: int, file: str, line: int) -> List[str]:
+    if deref:
+        size = size_of_primitive(tp.primitive)
+        store = f"store_memory(global_memory, address, Primitives.{tp.primitive.name}, {expr})"
+        if size == 1:
+            store = f"memory_bytes[address] = int({expr}) & 0xFF"
+
+        return [
+            f"address = {name}",
+            f"if address + {size - 1} > {memory_ptr - 1}:",
+            f"    report_error('trying to access unallocated memory', {file!r}, {line})",
+            store,
+        ]
+
+    elif tp == Primitives.F32:
+        return [f"{name} = round_f32({expr})"]
+
+    elif tp == Primitives.F64 and expr_tp not in float_types:
+        return [f"{name} = float({expr})"]
+
+    # integers wrap on store like they do in the interpreter
+    elif tp in [Primitives.Byte, Primitives.Bool]:
+        return [f"{name} = int({expr}) & 0xFF"]
+
+    elif tp == Primitives.I32:
+        return [f"{name} = (int({expr}) + 0x80000000) % 0x100000000 - 0x80000000"]
+
+    elif tp == Primitives.I64 or type(tp) in [TypedPtr, FuncType]:
+        return [f"{name} = (int({expr}) + 0x8000000000000000) % 0x10000000000000000 - 0x8000000000000000"]
+
+    elif tp == Primitives.F64:
+        return [f"{name} = {expr}"]
+
+    report_error(
+        f"assignment for this type `{type_str(tp)}` not defined", file, line)
+
+
+def compile_bulk(op: Operation, names: dict, expr: str, memory_ptr: int) -> str:
+    dst, count = [names[slot] for slot in op.slots]
+    primitive = f"Primitives.{op.types[0].primitive.name}"
+
+    if op.type == OpType.OpFill:
+        return f"fill_memory(global_memory, {dst}, {count}, {primitive}, {expr}, {memory_ptr}, {op.file!r}, {op.line})"
+
+    return f"copy_memory(global_memory, {dst}, {expr}, {count}, {primitive}, {memory_ptr}, {op.file!r}, {op.line})"
+
+
+def compile_print(tp: Types, expr: str, file: str, line: int) -> str:
+    if tp in [Primitives.I32, Primitives.I64, Primitives.F32, Primitives.F64]:
+        return f"write(str({expr}))"
+    elif tp == Primitives.Byte:
+        return f"write(chr({expr}))"
+    elif tp == Primitives.Bool:
+        return f"write('true' if {expr} == 1 else 'false')"
+    elif type(tp) == TypedPtr:
+        return f"write('^{type_str(tp.primitive)}(' + str({expr}) + ')')"
+
+    report_error(f"undefined print for this type", file, line)
+
+
+def compile_program(program: Program) -> str:
+    lines: List[str] = []
+    locations: List[tuple] = []  # source file and line of every line in lines
+
+    # slot -> python local, slots are reused by sibling scopes so this is
+    # kept up to date while walking the operations in order
+    names: dict = {}
+
+    # one entry per open scope, true when the scope opened an indented block
+    blocks: List[bool] = []
+    block_sizes: List[int] = []
+    indent = 1
+
+    expr = ""
+    expr_tp: Types = Primitives.Unknown
+    is_bool = False
+    opens_block = False
+
+    assert len(OpType) == 12, "Exhaustive handling of operations"
+
+    def emit(code: str):
+        lines.append("    " * indent + code)
+        locations.append((op.file, op.line))
+
+    for op in program.operations:
+
+        if op.type == OpType.OpBeginScope:
+            blocks.append(opens_block)
+            block_sizes.append(len(lines))
+            if opens_block:
+                indent += 1
+                opens_block = False
+
+            for i, slot in enumerate(op.slots):
+                var = op.oprands[i+1]
+                tp = op.types[i+1]
+                names[slot] = f"{var}_{slot}"
+
+                emit(f"{names[slot]} = {0.0 if tp in float_types else 0}")
+
+        elif op.type == OpType.OpEndScope:
+            if len(lines) == block_sizes.pop():
+                emit("pass")
+
+            if blocks.pop():
+                indent -= 1
+
+        elif op.type == OpType.OpPush:
+            expr, is_bool = compile_expression(op.code, names)
+            expr_tp = op.code[-1].type
+
+        elif op.type == OpType.OpMov:
+            name = names[op.slots[-1]]
+            for line in compile_store(name, op.oprands[-2], op.types[-1],
+                                      as_value(expr, is_bool), expr_tp,
+                                      program.memory_ptr, op.file, op.line):
+                emit(line)
+
+        elif op.type == OpType.OpIf:
+            emit(f"if {expr}:")
+            opens_block = True
+
+        elif op.type == OpType.OpElseIf:
+            emit(f"elif {expr}:")
+            opens_block = True
+
+        elif op.type == OpType.OpElse:
+            emit("else:")
+            opens_block = True
+
+        elif op.type == OpType.OpWhile:
+            emit(f"while {expr}:")
+            opens_block = True
+
+        elif op.type == OpType.OpPrint:
+            emit(compile_print(op.types[-1], as_value(
+                expr, is_bool), op.file, op.line))
+
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            emit(compile_bulk(op, names, as_value(expr, is_bool), program.memory_ptr))
+
+        else:
+            not_implemented(f"python compilation of `{op.type}`")
+
+    source = preamble
+    source += "\ndef main():\n"
+    source += f"    global_memory = make_memory({program.memory_capacity})\n"
+    source += "    memory_bytes = global_memory.views['B']\n"
+    source += "    write = sys.stdout.write\n"
+    first_line = source.count("\n") + 1
+    source += "\n".join(lines)
+    source += "\n\n\n"
+    # lets run_code tell where a python error came from in the husky source
+    source += f"source_lines = {dict([(first_line + i, loc) for i, loc in enumerate(locations)])!r}\n\n\n"
+    source += "if __name__ == \"__main__\":\n"
+    source += "    main()\n"
+
+    return source
+
+
+def cache_path(file_path: str) -> str:
+    directory, name = os.path.split(os.path.abspath(file_path))
+    return os.path.join(directory, "__huskycache__", f"{name}.{sys.implementation.cache_tag}.bin")
+
+
+# The key covers the husky source, the options it was built with and the whole compiler
+# (passes included) so a cached module never outlives a change to any of them
+def cache_key(file_path: str, options: str) -> bytes:
+    key = hashlib.sha256()
+
+    with open(file_path, "rb") as file:
+        key.update(file.read())
+
+    for source in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        with open(source, "rb") as file:
+            key.update(file.read())
+
+    key.update(options.encode())
+    return key.digest()
+
+
+def load_cached_code(file_path: str, key: bytes) -> CodeType | None:
+    try:
+        with open(cache_path(file_path), "rb") as file:
+            if file.read(len(key)) != key:
+                return None
+
+            return marshal.loads(file.read())
+
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+def store_cached_code(file_path: str, key: bytes, code: CodeType):
+    path = cache_path(file_path)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as file:
+            file.write(key)
+            file.write(marshal.dumps(code))
+
+    except OSError:
+        pass
+
+
+def compile_file(file_path: str, load_program: Callable[[str], Program],
+                 options: str = "", use_cache: bool = True) -> CodeType:
+    key = cache_key(file_path, options)
+
+    if use_cache:
+        code = load_cached_code(file_path, key)
+        if code is not None:
+            return code
+
+    source = compile_program(load_program(file_path))
+    code = compile(source, f"<husky {file_path}>", "exec")
+
+    if use_cache:
+        store_cached_code(file_path, key, code)
+
+    return code
+
+
+def run_code(code: CodeType):
+    namespace = {"__name__": "__husky__"}
+    exec(code, namespace)
+
+    try:
+        namespace["main"]()
+    except ZeroDivisionError as error:
+        # innermost line of the generated module the error went through
+        line = 0
+        trace = error.__traceback__
+        while trace is not None:
+            if trace.tb_frame.f_code.co_filename == code.co_filename:
+                line = trace.tb_lineno
+            trace = trace.tb_next
+
+        file, line = namespace["source_lines"].get(line, (code.co_filename, 0))
+        report_error("division by zero", file, line)
@@ -15,18 +15,18 @@ class Primitives(Enum):
     Unknown = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class TypedPtr():
     primitive: Primitives
 
 
-@dataclass
+@dataclass(slots=True)
 class FuncType():
     ins: List[Primitives | TypedPtr]
     outs: List[Primitives | TypedPtr]
 
 
-@dataclass
+@dataclass(slots=True)
 class FuncCall():
     name: str
     signature: FuncType
@@ -36,6 +36,16 @@ class FuncCall():
 
 Types = Primitives | TypedPtr | FuncType | FuncCall
 
+# pointer types are never changed once made, every `^i64` of a program is the same object
+pointer_types: dict = {}
+
+
+def typed_ptr(primitive: Primitives) -> TypedPtr:
+    if primitive not in pointer_types:
+        pointer_types[primitive] = TypedPtr(primitive)
+
+    return pointer_types[primitive]
+
 
 def size_of_primitive(primitive: Primitives) -> int:
     if primitive in [Primitives.I32, Primitives.F32]:
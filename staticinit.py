@@ -0,0 +1,141 @@
+import contextlib
+import copy
+import io
+import math
+from dataclasses import dataclass
+from typing import List
+
+import closures
+from interpreter import AllocStats, Memory, make_memory
+from ir import block_operations, has_call
+from lowering import lower_program
+from parser import OpType, Operation, Program
+from static_types import FuncType, Primitives, TypedPtr, Types
+
+# Compile time evaluation of the start of main, the longest prefix that only computes values
+# and stores to global memory is run through the closure engine while compiling, the c
+# backend then emits the globals and global memory it left behind as static initializers
+# and starts main right after it. The closure engine stores values exactly like the
+# interpreter does, narrow integers included, and unlike it can be stepped and stopped
+
+default_budget = 1 << 20
+
+i32_range = (-2**31, 2**31 - 1)
+i64_range = (-2**63, 2**63 - 1)
+
+
+@dataclass
+class StaticImage:
+    resume: int  # first operation of main still left to run
+    values: dict  # global -> value
+    memory: bytes
+
+
+def is_static(op: Operation) -> bool:
+    if op.type in [OpType.OpPrint, OpType.OpReturn] or has_call(op):
+        return False
+
+    # function pointers only exist once the c program runs
+    return op.type == OpType.OpBeginScope or not any([type(tp) == FuncType for tp in op.types])
+
+
+# Operations main can start from, statements at its top level that aren't part of an if
+# chain, up to the first operation that can't run at compile time
+def resume_points(ops: List[Operation]) -> List[int]:
+    points: List[int] = []
+    depth = 0
+
+    for ip, op in enumerate(ops):
+        if depth == 1 and ops[ip - 1].type not in [OpType.OpPush] + block_operations and op.type != OpType.OpElse \
+                and not (op.type == OpType.OpPush and ops[ip + 1].type == OpType.OpElseIf):
+            points.append(ip)
+
+        if not is_static(op):
+            break
+
+        if op.type == OpType.OpBeginScope:
+            depth += 1
+        elif op.type == OpType.OpEndScope:
+            depth -= 1
+
+    return points
+
+
+# Runs main until it gets to stop, fails or runs out of steps, returns where it stopped and
+# the furthest resume point it got to
+def run_prefix(program: Program, stop: int, points: set, budget: int) -> tuple[int, int, List, Memory]:
+    prefix = Program(program.memory_ptr, program.memory_capacity, [],
+                     program.operations[:stop], program.frame_size)
+
+    frame = [0] * program.frame_size
+    global_memory = make_memory(program.memory_capacity)
+    steps = closures.compile_operations(prefix, frame, global_memory, AllocStats())
+
+    ip = 0
+    reached = 0
+
+    # errors are left for the compiled program to report when it gets there
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(budget):
+                if ip in points:
+                    reached = max(reached, ip)
+
+                if ip == stop:
+                    break
+
+                ip = steps[ip]()
+
+    except (Exception, SystemExit):
+        pass
+
+    return ip, reached, frame, global_memory
+
+
+def fits(value: int | float, tp: Types) -> bool:
+    if tp in [Primitives.F32, Primitives.F64]:
+        return math.isfinite(value)
+    elif tp in [Primitives.Byte, Primitives.Bool]:
+        return 0 <= value <= 255
+
+    low, high = i32_range if tp == Primitives.I32 else i64_range
+
+    return low <= value <= high
+
+
+def evaluate_prefix(program: Program, budget: int = default_budget) -> StaticImage | None:
+    program = copy.deepcopy(program)
+    lower_program(program)
+
+    points = resume_points(program.operations)
+    if len(points) < 2:
+        return None
+
+    ip, reached, frame, global_memory = run_prefix(
+        program, points[-1], set(points), budget)
+
+    # the state at the last point passed is gone, running again up to it is cheaper than
+    # keeping copies of it along the way
+    if ip != reached:
+        ip, reached, frame, global_memory = run_prefix(
+            program, reached, set(points), budget)
+
+    if ip != reached or reached == points[0]:
+        return None
+
+    scope = program.operations[0]
+    values = {}
+
+    for name, tp, slot in zip(scope.oprands[1:], scope.types[1:], scope.slots):
+        value = frame[slot]
+
+        if type(tp) == FuncType:
+            continue
+        elif type(tp) not in [Primitives, TypedPtr] or not fits(value, tp):
+            return None
+
+        values[name] = value
+
+    memory = bytes(global_memory.data[:program.memory_capacity]).rstrip(b"\0")
+
+    return StaticImage(reached, values, memory)
@@ -0,0 +1,205 @@
+import copy
+from typing import List
+
+from ir import const_node, declare_temporary, declared_names, enclosing_scope, expression_tree, fresh_name, \
+    has_call, is_const, load_node, make_mov, make_push, node_size, relink_jumps, same_tree, set_expression
+from licm import is_invariant, replace_subtrees
+from lowering import ExprOp, Node
+from parser import OpType, Operation, Program
+from static_types import Primitives, TypedPtr
+
+# Strength reduction, a basic induction variable is one the loop changes exactly once per
+# iteration by a constant (`i = i+1` at the top level of the body). Expressions linear in
+# it that need a multiply, like `arr+i*8`, get their own variable which is set up before
+# the loop and bumped by the stride right after the induction variable moves
+
+
+def is_counter(node: Node, var: str) -> bool:
+    return node.opcode == ExprOp.Load and node.value == var
+
+
+# Returns the step of `var = var + c` / `var = var - c` or None
+def induction_step(op: Operation, var: str) -> int | None:
+    tree = expression_tree(op)
+    if tree.opcode not in [ExprOp.Add, ExprOp.Sub]:
+        return None
+
+    b, a = tree.children
+    if is_counter(b, var) and is_const(a) and type(a.value) == int:
+        return a.value if tree.opcode == ExprOp.Add else -a.value
+    if tree.opcode == ExprOp.Add and is_counter(a, var) and is_const(b) and type(b.value) == int:
+        return b.value
+
+    return None
+
+
+# Coefficient of var in node when node is linear in it with constant coefficients
+def linear_coefficient(node: Node, var: str, variant: set) -> int | None:
+    if is_counter(node, var):
+        return 1
+    elif is_invariant(node, variant, False):
+        return 0
+
+    if node.opcode in [ExprOp.Add, ExprOp.Sub] and is_binary_integer(node):
+        b = linear_coefficient(node.children[0], var, variant)
+        a = linear_coefficient(node.children[1], var, variant)
+        if a is None or b is None:
+            return None
+
+        return b + a if node.opcode == ExprOp.Add else b - a
+
+    elif node.opcode == ExprOp.Mul and node.type == Primitives.I64:
+        b, a = node.children
+        if is_const(a) and type(a.value) == int:
+            coefficient = linear_coefficient(b, var, variant)
+            return None if coefficient is None else coefficient * a.value
+        if is_const(b) and type(b.value) == int:
+            coefficient = linear_coefficient(a, var, variant)
+            return None if coefficient is None else coefficient * b.value
+
+    return None
+
+
+def is_binary_integer(node: Node) -> bool:
+    return node.type == Primitives.I64 or type(node.type) == TypedPtr
+
+
+def multiplies(node: Node, var: str) -> bool:
+    if node.opcode == ExprOp.Mul and any([reads(child, var) for child in node.children]):
+        return True
+
+    return any([multiplies(child, var) for child in node.children])
+
+
+def reads(node: Node, var: str) -> bool:
+    return is_counter(node, var) or any([reads(child, var) for child in node.children])
+
+
+def find_derived(node: Node, var: str, variant: set, found: List[tuple[Node, int]]):
+    if len(node.children) == 0:
+        return
+
+    if is_binary_integer(node) and multiplies(node, var):
+        coefficient = linear_coefficient(node, var, variant)
+
+        if coefficient is not None and coefficient != 0:
+            if not any([same_tree(node, other) for other, _ in found]):
+                found.append((node, coefficient))
+            return
+
+    for child in node.children:
+        find_derived(child, var, variant, found)
+
+
+def bump(name: str, node: Node, stride: int) -> Node:
+    opcode = ExprOp.Add if stride > 0 else ExprOp.Sub
+    return Node(opcode, "+" if stride > 0 else "-", node.type,
+                [load_node(name, node.type), const_node(abs(stride), Primitives.I64)])
+
+
+# Reduces the expressions derived from one counter of the loop, returns the number of
+# operations inserted in front of it
+def reduce_loop(ops: List[Operation], ip: int, names: set) -> int:
+    start = ip - 1
+    end = ip + ops[ip].oprands[-1]
+
+    variant = set()
+    declared = set()
+    writes: dict = {}
+    depth = 0
+
+    for i in range(start, end + 1):
+        op = ops[i]
+        if has_call(op):
+            return 0
+
+        if op.type == OpType.OpBeginScope:
+            declared.update(op.oprands[1:])
+            depth += 1
+        elif op.type == OpType.OpEndScope:
+            depth -= 1
+        elif op.type == OpType.OpMov and not op.oprands[-2]:
+            var = op.oprands[-1]
+            variant.add(var)
+            writes.setdefault(var, []).append((i, depth))
+
+    variant.update(declared)
+
+    for var, assignments in writes.items():
+        if len(assignments) != 1 or var in declared:
+            continue
+
+        # has to run exactly once per iteration, so directly in the body's scope
+        mov, mov_depth = assignments[0]
+        if mov_depth != 1 or ops[mov - 1].type != OpType.OpPush:
+            continue
+
+        step = induction_step(ops[mov - 1], var)
+        if step is None or step == 0:
+            continue
+
+        found: List[tuple[Node, int]] = []
+        for op in ops[start:end]:
+            if op.type == OpType.OpPush and op is not ops[mov - 1]:
+                find_derived(expression_tree(op), var, variant, found)
+
+        if len(found) == 0:
+            continue
+
+        scope = ops[enclosing_scope(ops, start)]
+        setup: List[Operation] = []
+        bumps: List[Operation] = []
+        replacements: List[tuple[Node, Node]] = []
+
+        for tree, coefficient in found:
+            name = fresh_name(names, "_iv")
+            declare_temporary(scope, name, tree.type)
+            file, line = ops[start].file, ops[start].line
+
+            setup.append(make_push(copy.deepcopy(tree), file, line))
+            setup.append(make_mov(name, tree.type, file, line))
+
+            file, line = ops[mov].file, ops[mov].line
+            bumps.append(make_push(
+                bump(name, tree, coefficient * step), file, line))
+            bumps.append(make_mov(name, tree.type, file, line))
+
+            replacements.append((tree, load_node(name, tree.type)))
+
+        for op in ops[start:end]:
+            if op.type == OpType.OpPush:
+                tree = expression_tree(op)
+                size = node_size(tree)
+                tree = replace_subtrees(tree, replacements)
+
+                if node_size(tree) < size:
+                    set_expression(op, tree)
+
+        ops[mov + 1:mov + 1] = bumps
+        ops[start:start] = setup
+        relink_jumps(ops)
+
+        return len(setup)
+
+    return 0
+
+
+def reduce_strength(program: Program, ops: List[Operation]) -> List[Operation]:
+    names = declared_names(program)
+    done = set()
+
+    ip = 0
+    while ip < len(ops):
+        op = ops[ip]
+
+        if op.type == OpType.OpWhile and id(op) not in done:
+            done.add(id(op))
+
+            inserted = reduce_loop(ops, ip, names)
+            while inserted > 0:
+                ip += inserted
+                inserted = reduce_loop(ops, ip, names)
+
+        ip += 1
+
+    return ops
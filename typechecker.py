@@ -1,22 +1,17 @@
 from typing import List
 from misc import operator_predence, operator_list, binary_operators, report_error, unary_operators
-from parser import Function, OpType, Operation, Program
+from parser import Function, OpType, Operation, Program, Scope, open_scope
 from static_types import FuncCall, Primitives, TypedPtr, Types, type_str
 
 
-def find_scope_with_symbol(symbol: str, operations: Operation, global_scope: Operation) -> tuple[Operation, int]:
-    skip = False
-    for op in operations[::-1]:
-        if op.type == OpType.OpBeginScope:
-            if not skip and symbol in op.oprands:
-                return op, op.oprands.index(symbol)
-            skip = False
-        elif op.type == OpType.OpEndScope:
-            skip = True
+def find_scope_with_symbol(symbol: str, scopes: List[Scope], global_scope: Scope) -> tuple[Operation, int]:
+    for scope in scopes[::-1]:
+        if symbol in scope.symbols:
+            return scope.op, scope.symbols[symbol]
 
     # Global Scope
-    if symbol in global_scope.oprands:
-        return global_scope, global_scope.oprands.index(symbol)
+    if symbol in global_scope.symbols:
+        return global_scope.op, global_scope.symbols[symbol]
 
     return None, -1
 
@@ -107,25 +102,27 @@ def evaluate_stack(eval_stack: List[int | str],
 
 
 def typecheck_program(program: Program):
-    typecheck_operations(program, program.operations[0])
+    global_scope = open_scope(program.operations[0])
+    typecheck_operations(program, global_scope)
 
     for func in program.funcs:
-        typecheck_operations(func, program.operations[0])
+        typecheck_operations(func, global_scope)
 
 
-def typecheck_operations(program: Program | Function, global_scope: Operation):
+def typecheck_operations(program: Program | Function, global_scope: Scope):
     type_stack: List[Types] = []
     value_stack: List[int | str] = []
+    scopes: List[Scope] = []  # scopes open at the operation
 
-    assert len(OpType) == 10, "Exhaustive handling of operations"
+    assert len(OpType) == 12, "Exhaustive handling of operations"
 
     for ip, op in enumerate(program.operations[:]):
 
         if op.type == OpType.OpBeginScope:
-            pass
+            scopes.append(open_scope(op))
 
         elif op.type == OpType.OpEndScope:
-            pass
+            scopes.pop()
 
         elif op.type == OpType.OpPush:
             value_stack = []
@@ -137,14 +134,14 @@ def typecheck_operations(program: Program | Function, global_scope: Operation):
 
                 if tp == Primitives.Untyped:
                     foundop, j = find_scope_with_symbol(
-                        val, program.operations[:ip], global_scope)
+                        val, scopes, global_scope)
 
                     tp = foundop.types[j]
                     op.types[len(op.oprands) - (i+1)] = tp
 
                 if type(tp) == FuncCall:
                     foundop, j = find_scope_with_symbol(
-                        tp.name, program.operations[:ip], global_scope)
+                        tp.name, scopes, global_scope)
 
                     tp = foundop.types[j].outs[:].pop()
                     op.types[len(op.oprands) - (i+1)
@@ -165,7 +162,7 @@ def typecheck_operations(program: Program | Function, global_scope: Operation):
                         t = tps.pop()
                         if t == Primitives.Untyped:
                             foundop, oprr = find_scope_with_symbol(
-                                opr[-1], program.operations[:ip], global_scope)
+                                opr[-1], scopes, global_scope)
 
                             t = foundop.types[oprr]
 
@@ -206,7 +203,7 @@ def typecheck_operations(program: Program | Function, global_scope: Operation):
 
             if tp == Primitives.Untyped:
                 foundop, j = find_scope_with_symbol(
-                    symbol, program.operations[:ip], global_scope)
+                    symbol, scopes, global_scope)
                 op.types[-1] = found
                 foundop.types[j] = found
             elif tp != found:
@@ -281,3 +278,8 @@ def typecheck_operations(program: Program | Function, global_scope: Operation):
                 report_error(
                     f"unexpected return type for function expected `{type_str(return_type)}` found `{type_str(found)}`", op.file, op.line)
             pass
+
+        # bulk stores only ever come out of the optimizer which runs on typechecked programs
+        elif op.type in [OpType.OpFill, OpType.OpCopy]:
+            report_error(
+                f"unexpected bulk memory operation before optimization", op.file, op.line)
@@ -0,0 +1,278 @@
+from dataclasses import dataclass
+from typing import Callable, List
+
+from interpreter import Frame, Memory, load_var, store_var
+from ir import expression_tree, has_call, is_const
+from lowering import ExprOp, Node, visible_variables
+from parser import OpType, Operation, Program
+from static_types import Primitives, TypedPtr, Types, size_of_primitive
+from strength import induction_step
+
+# numpy is optional, without it every loop simply keeps running one element at a time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Vectorized loops, a counted loop `while i < n` whose body only computes element addresses
+# with unit stride from i, or from variables stepping along with it, and stores an element
+# wise expression of the elements at them is run as one numpy operation over typed views of
+# global memory. Like idiom recognition it covers every iteration but the last one, the
+# interpreter runs that one so the variables end up exactly as before. Integers wrap in
+# numpy like they do on every store in the interpreter, adding and multiplying give the
+# same bits either way
+
+min_elements = 16
+
+bound_types = [Primitives.I32, Primitives.I64]
+element_types = [Primitives.I64, Primitives.F64]
+elementwise_opcodes = [ExprOp.Add, ExprOp.Sub, ExprOp.Mul]
+
+
+@dataclass
+class VectorLoop:
+    counter: str
+    bound: Node
+    inductions: dict  # variable -> what every iteration adds to it, the counter included
+    pointers: List[tuple[str, Primitives, Node]]  # element pointers with their address
+    values: List[tuple[str, Types, Node]]  # element wise temporaries in the order they are set
+    store: tuple[str, Node]  # pointer stored through and the value stored
+
+
+def reads_any(node: Node, names) -> bool:
+    if node.opcode == ExprOp.Load and node.value in names:
+        return True
+
+    return any([reads_any(child, names) for child in node.children])
+
+
+def is_linear(node: Node, inductions: dict) -> bool:
+    if node.opcode in [ExprOp.Add, ExprOp.Sub]:
+        return all([is_linear(child, inductions) for child in node.children])
+    elif node.opcode == ExprOp.Mul:
+        b, a = node.children
+        return (not reads_any(b, inductions) and is_linear(a, inductions)) or \
+            (not reads_any(a, inductions) and is_linear(b, inductions))
+
+    return True
+
+
+def is_elementwise(node: Node, inductions: dict, variant: set, pointers: dict, values: set) -> bool:
+    if is_const(node):
+        return type(node.value) in [int, float]
+
+    elif node.opcode == ExprOp.Load:
+        name = node.value
+        return name in inductions or name in values or name not in variant
+
+    elif node.opcode == ExprOp.Deref:
+        child = node.children[0]
+        return child.opcode == ExprOp.Load and child.value in pointers
+
+    elif node.opcode in elementwise_opcodes:
+        return all([is_elementwise(child, inductions, variant, pointers, values) for child in node.children])
+
+    return False
+
+
+def vector_loop(ops: List[Operation], ip: int) -> VectorLoop | None:
+    end = ip + ops[ip].oprands[-1]
+    body = ops[ip + 1]
+
+    cond = expression_tree(ops[ip - 1])
+    if cond.opcode != ExprOp.Lt or cond.children[0].opcode != ExprOp.Load:
+        return None
+
+    counter = cond.children[0].value
+    bound = cond.children[1]
+
+    pairs = list(zip(ops[ip + 2:end:2], ops[ip + 3:end:2]))
+    if 2 * len(pairs) != end - ip - 2:
+        return None
+
+    for push, mov in pairs:
+        if push.type != OpType.OpPush or mov.type != OpType.OpMov or has_call(push):
+            return None
+
+    targets = [mov.oprands[-1] for _, mov in pairs if not mov.oprands[-2]]
+    if len(set(targets)) != len(targets) or counter not in targets:
+        return None
+
+    # the counter steps by one after the body, followed by whatever strength reduction
+    # made step along with it
+    inductions = {}
+    steps = [i for i, (_, mov) in enumerate(pairs) if mov.oprands[-1] == counter][0]
+    for push, mov in pairs[steps:]:
+        var = mov.oprands[-1]
+        step = induction_step(push, var)
+
+        if mov.oprands[-2] or step is None or var in body.oprands[1:]:
+            return None
+        if mov.types[-1] != Primitives.I64 and type(mov.types[-1]) != TypedPtr:
+            return None
+
+        inductions[var] = step
+
+    if inductions[counter] != 1:
+        return None
+
+    variant = set(targets) | set(body.oprands[1:])
+    if bound.type not in bound_types or not is_elementwise(bound, {}, variant, {}, set()):
+        return None
+
+    pointers: dict = {}
+    values: dict = {}
+    store = None
+
+    for push, mov in pairs[:steps]:
+        tree = expression_tree(push)
+        name = mov.oprands[-1]
+        tp = mov.types[-1]
+
+        if mov.oprands[-2]:
+            if store is not None or name not in pointers or \
+                    not is_elementwise(tree, inductions, variant, pointers, set(values)):
+                return None
+
+            store = (name, tree)
+
+        elif type(tp) == TypedPtr:
+            if tp.primitive not in element_types or not is_elementwise(tree, inductions, variant, {}, set()):
+                return None
+            if not is_linear(tree, inductions):
+                return None
+
+            pointers[name] = (tp.primitive, tree)
+
+        elif tp in element_types and is_elementwise(tree, inductions, variant, pointers, set(values)):
+            values[name] = (tp, tree)
+
+        else:
+            return None
+
+    if store is None:
+        return None
+
+    return VectorLoop(counter, bound, inductions,
+                      [(name, primitive, tree) for name, (primitive, tree) in pointers.items()],
+                      [(name, tp, tree) for name, (tp, tree) in values.items()],
+                      store)
+
+
+def dtype(primitive: Primitives):
+    return np.int64 if primitive == Primitives.I64 else np.float64
+
+
+def evaluate(node: Node, env: dict, elements: dict):
+    if is_const(node):
+        return node.value
+    elif node.opcode == ExprOp.Load:
+        return env[node.value]
+    elif node.opcode == ExprOp.Deref:
+        return elements[node.children[0].value]
+
+    b, a = [evaluate(child, env, elements) for child in node.children]
+    if node.opcode == ExprOp.Add:
+        return b + a
+    elif node.opcode == ExprOp.Sub:
+        return b - a
+
+    return b * a
+
+
+def convert(value, tp: Types, count: int):
+    value = np.broadcast_to(np.asarray(value), (count,))
+
+    # like the interpreter a float assigned to an integer is cut off towards zero
+    if tp == Primitives.I64 and value.dtype.kind == "f":
+        value = np.trunc(value)
+
+    return value.astype(dtype(tp))
+
+
+# Runs all iterations but the last one of the loop, returns false when the loop is better
+# left to the interpreter
+def run_vector_loop(program: Program, ip: int, loop: VectorLoop, frame: Frame, global_memory: Memory) -> bool:
+    op = program.operations[ip]
+    variables = visible_variables(program.operations, ip - 1)
+
+    env = {}
+    for name, (slot, tp) in variables.items():
+        if type(tp) in [Primitives, TypedPtr] and tp not in [Primitives.Untyped, Primitives.Operator]:
+            env[name] = load_var(frame, slot, tp, op.file, op.line)
+
+    start = env[loop.counter]
+    count = evaluate(loop.bound, env, {}) - start - 1
+    if count < min_elements:
+        return False
+
+    following = env | {var: env[var] + step for var, step in loop.inductions.items()}
+
+    # addresses the first iteration computes, every iteration after has to move them by
+    # exactly one element
+    ranges: dict = {}
+    pointers = {name: (primitive, tree) for name, primitive, tree in loop.pointers}
+    for name, primitive, tree in loop.pointers:
+        address = evaluate(tree, env, {})
+        size = size_of_primitive(primitive)
+
+        if evaluate(tree, following, {}) - address != size:
+            return False
+        if address < 0 or address % size != 0 or address + count * size > len(global_memory.data):
+            return False
+
+        ranges[name] = (address, address + count * size)
+
+    target, value = loop.store
+    dst = ranges[target]
+    if dst[1] > program.memory_ptr:
+        return False
+
+    # elements read from anywhere but the very elements being stored would see the store
+    for name, (low, high) in ranges.items():
+        if name != target and low != dst[0] and low < dst[1] and dst[0] < high:
+            return False
+
+    views = {}
+    for primitive in set([primitive for primitive, _ in pointers.values()]):
+        views[primitive] = np.frombuffer(global_memory.data, dtype=dtype(primitive))
+
+    elements = {}
+    for name, (low, high) in ranges.items():
+        primitive = pointers[name][0]
+        size = size_of_primitive(primitive)
+        elements[name] = views[primitive][low // size:high // size]
+
+    iterations = np.arange(count, dtype=np.int64)
+    for var, step in loop.inductions.items():
+        env[var] = env[var] + iterations * step
+    for name, tp, tree in loop.values:
+        env[name] = convert(evaluate(tree, env, elements), tp, count)
+
+    primitive = pointers[target][0]
+    elements[target][:] = convert(evaluate(value, env, elements), primitive, count)
+
+    for var, step in loop.inductions.items():
+        slot, tp = variables[var]
+        store_var(frame, slot, tp, int(env[var][0]) + count * step, op.file, op.line)
+
+    return True
+
+
+class VectorLoops:
+    # loops that can't be vectorized go to the next runner, see jit.HotLoops
+    def __init__(self, next_runner: Callable[[Program, int, Frame, Memory], bool] | None = None):
+        self.next_runner = next_runner
+        self.loops: dict = {}  # while index -> vector loop or None
+
+    def __call__(self, program: Program, ip: int, frame: Frame, global_memory: Memory) -> bool:
+        if np is not None:
+            if ip not in self.loops:
+                self.loops[ip] = vector_loop(program.operations, ip)
+
+            loop = self.loops[ip]
+            if loop is not None and run_vector_loop(program, ip, loop, frame, global_memory):
+                # the interpreter runs the last iteration
+                return False
+
+        return self.next_runner is not None and self.next_runner(program, ip, frame, global_memory)